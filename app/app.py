@@ -1,39 +1,135 @@
 #!flask/bin/python
 
+import json
 import logging
+import tarfile
+import time
+from datetime import datetime, timedelta
+from hashlib import sha256
+from itertools import chain
+from uuid import uuid4
+
+import click
+
 import werkzeug.datastructures
-from flask import Flask, request, abort
+from flask import Blueprint, Flask, Response, current_app, g, request, abort, has_request_context, jsonify, stream_with_context
 
 from log_util import LogUtil
-from werkzeug.exceptions import BadRequest
-from hashlib import sha256
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 
 import config
+from cache import file_cache
 from database import db, migrate
-from models import File
-from file_store import memcached_client, check_all_keys
-from exception.memcache import MemcacheKeyNotFound
+from models import File, FilePart, UploadSession, pack_files, release_keys
+from scrubber import Scrubber, readable
+import metrics
+from single_flight import SingleFlight
+from file_store import memcached_client, live_keys, iter_fetch
+from exception.memcache import MemcacheKeyNotFound, MemcacheKeyDataCorrupt
 
 logger_name = config.logger_name
 # initialize logger
 LogUtil(logger_name)
 logger = logging.getLogger(logger_name)
 
-# Main flask application
-app = Flask(__name__)
+# Concurrent reads of same file and dedup checks of same data are done once per process
+downloads = SingleFlight()
+dedup_checks = SingleFlight()
+
+# Routes of the app, registered on each app created by create_app. Commands are top level commands of flask cli.
+api = Blueprint('api', __name__, cli_group=None)
+
+
+def create_app(flask_config: dict = None) -> Flask:
+    """
+    Create flask app.
+    Nothing connects to the database or memcached here, engines and memcached clients are created
+    on first use, so that each worker process forked by a prefork server creates its own.
+    Args:
+        flask_config: flask config overriding the one built from config module
+
+    Returns: flask app
+
+    """
+    flask_app = Flask(__name__)
+    # Max file size to accept in bytes with buffer of 250 bytes for extra data like key for file.
+    flask_app.config['MAX_CONTENT_LENGTH'] = (config.max_file_size * 1024 * 1024) + 250
+    # DB Connection String
+    flask_app.config['SQLALCHEMY_DATABASE_URI'] = config.db_str
+
+    # Flask-SQLAlchemy has its own event notification system that gets layered on top of SQLAlchemy.
+    # To do this, it tracks modifications to the SQLAlchemy session. This takes extra resources,
+    # so the option SQLALCHEMY_TRACK_MODIFICATIONS allows us to disable the modification tracking system.
+    flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    flask_app.config.update(flask_config or {})
+
+    # Create an instance of db to store information about each file.
+    db.init_app(flask_app)
+    # Schema changes are applied with `flask db upgrade`, batch mode lets them run on SQLite as well
+    migrate.init_app(flask_app, db, render_as_batch=True)
+    flask_app.register_blueprint(api)
+    return flask_app
+
+
+@api.before_app_request
+def start_request_metrics() -> None:
+    """Start timing request, and profiling it if profiling is enabled and requested with a header."""
+    g.request_start = time.perf_counter()
+    metrics.bytes_received.inc(request.content_length or 0)
+    if config.profiling_enabled and request.headers.get(config.profile_header):
+        g.profiler = metrics.SamplingProfiler(config.profile_interval).start()
+
+
+@api.after_app_request
+def record_request_metrics(response: Response) -> Response:
+    """
+    Observe latency and size of response, latency of streamed responses is observed once they are sent.
+    Args:
+        response: response of request
+
+    Returns: same response
+
+    """
+    endpoint = request.endpoint or 'unknown'
+    start = g.get('request_start', time.perf_counter())
+    profiler = g.get('profiler')
 
-# Max file size to accept in bytes with buffer of 250 bytes for extra data like key for file.
-app.config['MAX_CONTENT_LENGTH'] = (config.max_file_size * 1024 * 1024) + 250
-# DB Connection String
-app.config['SQLALCHEMY_DATABASE_URI'] = config.db_str
+    def finish() -> None:
+        metrics.request_seconds.observe(endpoint, time.perf_counter() - start)
+        if profiler is not None:
+            metrics.profiles.put(profiler.id, profiler.stop())
 
-""" Flask-SQLAlchemy has its own event notification system that gets layered on top of SQLAlchemy.
- To do this, it tracks modifications to the SQLAlchemy session. This takes extra resources,
- so the option SQLALCHEMY_TRACK_MODIFICATIONS allows us to disable the modification tracking system."""
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if profiler is not None:
+        response.headers['X-Profile-Id'] = profiler.id
+    if response.is_streamed:
+        response.response = _counting(response.response)
+    else:
+        metrics.bytes_sent.inc(response.content_length or 0)
+    response.call_on_close(finish)
+    return response
 
 
-@app.route('/api/healthcheck', methods=['GET'])
+def _counting(blocks):
+    """
+    Generator passing blocks of a streamed response through and counting their bytes as sent.
+    Args:
+        blocks: iterable of bytes
+
+    Returns:
+        bytes: each block
+    """
+    try:
+        for block in blocks:
+            metrics.bytes_sent.inc(len(block))
+            yield block
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+
+
+@api.route('/api/healthcheck', methods=['GET'])
 def health_check() -> str:
     """
     Checks health check of application.
@@ -53,7 +149,7 @@ def health_check() -> str:
     return "OK"
 
 
-@app.route('/api/liveness', methods=['GET'])
+@api.route('/api/liveness', methods=['GET'])
 def liveness_check() -> str:
     """
     Checks liveness of application
@@ -66,7 +162,7 @@ def liveness_check() -> str:
     return "OK"
 
 
-@app.route('/api/files/<string:file_id>', methods=['GET'])
+@api.route('/api/files/<string:file_id>', methods=['GET'])
 def get_files(file_id: str) -> str:
     """
     Get file data for supplied file id
@@ -78,10 +174,31 @@ def get_files(file_id: str) -> str:
     """
     try:
         logger.info(f"Fetching data for file id {file_id}")
-        file = File.query.get_or_404(file_id,
-                                     f'Sorry, could\'t find any file with the id {file_id}')
-        content = file.contents
-        return content
+        if has_request_context() and request.range is not None:
+            range_response = _range_response(file_id)
+            if range_response is not None:
+                return range_response
+        cached_chunks = file_cache.get(file_id)
+        if cached_chunks is not None:
+            logger.debug(f"Serving file id {file_id} from file cache")
+            if config.stream_downloads:
+                return Response(iter(cached_chunks),
+                                headers={'Content-Length': str(sum(len(chunk) for chunk in cached_chunks))})
+            return b''.join(cached_chunks)
+        if config.stream_downloads:
+            file = _get_file_or_404(file_id)
+            chunks = _caching_chunks(str(file.id), file.iter_contents())
+            # read first chunk before response starts, so that evicted or corrupted data still gets error status
+            first_chunk = next(chunks, b'')
+            response = Response(stream_with_context(chain([first_chunk], chunks)))
+            if file.size is not None:
+                # without length clients can't tell a download cut short by a failing chunk from a complete one
+                response.headers['Content-Length'] = str(file.size)
+            return response
+        if config.single_flight:
+            # concurrent requests for this file share a single fetch and verification of its data
+            return downloads.do(file_id, lambda: _read_file(file_id))
+        return _read_file(file_id)
     # TODO: Handle specific types of exception as per db and memcached
     except MemcacheKeyNotFound as mem_ex:
         abort(404, f"Data has been evicted or is corrupted.")
@@ -95,17 +212,245 @@ def get_files(file_id: str) -> str:
         abort(500, f"Error in retrieving data for id {file_id}")
 
 
-@app.route('/api/files', methods=['POST'])
+def _get_file_or_404(file_id: str) -> File:
+    """
+    Get file record for supplied file id
+    Args:
+        file_id: unique id of file
+
+    Returns: file record, aborts with 404 if there is no such file
+
+    """
+    return File.query.get_or_404(file_id, f'Sorry, could\'t find any file with the id {file_id}')
+
+
+def _range_response(file_id: str):
+    """
+    Get partial content of file for range requested in Range header.
+    Only chunks overlapping the range are fetched. Checksum of file is its ETag,
+    a range with If-Range header is served only if it matches.
+    Args:
+        file_id: unique id of file
+
+    Returns: 206 response with requested range, 416 response if range is not satisfiable,
+        None if whole file is to be served instead
+
+    """
+    file = _get_file_or_404(file_id)
+    size = file.size
+    if_range = request.if_range
+    if size is None or len(request.range.ranges) != 1:
+        # size of parts is not known or multiple ranges are requested, whole file is served
+        return None
+    if (if_range.etag or if_range.date) and if_range.etag != file.checksum:
+        # file has changed for client, whole file is served
+        return None
+    byte_range = request.range.range_for_length(size)
+    if byte_range is None:
+        logger.error(f"Requested range {request.range} is not satisfiable for file id {file_id} of size {size}")
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+    start, stop = byte_range
+    chunks = file.iter_range(start, stop)
+    # read first chunk before response starts, so that evicted or corrupted data still gets error status
+    first_chunk = next(chunks, b'')
+    response = Response(stream_with_context(chain([first_chunk], chunks)), status=206)
+    response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(file.checksum)
+    return response
+
+
+def _read_file(file_id: str) -> bytes:
+    """
+    Read and verify data of file, and cache it.
+    Args:
+        file_id: unique id of file
+
+    Returns: file data
+
+    """
+    file = _get_file_or_404(file_id)
+    content = file.contents
+    file_cache.put(str(file.id), (content,), len(content))
+    return content
+
+
+def _caching_chunks(file_id: str, chunks):
+    """
+    Generator passing verified chunks through and caching them once all of them are read.
+    Chunks are not kept once they exceed max size of a cache entry.
+    Args:
+        file_id: unique id of file
+        chunks: iterator over verified chunks of file
+
+    Returns:
+        chunk: each chunk of file
+    """
+    collected = [] if file_cache.enabled else None
+    size = 0
+    for chunk in chunks:
+        if collected is not None:
+            size += len(chunk)
+            collected = collected if size <= file_cache.max_entry_bytes else None
+            if collected is not None:
+                collected.append(chunk)
+        yield chunk
+    if collected is not None:
+        file_cache.put(file_id, tuple(collected), size)
+
+
+@api.route('/api/files/batch', methods=['POST'])
+def get_files_batch() -> Response:
+    """
+    Get data of many files in a single uncompressed tar stream.
+    Request body is JSON {"ids": [...]}. Each file is a tar entry named <id>/<file name>.
+    A file which is not found, or whose data is evicted or corrupted, is an entry <id>.error
+    with the reason, other files are still served.
+
+    Returns: tar stream
+
+    """
+    file_ids = (request.get_json(silent=True) or {}).get('ids')
+    if not isinstance(file_ids, list) or not all(isinstance(file_id, int) for file_id in file_ids):
+        raise BadRequest("List of file ids is not supplied.")
+    if len(file_ids) > config.batch_download_max_files:
+        raise BadRequest(f"At most {config.batch_download_max_files} files can be fetched at once.")
+    file_ids = list(dict.fromkeys(file_ids))
+    logger.info(f"Fetching data for {len(file_ids)} files")
+    # files and their parts are read with a single query
+    files = {file.id: file for file in File.query.options(db.joinedload(File.parts))
+             .filter(File.id.in_(file_ids))}
+    return Response(stream_with_context(_tar_entries(file_ids, files)), mimetype='application/x-tar')
+
+
+def _tar_entries(file_ids: list, files: dict):
+    """
+    Generator over tar stream of files.
+    Chunks of all files which are not cached are fetched with multi-gets in windows spanning files,
+    next window is fetched while a file is written.
+    Args:
+        file_ids: ids of files in order of entries
+        files: File objects with their parts by id
+
+    Returns:
+        bytes: blocks of tar stream
+    """
+    cached = {file_id: file_cache.get(str(file_id)) for file_id in file_ids if file_id in files}
+    keys = [part.memcached_key for file_id in file_ids if file_id in files and cached[file_id] is None
+            for part in files[file_id].data_parts]
+    payloads = iter_fetch(keys, config.memcached_fetch_window, missing_ok=True)
+    for file_id in file_ids:
+        file = files.get(file_id)
+        if file is None:
+            yield from _tar_entry(f'{file_id}.error', f"Sorry, couldn't find any file with the id {file_id}".encode())
+            continue
+        if cached[file_id] is not None:
+            yield from _tar_entry(_entry_name(file_id, file), b''.join(cached[file_id]))
+            continue
+        chunks = [File._verified(part, payload) for part, payload in zip(file.data_parts, payloads)]
+        try:
+            # evicted or corrupted chunks are rebuilt from parity chunks, or file is removed
+            content = b''.join(chunks) if None not in chunks else file.contents
+        except (MemcacheKeyNotFound, MemcacheKeyDataCorrupt) as ex:
+            logger.error(f"Could not read data for file id {file_id} of batch: {ex}")
+            yield from _tar_entry(f'{file_id}.error', b"Data has been evicted or is corrupted.")
+            continue
+        file_cache.put(str(file_id), (content,), len(content))
+        yield from _tar_entry(_entry_name(file_id, file), content)
+    # end of archive
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def _entry_name(file_id: int, file: File) -> str:
+    """
+    Get name of tar entry of file.
+    File names are sent by clients, so they are reduced to a plain name which can't escape
+    directory of entry when archive is extracted.
+    Args:
+        file_id: unique id of file
+        file: File object
+
+    Returns: '<id>/<file name>', file name is id if nothing is left of it
+
+    """
+    return f'{file_id}/{secure_filename(file.file_name or "") or file_id}'
+
+
+def _tar_entry(name: str, content: bytes):
+    """
+    Generator over tar header and data blocks of a file
+    Args:
+        name: name of entry
+        content: data of file
+
+    Returns:
+        bytes: header, data and padding to tar block size
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = int(time.time())
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    yield content
+    yield bytes(-len(content) % tarfile.BLOCKSIZE)
+
+
+@api.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Get counters of in-process file cache, to help sizing it.
+
+    Returns: hits, misses, evictions and size of cache
+
+    """
+    return jsonify(file_cache.stats())
+
+
+@api.route('/api/metrics', methods=['GET'])
+def get_metrics() -> Response:
+    """
+    Get latency histograms of stages, memcached operations and requests, and counters
+    of this process in Prometheus text format.
+
+    Returns: metrics
+
+    """
+    extra_lines = []
+    for name, value in file_cache.stats().items():
+        extra_lines.append(f'file_store_file_cache_{name} {value}')
+    for name, flight in (('downloads', downloads), ('dedup_checks', dedup_checks)):
+        extra_lines.append(f'file_store_single_flight_calls{{flight="{name}"}} {flight.calls}')
+        extra_lines.append(f'file_store_single_flight_shared{{flight="{name}"}} {flight.shared}')
+    return Response(metrics.render(extra_lines), mimetype='text/plain; version=0.0.4')
+
+
+@api.route('/api/profiles/<string:profile_id>', methods=['GET'])
+def get_profile(profile_id: str) -> Response:
+    """
+    Get profile of a request, which is taken when request has profiling header.
+    Each line is a stack with outermost frame first and its number of samples.
+    Args:
+        profile_id: id returned in X-Profile-Id header of profiled request
+
+    Returns: profile in collapsed stack format
+
+    """
+    profile = metrics.profiles.get(profile_id)
+    if profile is None:
+        abort(404, f"Sorry, couldn't find any profile with the id {profile_id}")
+    return Response(profile, mimetype='text/plain')
+
+
+@api.route('/api/files', methods=['POST'])
 def post_files() -> int:
     """
     Store one or more files.
 
     This method expects the POST request to include one or more files as part
-    of the request.
+    of the request. Small files are read whole and packed together once duplicates are left out.
     Returns: id of file
 
     """
-    file_ids = []
     files = request.files
     # Check if file is supplied
     if not len(files):
@@ -116,35 +461,133 @@ def post_files() -> int:
     is_validated, resp_msg = _validate_files(files)
     if not is_validated:
         raise BadRequest(resp_msg)
+    # checksum of each file in request, in request order
+    checksums = []
+    # id of stored file by checksum
+    file_ids = {}
+    # files of request to be stored by checksum, all of them are stored in a single transaction
+    uploads = {}
+    # small files of request and their data by checksum, to be packed together
+    small_files = {}
+    packing = config.pack_max_file_size > 0 and not config.erasure_data_chunks
     try:
         for file_id, file_data in files.items():
-            file_record, checksum = _file_record(file_data)
-
-            if file_record:
-                file_ids.append(str(file_record.id))
+            user_file = File(file_name=file_id)
+            data = file_data.stream.read(config.pack_max_file_size + 1) if packing else None
+            if data is not None and len(data) <= config.pack_max_file_size:
+                with metrics.timed('hash'):
+                    user_file.checksum = sha256(data).hexdigest()
+                parts = []
             else:
-                # Create the file in the database
-                user_file = File(file_name=file_id)
-
-                db.session.add(user_file)
-                db.session.flush()
-                file_data.stream.seek(0)
-                # Store each portion of the file.  What happens if this fails though :
+                if data is not None:
+                    file_data.stream.seek(0)
+                # Store each portion of the file while calculating its checksum, so stream is read only once.
                 # we will free up memcached in case of failure
-                for part in user_file.save(file_data.stream, checksum):
-                    db.session.add(part)
+                parts = user_file.save(file_data.stream)
+                data = None
+            checksums.append(user_file.checksum)
 
-                db.session.commit()
-                file_ids.append(str(user_file.id))
-                logger.info(f"Stored files for request with ids: {file_ids}")
-        return ','.join(file_ids)
+            if user_file.checksum in uploads or user_file.checksum in small_files or user_file.checksum in file_ids:
+                # same data is supplied twice in request
+                metrics.dedup_hits.inc(label_value='request')
+                _discard_parts(parts, uploads)
+                continue
+            stored_file_id = _stored_file_id(user_file.checksum)
+            if stored_file_id is not None:
+                # same data is already stored, discard chunks written for this upload
+                metrics.dedup_hits.inc(label_value='upload')
+                _discard_parts(parts, uploads)
+                file_ids[user_file.checksum] = stored_file_id
+            elif data is not None:
+                small_files[user_file.checksum] = (user_file, data)
+            else:
+                uploads[user_file.checksum] = (user_file, parts)
+        if small_files:
+            for (user_file, _), parts in zip(small_files.values(), pack_files(list(small_files.values()))):
+                uploads[user_file.checksum] = (user_file, parts)
+        if uploads:
+            file_ids.update(_store_files(uploads))
+            logger.info(f"Stored files for request with ids: {list(file_ids.values())}")
+        return ','.join(str(file_ids[checksum]) for checksum in checksums)
     except Exception as exep:
         logger.error(f"Got exception in processing request: {exep}")
         # in case of error rollback session
         db.session.remove()
+        # free up memcached for every file of request which is not stored
+        for _, parts in uploads.values():
+            _discard_parts(parts)
         abort(500, "Could not process your request due to some technical error")
 
 
+def _store_files(uploads: dict) -> dict:
+    """
+    Store files and their parts in database in a single transaction.
+    If a file with same data is stored by a concurrent request meanwhile, its chunks are discarded
+    and the stored file is used instead.
+    Args:
+        uploads: saved file and parts of each file by checksum, stored files are removed from it
+
+    Returns:
+        file_ids: id of stored file by checksum
+
+    """
+    try:
+        with metrics.timed('commit'):
+            file_ids = _insert_files(uploads)
+            db.session.commit()
+    except IntegrityError:
+        # some data was stored by a concurrent upload after our check, checksum is unique
+        db.session.rollback()
+        file_ids = {}
+        for checksum in list(uploads):
+            file_record = File.query.filter_by(checksum=checksum).first()
+            if file_record:
+                logger.debug(f"File with checksum {checksum} was stored concurrently")
+                _, parts = uploads.pop(checksum)
+                _discard_parts(parts, uploads)
+                file_ids[checksum] = file_record.id
+        file_ids.update(_insert_files(uploads))
+        db.session.commit()
+    uploads.clear()
+    return file_ids
+
+
+def _insert_files(uploads: dict) -> dict:
+    """
+    Insert files and their parts in current transaction.
+    Parts of all files are inserted with a single bulk statement.
+    Args:
+        uploads: saved file and parts of each file by checksum
+
+    Returns:
+        file_ids: id of inserted file by checksum
+
+    """
+    user_files = {checksum: File(file_name=saved_file.file_name, checksum=checksum, chunk_size=saved_file.chunk_size)
+                  for checksum, (saved_file, _) in uploads.items()}
+    db.session.add_all(user_files.values())
+    # flush to get ids of files for their parts
+    db.session.flush()
+    db.session.bulk_insert_mappings(FilePart, [
+        mapping for checksum, (_, parts) in uploads.items()
+        for mapping in _part_mappings(parts, file_id=user_files[checksum].id)])
+    return {checksum: user_file.id for checksum, user_file in user_files.items()}
+
+
+def _part_mappings(parts: list, **values) -> list:
+    """
+    Get column values of parts for a bulk insert
+    Args:
+        parts: list of FilePart objects
+        values: values of columns to set on every part
+
+    Returns: list of dict of column values
+
+    """
+    columns = [column.key for column in FilePart.__table__.columns if column.key != 'id']
+    return [dict({column: getattr(part, column) for column in columns}, **values) for part in parts]
+
+
 def _validate_files(files: dict) -> tuple:
     """
     Add some validation on received file object
@@ -179,40 +622,499 @@ def _validate_files(files: dict) -> tuple:
     return flag, msg
 
 
-def _file_record(stream) -> tuple:
+def _stored_file_id(checksum: str):
     """
-    Checks if file record is present with us in db.
-    Also checks if its data is present in memcached.
+    Get id of live file stored with supplied checksum.
+    Concurrent uploads of same data share a single lookup and liveness check.
     Args:
-        stream: stream having data
+        checksum: checksum of data supplied in stream
 
     Returns:
-        file_row: details of file stored in db
+        file_id: id of file stored in db, None if there is no live record
+
+    """
+    def lookup():
+        with metrics.timed('dedup_lookup'):
+            file_row = _file_record(checksum)
+        return file_row.id if file_row is not None else None
+
+    if config.single_flight:
+        return dedup_checks.do(checksum, lookup)
+    return lookup()
+
+
+def _file_record(checksum: str):
+    """
+    Checks if file record with supplied checksum is present with us in db.
+    Also checks if its data is present in memcached, unless scrubber has found it recently.
+    Args:
         checksum: checksum of data supplied in stream
 
+    Returns:
+        file_row: details of file stored in db, None if there is no live record
+
     """
-    checksum = sha256(stream.read()).hexdigest()
     logger.debug(f"Checking if entry for file with checksum {checksum} is present in db")
-    file_row = File.query.filter_by(checksum=checksum).first()
+    return _live_record(File.query.filter_by(checksum=checksum).first())
+
+
+def _live_record(file_row):
+    """
+    Check if data of file record is present in memcached, unless scrubber has found it recently.
+    Evicted data chunks can be rebuilt from parity chunks, record is deleted only if more chunks
+    of a parity group are evicted than it has parity chunks.
+    Args:
+        file_row: file stored in db, may be None
+
+    Returns:
+        file_row: same file, None if there is no live record
+
+    """
+    if file_row is not None and file_row.scrubbed_at is not None and \
+            datetime.utcnow() - file_row.scrubbed_at < timedelta(seconds=config.scrub_trust_seconds):
+        logger.debug(f"Trusting file id {file_row.id} scrubbed at {file_row.scrubbed_at}")
+        return file_row
     if file_row is not None:
-        # check if no chunk is evicted from memcached
+        # check if every data chunk is present in memcached or can be rebuilt, as scrubber does
         memcached_keys = [part.memcached_key for part in file_row.parts]
-        check = check_all_keys(memcached_keys)
-        if not check:
+        if not readable(file_row.parts, live_keys(memcached_keys)):
+            # delete corrupted record from memcached, chunks shared with other files are kept
+            release_keys(memcached_keys, file_row.id)
             logger.debug(f"Attempting to delete entry from db for file id {file_row.id}")
+            file_cache.invalidate(str(file_row.id))
             File.query.filter_by(id=file_row.id).delete()
             db.session.commit()
             # As we deleted corrupted data and record, this entry shouldn't be returned
             file_row = None
-    return file_row, checksum
+    return file_row
 
 
-if __name__ == '__main__':
-    # Create an instance of db to store information about each file.
+def _discard_parts(parts: list, uploads: dict = None) -> None:
+    """
+    Delete chunks of parts from memcached, parts are not stored in database.
+    Chunks which are shared with stored files or with files still to be stored are kept.
+    Args:
+        parts: list of FilePart objects
+        uploads: saved file and parts of files still to be stored by checksum
+
+    Returns: None
+
+    """
+    kept_keys = {part.memcached_key for _, upload_parts in (uploads or {}).values() for part in upload_parts}
+    keys = [part.memcached_key for part in parts if part.memcached_key not in kept_keys]
+    if keys:
+        logger.debug(f"Discarding {len(keys)} duplicate chunks from memcached")
+        release_keys(keys)
+
+
+@api.route('/api/checksums/<string:checksum>', methods=['GET'])
+def check_checksum(checksum: str) -> str:
+    """
+    Get id of stored file with supplied sha256, so that a client sends data only if it is not stored yet.
+    Optional size query parameter is matched with size of stored file.
+    Args:
+        checksum: sha256 hex digest of data
+
+    Returns: id of file, 404 if data is not stored
+
+    """
+    checksum = _valid_checksum(checksum)
+    size = request.args.get('size', type=int)
+    try:
+        file_id = _stored_file_id(checksum)
+        if file_id is not None and _size_matches(File.query.get(file_id), size):
+            metrics.dedup_hits.inc(label_value='checksum')
+            return str(file_id)
+    except Exception as ex:
+        logger.error(f"Got exception in checking checksum {checksum}: {ex}")
+        db.session.remove()
+        abort(500, "Could not process your request due to some technical error")
+    abort(404, f"No file is stored with checksum {checksum}")
+
+
+@api.route('/api/checksums', methods=['POST'])
+def check_checksums():
+    """
+    Get ids of stored files for many sha256 at once.
+    Request body is JSON {"files": [{"sha256": "...", "size": 123}, ...]}, size is optional.
+    Stored files are looked up with a single query.
+
+    Returns: JSON {"ids": [...]} with id of stored file or null for each supplied file, in request order
+
+    """
+    files = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(files, list) or not all(isinstance(file, dict) for file in files):
+        raise BadRequest("List of files is not supplied.")
+    if len(files) > config.checksum_batch_size:
+        raise BadRequest(f"At most {config.checksum_batch_size} files can be checked at once.")
+    checksums = [_valid_checksum(file.get('sha256')) for file in files]
+    try:
+        file_rows = {file_row.checksum: file_row
+                     for file_row in File.query.filter(File.checksum.in_(set(checksums)))}
+        live_ids = {}
+        for checksum, file_row in file_rows.items():
+            file_row = _live_record(file_row)
+            if file_row is not None:
+                live_ids[checksum] = file_row
+        ids = [live_ids[checksum].id if checksum in live_ids and _size_matches(live_ids[checksum], file.get('size'))
+               else None
+               for checksum, file in zip(checksums, files)]
+        metrics.dedup_hits.inc(sum(file_id is not None for file_id in ids), label_value='checksum')
+        return jsonify({'ids': ids})
+    except Exception as ex:
+        logger.error(f"Got exception in checking checksums: {ex}")
+        db.session.remove()
+        abort(500, "Could not process your request due to some technical error")
+
+
+def _valid_checksum(checksum) -> str:
+    """
+    Validate sha256 supplied by client
+    Args:
+        checksum: sha256 hex digest
+
+    Returns: checksum in lower case, raises BadRequest if it is not a sha256 hex digest
+
+    """
+    if not isinstance(checksum, str) or len(checksum) != 64 or \
+            any(character not in '0123456789abcdef' for character in checksum.lower()):
+        raise BadRequest(f"Checksum {checksum} is not a sha256 hex digest.")
+    return checksum.lower()
+
+
+def _size_matches(file_row: File, size) -> bool:
+    """
+    Check if size supplied by client matches size of stored file
+    Args:
+        file_row: stored file
+        size: size supplied by client, None if it is not supplied
+
+    Returns: False only if both sizes are known and differ
+
+    """
+    if size is None or file_row.size is None or file_row.size == size:
+        return True
+    logger.error(f"File id {file_row.id} has size {file_row.size}, client supplied size {size}")
+    return False
+
+
+@api.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """
+    Start an upload session, file is sent in numbered parts with PUT /api/uploads/<id>/parts/<number>
+    and is stored once the session is committed.
+    File name is taken from file_name query parameter or JSON body.
+
+    Returns: id and expiry of session
+
+    """
+    file_name = request.args.get('file_name') or (request.get_json(silent=True) or {}).get('file_name')
+    if not file_name:
+        logger.error("No file name is supplied for upload session")
+        raise BadRequest("File name is not supplied.")
+    try:
+        upload = UploadSession(id=str(uuid4()), file_name=file_name, expires_at=_session_expiry())
+        db.session.add(upload)
+        db.session.commit()
+        logger.info(f"Started upload session {upload.id} for file {file_name}")
+        return jsonify(_session_details(upload)), 201
+    except Exception as ex:
+        logger.error(f"Got exception in starting upload session: {ex}")
+        db.session.remove()
+        abort(500, "Could not process your request due to some technical error")
+
+
+@api.route('/api/uploads/<string:session_id>', methods=['GET'])
+def get_upload(session_id: str):
+    """
+    Get parts received by upload session, so that an interrupted upload resumes with missing parts only
+    Args:
+        session_id: id of upload session
+
+    Returns: id and expiry of session, number and size of each received part
+
+    """
+    return jsonify(_session_details(_get_session_or_404(session_id)))
+
+
+@api.route('/api/uploads/<string:session_id>/parts/<int:number>', methods=['PUT'])
+def put_upload_part(session_id: str, number: int):
+    """
+    Store a part of upload session, request body is data of part.
+    Parts can be sent in any order and concurrently, a part sent again replaces the earlier one.
+    A part which would make file larger than max file size is rejected before it is stored.
+    Args:
+        session_id: id of upload session
+        number: number of part, starting at 1
+
+    Returns: number, size and sha256 of part
+
+    """
+    if not 1 <= number <= config.upload_max_parts:
+        raise BadRequest(f"Part number should be between 1 and {config.upload_max_parts}.")
+    upload = _get_session_or_404(session_id)
+    # body is not parsed as a form, so max content length of app does not apply to it
+    stored_size = db.session.query(db.func.sum(FilePart.size)) \
+        .filter(FilePart.upload_session_id == upload.id, FilePart.upload_part != number,
+                FilePart.parity.is_(False)).scalar() or 0
+    max_part_size = config.max_file_size * 1024 * 1024 - stored_size
+    if request.content_length is not None and request.content_length > max_part_size:
+        abort(413, f"File is larger than {config.max_file_size} MB.")
+    part_file = File(file_name=upload.file_name)
+    parts = []
+    try:
+        # body is chunked as it is read, it is not buffered as a form. Body sent without length is read
+        # up to one byte past max size, which is enough to reject it.
+        parts = part_file.save(_BoundedStream(request.stream, max(max_part_size, 0) + 1))
+        if not parts:
+            raise BadRequest("Part is empty.")
+        if sum(part.size for part in parts if not part.parity) > max_part_size:
+            raise RequestEntityTooLarge(f"File is larger than {config.max_file_size} MB.")
+        replaced = FilePart.query.filter_by(upload_session_id=upload.id, upload_part=number)
+        replaced_keys = [key for key, in replaced.with_entities(FilePart.memcached_key)]
+        replaced.delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(FilePart, _part_mappings(parts, upload_session_id=upload.id,
+                                                                 upload_part=number))
+        upload.expires_at = _session_expiry()
+        db.session.commit()
+    except BadRequest:
+        raise
+    except RequestEntityTooLarge:
+        _discard_parts(parts)
+        raise
+    except IntegrityError:
+        logger.error(f"Part {number} of upload session {session_id} is stored concurrently")
+        db.session.rollback()
+        _discard_parts(parts)
+        abort(409, f"Part {number} is being uploaded by another request.")
+    except Exception as ex:
+        logger.error(f"Got exception in storing part {number} of upload session {session_id}: {ex}")
+        db.session.remove()
+        _discard_parts(parts)
+        abort(500, "Could not process your request due to some technical error")
+    if replaced_keys:
+        # chunks of replaced part, except ones shared with the new part
+        release_keys(replaced_keys)
+    logger.info(f"Stored part {number} of upload session {session_id}")
+    return jsonify({'number': number, 'size': sum(part.size for part in parts if not part.parity),
+                    'sha256': part_file.checksum})
+
+
+class _BoundedStream(object):
+    """Stream reading at most limit bytes of wrapped stream, reads end early if wrapped stream ends."""
+
+    def __init__(self, stream, limit: int):
+        self.stream = stream
+        self.remaining = limit
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.stream.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+
+@api.route('/api/uploads/<string:session_id>/commit', methods=['POST'])
+def commit_upload(session_id: str) -> str:
+    """
+    Store file of upload session from its parts, in order of part number.
+    Checksum of whole file is calculated here, a file with same data is reused like for POST /api/files.
+    Optional parts query parameter is the number of parts client has sent.
+    Args:
+        session_id: id of upload session
+
+    Returns: id of file
+
+    """
+    upload = _get_session_or_404(session_id)
+    parts = FilePart.query.filter_by(upload_session_id=upload.id) \
+        .order_by(FilePart.upload_part, FilePart.parity, FilePart.sequence).all()
+    numbers = sorted({part.upload_part for part in parts})
+    expected = request.args.get('parts', type=int)
+    if not numbers or numbers != list(range(1, len(numbers) + 1)) or expected not in (None, len(numbers)):
+        missing = sorted(set(range(1, max(numbers + [expected or 0]) + 1)) - set(numbers))
+        raise BadRequest(f"Parts {missing or [1]} of upload session are not received.")
+    data_parts = [part for part in parts if not part.parity]
+    if sum(part.size for part in data_parts) > config.max_file_size * 1024 * 1024:
+        abort(413, f"File is larger than {config.max_file_size} MB.")
+    checksum, evicted_part = _session_checksum(data_parts)
+    if evicted_part is not None:
+        abort(409, f"Part {evicted_part} of upload session is evicted, send it again.")
+    try:
+        file_id = _stored_file_id(checksum)
+        if file_id is None:
+            with metrics.timed('commit'):
+                file_id = _attach_parts(upload, parts, checksum)
+            if file_id is not None:
+                logger.info(f"Committed upload session {session_id} as file id {file_id}")
+                return str(file_id)
+            # same data is stored by a concurrent upload
+            file_id = File.query.filter_by(checksum=checksum).first().id
+        # same data is already stored, discard chunks of session
+        metrics.dedup_hits.inc(label_value='upload')
+        _delete_session(session_id)
+        logger.info(f"Upload session {session_id} has data of file id {file_id}")
+        return str(file_id)
+    except Exception as ex:
+        logger.error(f"Got exception in committing upload session {session_id}: {ex}")
+        db.session.remove()
+        abort(500, "Could not process your request due to some technical error")
+
+
+@api.route('/api/uploads/<string:session_id>', methods=['DELETE'])
+def delete_upload(session_id: str) -> str:
+    """
+    Abandon upload session and free its chunks
+    Args:
+        session_id: id of upload session
+
+    Returns: "OK"
+
+    """
+    _get_session_or_404(session_id)
+    _delete_session(session_id)
+    return "OK"
+
+
+def _session_expiry() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=config.upload_session_ttl)
+
+
+def _get_session_or_404(session_id: str) -> UploadSession:
+    """
+    Get upload session which has not expired
+    Args:
+        session_id: id of upload session
+
+    Returns: upload session, aborts with 404 if there is no such session
+
+    """
+    upload = UploadSession.query.get(session_id)
+    if upload is None or upload.expires_at <= datetime.utcnow():
+        abort(404, f"Sorry, couldn't find any upload session with the id {session_id}")
+    return upload
 
-    db.init_app(app)
-    migrate.init_app(app, db)
-    # Initialize the database.
-    db.create_all(app=app)
 
-    app.run(debug=False, threaded=True, host='0.0.0.0')
+def _session_details(upload: UploadSession) -> dict:
+    """
+    Get details of upload session
+    Args:
+        upload: upload session
+
+    Returns: dict of id, file name, expiry in ISO format and size of each received part
+
+    """
+    sizes = db.session.query(FilePart.upload_part, db.func.sum(FilePart.size)) \
+        .filter(FilePart.upload_session_id == upload.id, FilePart.parity.is_(False)) \
+        .group_by(FilePart.upload_part).order_by(FilePart.upload_part)
+    return {'id': upload.id, 'file_name': upload.file_name, 'expires_at': upload.expires_at.isoformat() + 'Z',
+            'parts': [{'number': number, 'size': int(size)} for number, size in sizes]}
+
+
+def _session_checksum(data_parts: list) -> tuple:
+    """
+    Calculate checksum of file from stored chunks of its parts
+    Args:
+        data_parts: data parts of upload session in file order
+
+    Returns:
+        checksum: sha256 hex digest of file, None if a chunk is evicted or corrupted
+        evicted_part: number of part to send again, None if every chunk is present
+
+    """
+    checksum = sha256()
+    payloads = iter_fetch([part.memcached_key for part in data_parts], config.memcached_fetch_window,
+                          missing_ok=True)
+    for part, payload in zip(data_parts, payloads):
+        chunk = File._verified(part, payload)
+        if chunk is None:
+            logger.error(f"Chunk {part.memcached_key} of part {part.upload_part} of upload session is evicted")
+            return None, part.upload_part
+        checksum.update(chunk)
+    return checksum.hexdigest(), None
+
+
+def _attach_parts(upload: UploadSession, parts: list, checksum: str):
+    """
+    Store file of upload session with its parts.
+    Parts are numbered in file order, and parity groups of parts are numbered across the file.
+    Args:
+        upload: upload session
+        parts: parts of session, data parts of each part number followed by its parity parts
+        checksum: checksum of file
+
+    Returns: id of file, None if a file with same checksum is stored concurrently
+
+    """
+    # parts may have been saved with different chunk sizes, largest chunk is recorded
+    user_file = File(file_name=upload.file_name, checksum=checksum,
+                     chunk_size=max(part.size for part in parts if not part.parity))
+    db.session.add(user_file)
+    try:
+        db.session.flush()
+        data_parts = [part for part in parts if not part.parity]
+        parity_parts = [part for part in parts if part.parity]
+        # parity groups are counted from 0 within each part number
+        group_offsets = {}
+        offset = 0
+        for number in sorted({part.upload_part for part in parts}):
+            group_offsets[number] = offset
+            groups = [part.parity_group for part in parts if part.upload_part == number
+                      and part.parity_group is not None]
+            offset += max(groups) + 1 if groups else 0
+        for sequence, part in enumerate(data_parts + parity_parts, 1):
+            part.sequence = sequence
+            part.file_id = user_file.id
+            if part.parity_group is not None:
+                part.parity_group += group_offsets[part.upload_part]
+            part.upload_session_id = None
+            part.upload_part = None
+        db.session.flush()
+        UploadSession.query.filter_by(id=upload.id).delete()
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return user_file.id
+
+
+def _delete_session(session_id: str) -> None:
+    """
+    Delete upload session with its parts, and free their chunks
+    Args:
+        session_id: id of upload session
+
+    Returns: None
+
+    """
+    query = FilePart.query.filter_by(upload_session_id=session_id)
+    keys = [key for key, in query.with_entities(FilePart.memcached_key)]
+    query.delete(synchronize_session=False)
+    UploadSession.query.filter_by(id=session_id).delete()
+    db.session.commit()
+    if keys:
+        release_keys(keys)
+
+
+@api.cli.command('scrub')
+@click.option('--interval', type=float, default=0, help="Seconds between passes, 0 runs a single pass.")
+def scrub_command(interval: float) -> None:
+    """Remove files whose chunks are evicted and stored chunks no file refers to."""
+    scrubber = Scrubber(current_app._get_current_object())
+    while True:
+        click.echo(json.dumps(scrubber.run()))
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+# App served by `flask run`, by a prefork server with `gunicorn -c gunicorn.conf.py app:app` and used by tests
+app = create_app()
+
+
+if __name__ == '__main__':
+    # Development server, schema is created with `flask db upgrade`
+    if config.scrub_interval:
+        Scrubber(app).start(config.scrub_interval)
+
+    app.run(debug=False, threaded=True, host='0.0.0.0', port=config.port)
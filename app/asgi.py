@@ -0,0 +1,363 @@
+"""
+Asyncio serving of the app, as an ASGI application.
+
+Downloads of whole files are served on the event loop: chunks are read from memcached over asyncio
+streams with fetches of next windows overlapping verification and sending of chunks, hashing and
+decompression of chunks run in a thread pool and database queries in another one. So a process
+holds thousands of concurrent downloads, bounded by memory rather than by threads. Chunks which are
+evicted or corrupted are read and rebuilt by File model in a thread, like the flask app does.
+Every other request, including range requests, is served by the flask app in a thread.
+
+Usage:
+    $ cd app/
+    $ FLASK_APP=app.py flask db upgrade
+    $ uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException, InternalServerError, NotFound
+
+import config
+import metrics
+from app import app as flask_app
+from async_file_store import iter_fetch_windows, memcached_client
+from cache import file_cache
+from exception.memcache import MemcacheKeyNotFound
+from models import File
+
+logger = logging.getLogger(config.logger_name)
+
+FILE_PATH = re.compile(r'^/api/files/(?P<file_id>[^/]+)$')
+# request bodies larger than this are spooled to disk before flask app reads them
+SPOOL_MAX_BYTES = 1024 * 1024
+
+# Process wide pools of threads running blocking work off the event loop. Built lazily by _blocking() and _hashing().
+_blocking_executor = None
+_hashing_executor = None
+_executor_lock = Lock()
+
+
+def _blocking() -> ThreadPoolExecutor:
+    """
+    Get executor of database queries and requests served by flask app
+    Returns: executor
+
+    """
+    global _blocking_executor
+    if _blocking_executor is None:
+        with _executor_lock:
+            if _blocking_executor is None:
+                _blocking_executor = ThreadPoolExecutor(max_workers=config.async_threads,
+                                                        thread_name_prefix='asgi-blocking')
+    return _blocking_executor
+
+
+def _hashing() -> ThreadPoolExecutor:
+    """
+    Get executor of decompression and checksum verification of chunks
+    Returns: executor
+
+    """
+    global _hashing_executor
+    if _hashing_executor is None:
+        with _executor_lock:
+            if _hashing_executor is None:
+                _hashing_executor = ThreadPoolExecutor(max_workers=config.async_hash_workers,
+                                                       thread_name_prefix='asgi-hashing')
+    return _hashing_executor
+
+
+async def _run(executor: ThreadPoolExecutor, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+class AsgiApp(object):
+    """ASGI application serving downloads of whole files on the event loop, and other requests with a WSGI app.
+
+    Args:
+        wsgi_app: WSGI app serving other requests
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+        match = FILE_PATH.match(scope['path'])
+        headers = dict(scope['headers'])
+        if scope['method'] == 'GET' and match and b'range' not in headers \
+                and not (config.profiling_enabled and config.profile_header.lower().encode() in headers):
+            await self.get_file(match.group('file_id'), receive, send)
+        else:
+            await self.call_wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                memcached_client().close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_file(self, file_id: str, receive, send) -> None:
+        """
+        Serve data of file, as GET /api/files/<file_id> of flask app does
+        Args:
+            file_id: unique id of file
+            receive: ASGI receive callable
+            send: ASGI send callable
+
+        Returns: None
+
+        """
+        start = time.perf_counter()
+        logger.info(f"Fetching data for file id {file_id}")
+        disconnected = asyncio.ensure_future(_disconnect(receive))
+        chunks = None
+        try:
+            cached_chunks = file_cache.get(file_id)
+            if cached_chunks is not None:
+                logger.debug(f"Serving file id {file_id} from file cache")
+                chunks, size = _aiter(cached_chunks), sum(len(chunk) for chunk in cached_chunks)
+            else:
+                file = await _run(_blocking(), _load_file, file_id)
+                if file is None:
+                    raise NotFound(f'Sorry, could\'t find any file with the id {file_id}')
+                chunks, size = _caching_chunks(file_id, _iter_chunks(file)), file.size
+            # read first chunk before response starts, so that evicted or corrupted data still gets error status
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            first_chunk = b''
+        except Exception as ex:
+            disconnected.cancel()
+            if chunks is not None:
+                await chunks.aclose()
+            await _send_error(send, _http_error(file_id, ex))
+            return
+        try:
+            headers = [(b'content-type', b'text/html; charset=utf-8')]
+            if size is not None:
+                headers.append((b'content-length', str(size).encode()))
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            chunk = first_chunk
+            while chunk is not None and not disconnected.done():
+                metrics.bytes_sent.inc(len(chunk))
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            await chunks.aclose()
+            metrics.request_seconds.observe('api.get_files', time.perf_counter() - start)
+
+    async def call_wsgi(self, scope: dict, receive, send) -> None:
+        """
+        Serve request with WSGI app in a thread, request body is read before app is called
+        Args:
+            scope: ASGI scope of request
+            receive: ASGI receive callable
+            send: ASGI send callable
+
+        Returns: None
+
+        """
+        body = SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message: dict) -> None:
+            # waits until message is sent, so a slow client holds back the app
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+
+        def start_response(status: str, headers: list, exc_info=None):
+            # headers are sent with first block of body, so an error until then can still replace them
+            response_start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                                  headers=[(name.lower().encode('latin1'), value.encode('latin1'))
+                                           for name, value in headers])
+
+        def serve() -> None:
+            # response is iterated in thread which called app, as flask keeps context of streamed responses per thread
+            iterable = self.wsgi_app(_environ(scope, body), start_response)
+            try:
+                started = False
+                for block in iterable:
+                    if block:
+                        if not started:
+                            send_from_thread(response_start)
+                            started = True
+                        send_from_thread({'type': 'http.response.body', 'body': block, 'more_body': True})
+                if not started:
+                    send_from_thread(response_start)
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        try:
+            await _run(_blocking(), serve)
+        finally:
+            body.close()
+
+
+def _load_file(file_id: str):
+    """
+    Load file record with its parts, in a thread
+    Args:
+        file_id: unique id of file
+
+    Returns: detached file record, None if there is no such file
+
+    """
+    with flask_app.app_context():
+        return File.query.options(joinedload(File.parts)).get(file_id)
+
+
+async def _iter_chunks(file: File):
+    """
+    Async generator over verified chunks of file.
+    Args:
+        file: file record with its parts
+
+    Returns:
+        bytes: content of each chunk
+    """
+    parts = file.data_parts
+    index = 0
+    async for payloads in iter_fetch_windows([part.memcached_key for part in parts]):
+        window = parts[index:index + len(payloads)]
+        index += len(payloads)
+        for part, chunk in zip(window, await _run(_hashing(), _verify_window, window, payloads)):
+            if chunk is None:
+                chunk = await _run(_blocking(), _read_chunk, file.id, part.sequence)
+            yield chunk
+
+
+def _verify_window(parts: list, payloads: list) -> list:
+    # chunks which fail are counted in metrics once they are read again by File model
+    return [File._verified(part, payload, record=False) for part, payload in zip(parts, payloads)]
+
+
+def _read_chunk(file_id: int, sequence: int) -> bytes:
+    """
+    Read chunk of part with File model, in a thread. Chunk is read through disk tier, rebuilt from
+    its parity group, or whole file is removed as for any read of the flask app.
+    Args:
+        file_id: unique id of file
+        sequence: sequence of part
+
+    Returns: data of chunk
+
+    """
+    with flask_app.app_context():
+        file = File.query.get(file_id)
+        parts = [part for part in file.data_parts if part.sequence == sequence] if file is not None else []
+        if not parts:
+            raise MemcacheKeyNotFound(description=f"File id {file_id} has been removed")
+        return next(file._iter_verified(parts))
+
+
+async def _caching_chunks(file_id: str, chunks):
+    """Async generator passing verified chunks through and caching them once all of them are read."""
+    collected = [] if file_cache.enabled else None
+    size = 0
+    async for chunk in chunks:
+        if collected is not None:
+            size += len(chunk)
+            collected = collected if size <= file_cache.max_entry_bytes else None
+            if collected is not None:
+                collected.append(chunk)
+        yield chunk
+    if collected is not None:
+        file_cache.put(file_id, tuple(collected), size)
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+async def _disconnect(receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _http_error(file_id: str, ex: Exception) -> HTTPException:
+    if isinstance(ex, HTTPException):
+        return ex
+    if isinstance(ex, MemcacheKeyNotFound):
+        return NotFound("Data has been evicted or is corrupted.")
+    logger.error(f"Got exception in retrieving data for id {file_id}: {ex}")
+    return InternalServerError(f"Error in retrieving data for id {file_id}")
+
+
+async def _send_error(send, error: HTTPException) -> None:
+    response = error.get_response()
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                            for name, value in response.headers.items()]})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+def _environ(scope: dict, body) -> dict:
+    """
+    Build WSGI environ of ASGI request
+    Args:
+        scope: ASGI scope of request
+        body: file with request body
+
+    Returns: WSGI environ
+
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+app = AsgiApp(flask_app)
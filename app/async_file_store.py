@@ -0,0 +1,176 @@
+"""Reads of chunks from memcached over asyncio streams, for the asyncio server of asgi.py."""
+
+import asyncio
+import logging
+from collections import deque
+from weakref import WeakKeyDictionary
+
+from pymemcache.exceptions import MemcacheUnexpectedCloseError, MemcacheUnknownError
+
+import config
+from cluster import ClusterClient
+from file_store import _server, _windows
+
+logger = logging.getLogger(config.logger_name)
+
+# Client of each event loop, asyncio streams and locks can't be shared across loops. Built lazily by memcached_client().
+_clients = WeakKeyDictionary()
+
+
+class _ConnectionPool(object):
+    """Pool of asyncio stream connections to a memcached node.
+
+    Args:
+        server: (host, port) of node
+        max_size: max number of connections, callers wait for a free one beyond it
+        connect_timeout: seconds to wait for a connection
+        timeout: seconds to wait for a reply
+    """
+
+    def __init__(self, server: tuple, max_size: int, connect_timeout: float, timeout: float):
+        self.server = server
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_size)
+
+    async def get_many(self, keys: list) -> dict:
+        """
+        Get many keys in a single round trip
+        Args:
+            keys: memcached keys
+
+        Returns: dict of found keys and values
+
+        """
+        async with self._slots:
+            if self._idle:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.server), self.connect_timeout)
+            try:
+                writer.write(b'get ' + ' '.join(keys).encode() + b'\r\n')
+                found = await asyncio.wait_for(self._read_values(reader), self.timeout)
+            except BaseException:
+                # reply may be partly read, or request cancelled midway, so connection can't be reused
+                writer.close()
+                raise
+            self._idle.append((reader, writer))
+            return found
+
+    @staticmethod
+    async def _read_values(reader: asyncio.StreamReader) -> dict:
+        found = {}
+        while True:
+            line = await reader.readline()
+            if line == b'END\r\n':
+                return found
+            if not line:
+                raise MemcacheUnexpectedCloseError()
+            if not line.startswith(b'VALUE '):
+                raise MemcacheUnknownError(line.rstrip().decode(errors='replace'))
+            _, key, _, length = line.split()[:4]
+            found[key.decode()] = (await reader.readexactly(int(length) + 2))[:-2]
+
+    def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+
+class AsyncMemcachedClient(object):
+    """Client of memcached over asyncio streams, with a pool of connections per node.
+
+    Keys are placed on nodes the way ClusterClient places them, so chunks written by file_store are
+    read from nodes holding them. Keys missing on a node, or on a failing node, are looked up on next
+    replica. Keys not found on any node are left to the caller, which reads them through file_store.
+
+    Args:
+        servers: list of (host, port) of nodes
+        replicas: number of nodes each key is written to
+        pool_size: max number of connections per node
+    """
+
+    def __init__(self, servers: list, replicas: int = 1, pool_size: int = 32):
+        self._cluster = ClusterClient(servers, lambda server: _ConnectionPool(server, pool_size,
+                                                                              config.memcached_connect_timeout,
+                                                                              config.memcached_timeout),
+                                      replicas=replicas)
+
+    async def get_many(self, keys: list) -> dict:
+        """
+        Get many keys, with one multi-get per node for each replica level, sent to nodes concurrently
+        Args:
+            keys: memcached keys
+
+        Returns: dict of found keys and values
+
+        """
+        found = {}
+        pending = {key: self._cluster.replica_nodes(key) for key in keys}
+        while pending:
+            by_node = {}
+            for key, nodes in pending.items():
+                if nodes:
+                    by_node.setdefault(nodes.pop(0), []).append(key)
+            if not by_node:
+                break
+            results = await asyncio.gather(*(node.client.get_many(node_keys) for node, node_keys in by_node.items()),
+                                           return_exceptions=True)
+            for node, result in zip(by_node, results):
+                if isinstance(result, asyncio.CancelledError):
+                    raise result
+                if isinstance(result, BaseException):
+                    logger.error(f"Got error in fetching keys from memcached node {node.name}: {result!r}")
+                    continue
+                found.update(result)
+            pending = {key: nodes for key, nodes in pending.items() if key not in found and nodes}
+        return found
+
+    def close(self) -> None:
+        for node in self._cluster.nodes:
+            node.client.close()
+
+
+def memcached_client() -> AsyncMemcachedClient:
+    """
+    Get asyncio memcached client of running event loop.
+    Returns: memcached client
+
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncMemcachedClient([_server(node) for node in config.memcached_nodes],
+                                                       replicas=config.memcached_replicas,
+                                                       pool_size=config.memcached_pool_size)
+    return client
+
+
+async def iter_fetch_windows(keys: list, window: int = None, ahead: int = None):
+    """
+    Async generator over windows of stored data of keys, in order of keys. Next windows are fetched
+    while a window is consumed, so round trips overlap with verifying and sending chunks.
+    Args:
+        keys: memcached keys
+        window: number of keys fetched per round trip, defaults to configured fetch window
+        ahead: number of windows fetched ahead, defaults to configured prefetch window
+
+    Returns:
+        list: data of each key of window, None for keys which are not found
+    """
+    windows = deque(_windows(keys, window or config.memcached_fetch_window))
+    ahead = max(ahead if ahead is not None else config.memcached_prefetch_window, 0)
+    client = memcached_client()
+    pending = deque()
+    try:
+        while windows or pending:
+            while windows and len(pending) <= ahead:
+                keys_window = windows.popleft()
+                pending.append((keys_window, asyncio.ensure_future(client.get_many(keys_window))))
+            keys_window, fetch = pending.popleft()
+            found = await fetch
+            yield [found.get(key) or None for key in keys_window]
+    finally:
+        for _, fetch in pending:
+            fetch.cancel()
@@ -0,0 +1,102 @@
+"""
+Benchmark concurrent downloads served by the asyncio app of asgi.py in a single process.
+
+Files are uploaded through the flask app to a temporary SQLite database and a memcached stand-in
+run in its own process with injected latency. Then each number of concurrent downloads is driven
+straight through the ASGI app, without an HTTP server, so the numbers show what the event loop holds.
+Downloads/s, MB/s, p50/p99 latency, threads of process and peak RSS are printed as JSON lines.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/async_downloads.py --concurrency 100,1000,5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+MEMCACHED_PORT = 11312
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+async def download(asgi_app, file_id: str) -> tuple:
+    """Send GET of file through ASGI app, returns latency and size of body."""
+    received = []
+    size = 0
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {'type': 'http.request', 'body': b''}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal size
+        size += len(message.get('body', b''))
+
+    scope = {'type': 'http', 'method': 'GET', 'path': f'/api/files/{file_id}', 'query_string': b'',
+             'root_path': '', 'headers': [], 'server': ('localhost', 80), 'client': ('127.0.0.1', 0)}
+    start = time.perf_counter()
+    await asgi_app(scope, receive, send)
+    return time.perf_counter() - start, size
+
+
+async def burst(asgi_app, file_ids: list, concurrency: int) -> dict:
+    start = time.perf_counter()
+    results = await asyncio.gather(*(download(asgi_app, file_ids[index % len(file_ids)])
+                                     for index in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    return {'concurrency': concurrency,
+            'downloads_s': round(concurrency / elapsed, 1),
+            'mb_s': round(sum(size for _, size in results) / elapsed / 1e6, 2),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            'threads': threading.active_count(),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='100,1000,5000', help="comma separated concurrent downloads")
+    parser.add_argument('--files', type=int, default=20, help="number of distinct files downloaded")
+    parser.add_argument('--file-size', type=int, default=1000 * 1000, help="file size in bytes")
+    parser.add_argument('--latency', type=float, default=0.001, help="memcached latency per command in seconds")
+    args = parser.parse_args()
+
+    memcached = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'fake_memcached.py'),
+                                  '--port', str(MEMCACHED_PORT), '--latency', str(args.latency)],
+                                 stdout=subprocess.DEVNULL)
+    os.environ.update({'MEMCACHED_NODES': f'127.0.0.1:{MEMCACHED_PORT}',
+                       'DB_STR': f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}?timeout=30"})
+    import logging
+    import config
+    from asgi import app as asgi_app, flask_app
+    from database import db
+    logging.getLogger(config.logger_name).setLevel(logging.WARNING)
+    try:
+        time.sleep(1)
+        with flask_app.app_context():
+            db.create_all()
+        client = flask_app.test_client()
+        file_ids = [client.post('/api/files', data={'file': (BytesIO(os.urandom(args.file_size)), 'file')}).data.decode()
+                    for _ in range(args.files)]
+        for concurrency in [int(concurrency) for concurrency in args.concurrency.split(',')]:
+            print(json.dumps(dict(asyncio.run(burst(asgi_app, file_ids, concurrency)), file_size=args.file_size)),
+                  flush=True)
+    finally:
+        memcached.terminate()
@@ -0,0 +1,71 @@
+"""
+Benchmark chunk compression ratio against throughput.
+
+Synthetic log, JSON, CSV and random data is split in chunks of each size and compressed
+with each codec and level, as File.save does before storing chunks in memcached.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/chunk_compression.py --data-size 20000000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from compression import compress, decompress
+
+CODECS = [('zlib', 1), ('zlib', 6), ('zlib', 9), ('lzma', 0), ('lzma', 6)]
+CHUNK_SIZES = [64 * 1000, 250 * 1000, 500 * 1000, 1000 * 1000]
+
+
+def sample_data(kind: str, size: int) -> bytes:
+    generator = random.Random(42)
+    lines = []
+    length = 0
+    while length < size:
+        if kind == 'log':
+            line = (f'2026-10-17 12:{generator.randint(0, 59):02d}:{generator.randint(0, 59):02d} '
+                    f'{generator.choice(["INFO", "DEBUG", "ERROR"])} request {generator.randint(0, 10 ** 6)} '
+                    f'served in {generator.randint(1, 500)} ms\n')
+        elif kind == 'json':
+            line = json.dumps({'id': generator.randint(0, 10 ** 6), 'name': f'item-{generator.randint(0, 1000)}',
+                               'price': round(generator.random() * 100, 2), 'tags': ['a', 'b']}) + '\n'
+        else:
+            line = ','.join(str(generator.randint(0, 10 ** 4)) for _ in range(8)) + '\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def run(kind: str, data: bytes, chunk_size: int, codec: str, level: int) -> None:
+    chunks = [data[index:index + chunk_size] for index in range(0, len(data), chunk_size)]
+    start = time.perf_counter()
+    payloads = [compress(chunk, codec, level) for chunk in chunks]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload, used_codec in payloads:
+        decompress(payload, used_codec)
+    decompress_time = time.perf_counter() - start
+    stored = sum(len(payload) for payload, _ in payloads)
+    print(json.dumps({'data': kind, 'chunk_size': chunk_size, 'codec': codec, 'level': level,
+                      'ratio': round(len(data) / stored, 2),
+                      'compress_mb_s': round(len(data) / compress_time / 1e6, 1),
+                      'decompress_mb_s': round(len(data) / decompress_time / 1e6, 1)}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-size', type=int, default=20 * 1000 * 1000, help="bytes of data of each kind")
+    args = parser.parse_args()
+
+    for kind in ('log', 'json', 'csv', 'random'):
+        data = os.urandom(args.data_size) if kind == 'random' else sample_data(kind, args.data_size)
+        for chunk_size in CHUNK_SIZES:
+            for codec, level in CODECS:
+                run(kind, data, chunk_size, codec, level)
@@ -0,0 +1,69 @@
+"""
+Benchmark connection churn of memcached clients under concurrent uploads.
+
+Compares a new client per call (old behaviour) against the pooled process wide client.
+Connection count is read from memcached ``total_connections`` stat, so a running memcached
+at MEMCACHED_HOST:MEMCACHED_PORT is needed.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/connection_pool.py --uploads 8 --chunks 100
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pymemcache.client.base import Client
+
+import config
+from file_store import memcached_client
+
+
+def _per_call_client():
+    return Client((config.memcached_host, config.memcached_port))
+
+
+def _upload(client_factory, chunks: int, chunk: bytes) -> None:
+    keys = []
+    for _ in range(chunks):
+        key = str(uuid4())
+        client_factory().set(key, chunk)
+        keys.append(key)
+    client_factory().delete_many(keys)
+
+
+def _total_connections() -> int:
+    return int(_per_call_client().stats()[b'total_connections'])
+
+
+def run(name: str, client_factory, uploads: int, chunks: int, chunk_size: int) -> None:
+    chunk = os.urandom(chunk_size)
+    before = _total_connections()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=uploads) as executor:
+        for future in [executor.submit(_upload, client_factory, chunks, chunk) for _ in range(uploads)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    # one connection is opened by the stats call itself
+    opened = _total_connections() - before - 1
+    print(f"{name:<10} uploads={uploads} chunks/upload={chunks} connections_opened={opened} "
+          f"elapsed={elapsed:.3f}s MB/s={uploads * chunks * chunk_size / elapsed / 1e6:.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=8, help="concurrent uploads")
+    parser.add_argument('--chunks', type=int, default=100, help="chunks per upload")
+    parser.add_argument('--chunk-size', type=int, default=config.chunk_size, help="chunk size in bytes")
+    args = parser.parse_args()
+
+    run("per-call", _per_call_client, args.uploads, args.chunks, args.chunk_size)
+    # warm up the pool first so that only steady state churn is measured
+    run("pooled", memcached_client, args.uploads, 1, args.chunk_size)
+    run("pooled", memcached_client, args.uploads, args.chunks, args.chunk_size)
@@ -0,0 +1,76 @@
+"""
+Benchmark erasure coding throughput and survival of files under random chunk eviction.
+
+Parity chunks of each group of data chunks are computed and lost data chunks rebuilt from
+them, as File.save and File._recover do. Survival is the share of files still readable when
+each chunk is evicted independently with a probability, without erasure coding and with each
+data and parity chunk count.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/erasure_coding.py --chunk-size 500000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from erasure import encode, decode
+
+SCHEMES = [(4, 1), (4, 2), (8, 2), (8, 3), (10, 4)]
+EVICTION_RATES = [0.001, 0.01, 0.05]
+
+
+def throughput(data_count: int, parity_count: int, chunk_size: int, rounds: int) -> None:
+    chunks = [os.urandom(chunk_size) for _ in range(data_count)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parity = encode(chunks, parity_count)
+    encode_time = time.perf_counter() - start
+    # worst case, as many data chunks lost as there are parity chunks
+    lost = chunks[:]
+    lost[:parity_count] = [None] * parity_count
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decode(lost, parity, [chunk_size] * data_count)
+    decode_time = time.perf_counter() - start
+    data_size = data_count * chunk_size * rounds
+    print(json.dumps({'data_chunks': data_count, 'parity_chunks': parity_count, 'chunk_size': chunk_size,
+                      'overhead': round(parity_count / data_count, 2),
+                      'encode_mb_s': round(data_size / encode_time / 1e6, 1),
+                      'decode_mb_s': round(parity_count * chunk_size * rounds / decode_time / 1e6, 1)}))
+
+
+def survival(data_count: int, parity_count: int, file_chunks: int, rate: float, files: int) -> None:
+    generator = random.Random(42)
+    survived = 0
+    for _ in range(files):
+        readable = True
+        for group_start in range(0, file_chunks, data_count or file_chunks):
+            group_size = min(data_count or file_chunks, file_chunks - group_start) + parity_count
+            if sum(generator.random() < rate for _ in range(group_size)) > parity_count:
+                readable = False
+                break
+        survived += readable
+    print(json.dumps({'data_chunks': data_count, 'parity_chunks': parity_count, 'file_chunks': file_chunks,
+                      'eviction_rate': rate, 'survival': round(survived / files, 4)}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunk-size', type=int, default=500 * 1000, help="bytes of each chunk")
+    parser.add_argument('--rounds', type=int, default=5, help="encodes and decodes of each group")
+    parser.add_argument('--file-chunks', type=int, default=40, help="chunks of each file in survival simulation")
+    parser.add_argument('--files', type=int, default=10000, help="files in survival simulation")
+    args = parser.parse_args()
+
+    for data_count, parity_count in SCHEMES:
+        throughput(data_count, parity_count, args.chunk_size, args.rounds)
+    for rate in EVICTION_RATES:
+        for data_count, parity_count in [(0, 0)] + SCHEMES:
+            survival(data_count, parity_count, args.file_chunks, rate, args.files)
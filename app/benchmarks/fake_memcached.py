@@ -0,0 +1,153 @@
+"""
+In-process stand-in for memcached speaking its text protocol, for benchmarks and load tests.
+
+Commands used by pymemcache clients of file_store are supported: set, add, get, gets, touch,
+delete, version, stats (also stats settings and stats slabs) and flush_all. Every command waits
+for an injected latency before its reply, so benchmarks can model a memcached reached over a network.
+It is run in a process of its own with
+
+    $ python benchmarks/fake_memcached.py --port 11311 --latency 0.0002
+"""
+
+import argparse
+import socketserver
+import time
+from collections import Counter
+from threading import Lock, Thread
+
+
+class FakeMemcachedServer(socketserver.ThreadingTCPServer):
+    """Memcached stand-in listening on localhost, each connection is served by a thread.
+
+    Args:
+        latency: seconds waited before replying to each command
+        port: port to listen on, 0 picks a free one
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.0, port: int = 0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.data = {}
+        self.commands = Counter()
+        self.lock = Lock()
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        host, port = self.server_address
+        return f'{host}:{port}'
+
+    def start(self) -> 'FakeMemcachedServer':
+        self._thread = Thread(target=self.serve_forever, name='fake-memcached', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            words = line.split()
+            if not words:
+                continue
+            command = words[0].decode()
+            with self.server.lock:
+                self.server.commands[command] += 1
+            handler = getattr(self, f'_{command}', None)
+            if handler is None:
+                self._reply(b'ERROR\r\n')
+                continue
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            handler(words[1:])
+
+    def _reply(self, reply: bytes, noreply: bool = False) -> None:
+        if not noreply:
+            self.wfile.write(reply)
+            self.wfile.flush()
+
+    def _set(self, args: list, only_new: bool = False) -> None:
+        key, flags, _, length = args[:4]
+        value = self.rfile.read(int(length) + 2)[:-2]
+        with self.server.lock:
+            stored = not only_new or key not in self.server.data
+            if stored:
+                self.server.data[key] = (flags, value)
+        self._reply(b'STORED\r\n' if stored else b'NOT_STORED\r\n', noreply=args[-1] == b'noreply')
+
+    def _add(self, args: list) -> None:
+        self._set(args, only_new=True)
+
+    def _get(self, keys: list, with_cas: bool = False) -> None:
+        with self.server.lock:
+            found = [(key, self.server.data[key]) for key in keys if key in self.server.data]
+        reply = []
+        for key, (flags, value) in found:
+            reply.append(b'VALUE %s %s %d%s\r\n' % (key, flags, len(value), b' 0' if with_cas else b''))
+            reply.append(value)
+            reply.append(b'\r\n')
+        reply.append(b'END\r\n')
+        self._reply(b''.join(reply))
+
+    def _gets(self, keys: list) -> None:
+        self._get(keys, with_cas=True)
+
+    def _touch(self, args: list) -> None:
+        with self.server.lock:
+            found = args[0] in self.server.data
+        self._reply(b'TOUCHED\r\n' if found else b'NOT_FOUND\r\n', noreply=args[-1] == b'noreply')
+
+    def _delete(self, args: list) -> None:
+        with self.server.lock:
+            found = self.server.data.pop(args[0], None) is not None
+        self._reply(b'DELETED\r\n' if found else b'NOT_FOUND\r\n', noreply=args[-1] == b'noreply')
+
+    def _version(self, args: list) -> None:
+        self._reply(b'VERSION 1.6.0-fake\r\n')
+
+    def _stats(self, args: list) -> None:
+        if args == [b'settings']:
+            # slab settings of memcached 1.6 defaults, so chunks can be fitted to its slab classes
+            stats = {'item_size_max': 1024 * 1024, 'slab_chunk_max': 512 * 1024, 'chunk_size': 48,
+                     'growth_factor': 1.25}
+        elif args == [b'slabs']:
+            # no class is listed as holding items, every class follows from settings
+            stats = {'active_slabs': 0, 'total_malloced': 0}
+        else:
+            stats = self._counters()
+        self._reply(b''.join(b'STAT %s %s\r\n' % (name.encode(), str(value).encode()) for name, value in stats.items())
+                    + b'END\r\n')
+
+    def _counters(self) -> dict:
+        with self.server.lock:
+            stats = {'curr_items': len(self.server.data),
+                     'bytes': sum(len(value) for _, value in self.server.data.values()),
+                     'cmd_get': self.server.commands['get'] + self.server.commands['gets'],
+                     'cmd_set': self.server.commands['set'] + self.server.commands['add']}
+        return stats
+
+    def _flush_all(self, args: list) -> None:
+        with self.server.lock:
+            self.server.data.clear()
+        self._reply(b'OK\r\n', noreply=bool(args) and args[-1] == b'noreply')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=11211, help="port to listen on")
+    parser.add_argument('--latency', type=float, default=0.0, help="latency per command in seconds")
+    args = parser.parse_args()
+
+    server = FakeMemcachedServer(args.latency, args.port)
+    print(f"Listening on {server.address}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,135 @@
+"""
+Load test of threaded single process serving against prefork serving with gunicorn.
+
+The app is started as `python app.py` (threaded Werkzeug server) and as `gunicorn -c gunicorn.conf.py app:app`
+with each worker count, against a SQLite database whose schema is created by `flask db upgrade`,
+and a memcached stand-in run in its own process. Client processes upload unique files, so every
+upload is hashed, then download them. Requests/s, MB/s and p50/p99 latency of each mode are printed
+as JSON lines. Hashing and verifying chunks is CPU bound, so prefork serving scales with cores
+while a single process is bound by the GIL.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/serving.py --workers 2,4,8 --clients 16
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from uuid import uuid4
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MEMCACHED_PORT = 11311
+APP_PORT = 5311
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+def multipart(data: bytes) -> tuple:
+    boundary = uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="file"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def client(requests: int, file_size: int) -> dict:
+    """Upload then download files over a keep-alive connection, returns latency of each request."""
+    connection = http.client.HTTPConnection('127.0.0.1', APP_PORT, timeout=300)
+    uploads, downloads, file_ids = [], [], []
+    for _ in range(requests):
+        body, content_type = multipart(os.urandom(file_size))
+        start = time.perf_counter()
+        connection.request('POST', '/api/files', body=body, headers={'Content-Type': content_type})
+        response = response_of(connection)
+        uploads.append(time.perf_counter() - start)
+        file_ids.append(response.decode())
+    for file_id in file_ids:
+        start = time.perf_counter()
+        connection.request('GET', f'/api/files/{file_id}')
+        assert len(response_of(connection)) == file_size
+        downloads.append(time.perf_counter() - start)
+    connection.close()
+    return {'upload': uploads, 'download': downloads}
+
+
+def response_of(connection: http.client.HTTPConnection) -> bytes:
+    response = connection.getresponse()
+    data = response.read()
+    assert response.status == 200, (response.status, data[:200])
+    return data
+
+
+def wait_until_up(process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', APP_PORT, timeout=1)
+            connection.request('GET', '/api/liveness')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("Server did not start in time")
+
+
+def run(mode: str, command: list, env: dict, args) -> None:
+    server = subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(server)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.clients) as executor:
+            results = list(executor.map(client, [args.requests] * args.clients, [args.file_size] * args.clients))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    requests = args.clients * args.requests
+    report = {'mode': mode, 'clients': args.clients, 'file_size': args.file_size,
+              'requests_s': round(2 * requests / elapsed, 1),
+              'mb_s': round(2 * requests * args.file_size / elapsed / 1e6, 2)}
+    for direction in ('upload', 'download'):
+        latencies = [latency for result in results for latency in result[direction]]
+        report[f'{direction}_p50_ms'] = round(percentile(latencies, 0.5) * 1000, 1)
+        report[f'{direction}_p99_ms'] = round(percentile(latencies, 0.99) * 1000, 1)
+    print(json.dumps(report), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default=str(os.cpu_count()), help="comma separated gunicorn worker counts")
+    parser.add_argument('--threads', type=int, default=4, help="threads of each gunicorn worker")
+    parser.add_argument('--clients', type=int, default=16, help="concurrent client processes")
+    parser.add_argument('--requests', type=int, default=8, help="uploads, then downloads, of each client")
+    parser.add_argument('--file-size', type=int, default=5 * 1000 * 1000, help="file size in bytes")
+    parser.add_argument('--latency', type=float, default=0.0002, help="memcached latency per command in seconds")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, FLASK_APP='app.py', PORT=str(APP_PORT),
+               MEMCACHED_NODES=f'127.0.0.1:{MEMCACHED_PORT}', MEMCACHED_POOL_SIZE='64',
+               DB_STR=f"sqlite:///{os.path.join(directory, 'bench.db')}?timeout=30")
+    memcached = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'fake_memcached.py'),
+                                  '--port', str(MEMCACHED_PORT), '--latency', str(args.latency)],
+                                 stdout=subprocess.DEVNULL)
+    try:
+        # schema is created once by its own command, servers no longer create it on start
+        subprocess.run(['flask', 'db', 'upgrade'], cwd=APP_DIR, env=env, check=True, capture_output=True)
+        run('threaded', [sys.executable, 'app.py'], env, args)
+        for workers in [int(workers) for workers in args.workers.split(',')]:
+            run(f'prefork-{workers}x{args.threads}', ['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                dict(env, WORKERS=str(workers), WORKER_THREADS=str(args.threads)), args)
+    finally:
+        memcached.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
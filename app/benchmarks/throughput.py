@@ -0,0 +1,204 @@
+"""
+Benchmark upload and download throughput of the app, for comparison across commits.
+
+Each point of a sweep over file size, chunk size, concurrency and dedup ratio runs in a fresh process,
+with the real app on a temporary SQLite database and an in-process memcached stand-in speaking the
+text protocol with injected latency, so files go through the real pymemcache client. Uploads send
+files of which the dedup ratio share repeats data already sent, then every file is downloaded.
+MB/s, p50/p99 latency of requests and peak RSS of each point are written as JSON.
+Pass the output of a previous run as --baseline to print the change of each point.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/throughput.py --output before.json
+    $ python benchmarks/throughput.py --file-sizes 1000000 --chunk-sizes 64000,500000 --concurrency 1,16 \\
+        --dedup-ratios 0,0.5 --latency 0.0002 --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import product
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# a change of MB/s or p99 latency larger than this share is flagged when comparing with a baseline
+CHANGE_THRESHOLD = 0.1
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+def workload(files: int, file_size: int, dedup_ratio: float) -> list:
+    """Data of each upload, a dedup ratio share of uploads repeats data of an earlier upload."""
+    generator = random.Random(42)
+    unique = [generator.getrandbits(file_size * 8).to_bytes(file_size, 'little')
+              for _ in range(max(round(files * (1 - dedup_ratio)), 1))]
+    uploads = unique + [generator.choice(unique) for _ in range(files - len(unique))]
+    generator.shuffle(uploads)
+    return uploads
+
+
+def timed_requests(concurrency: int, requests: list) -> tuple:
+    """
+    Send requests from concurrent threads
+    Args:
+        concurrency: number of threads
+        requests: callables sending a request, each returns bytes transferred
+
+    Returns: (seconds taken, list of latency of each request, total bytes)
+
+    """
+    def send(request):
+        start = time.perf_counter()
+        size = request()
+        return time.perf_counter() - start, size
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, requests))
+    return time.perf_counter() - start, [latency for latency, _ in results], sum(size for _, size in results)
+
+
+def summary(elapsed: float, latencies: list, size: int) -> dict:
+    return {'mb_s': round(size / elapsed / 1e6, 2),
+            'requests_s': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+
+
+def run_point(point: dict, files: int, latency: float) -> dict:
+    """Run a single point of sweep, in a process of its own so that config and peak RSS are its own."""
+    from fake_memcached import FakeMemcachedServer
+
+    memcached = FakeMemcachedServer(latency).start()
+    directory = tempfile.mkdtemp()
+    os.environ.update({'CHUNK_SIZE_BYTES': str(point['chunk_size']),
+                       'MEMCACHED_NODES': memcached.address,
+                       'MAX_FILE_SIZE_MB': str(max(point['file_size'] // 10 ** 6 + 1, 50)),
+                       'DB_STR': f"sqlite:///{os.path.join(directory, 'bench.db')}?timeout=30"})
+    import logging
+    import config
+    from app import app
+    from database import db
+    logging.getLogger(config.logger_name).setLevel(logging.WARNING)
+    with app.app_context():
+        db.create_all()
+
+    uploads = workload(files, point['file_size'], point['dedup_ratio'])
+    file_ids = [None] * len(uploads)
+
+    def upload(index: int):
+        def request():
+            response = app.test_client().post('/api/files', data={'file': (BytesIO(uploads[index]), 'file')})
+            assert response.status_code == 200, response.status_code
+            file_ids[index] = response.data.decode()
+            return len(uploads[index])
+        return request
+
+    def download(index: int):
+        def request():
+            response = app.test_client().get(f'/api/files/{file_ids[index]}')
+            data = response.data
+            response.close()
+            assert response.status_code == 200 and data == uploads[index], response.status_code
+            return len(data)
+        return request
+
+    upload_stats = summary(*timed_requests(point['concurrency'], [upload(index) for index in range(len(uploads))]))
+    download_stats = summary(*timed_requests(point['concurrency'], [download(index) for index in range(len(uploads))]))
+    memcached.stop()
+    return dict(point, upload=upload_stats, download=download_stats,
+                stored_bytes=sum(len(value) for _, value in memcached.data.values()),
+                memcached_commands=dict(memcached.commands),
+                peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1))
+
+
+def sweep(args) -> list:
+    results = []
+    for file_size, chunk_size, concurrency, dedup_ratio in product(args.file_sizes, args.chunk_sizes,
+                                                                   args.concurrency, args.dedup_ratios):
+        point = {'file_size': file_size, 'chunk_size': chunk_size, 'concurrency': concurrency,
+                 'dedup_ratio': dedup_ratio}
+        process = subprocess.run([sys.executable, __file__, '--point', json.dumps(point), '--files', str(args.files),
+                                  '--latency', str(args.latency)], capture_output=True, text=True)
+        if process.returncode:
+            sys.stderr.write(process.stderr)
+            raise SystemExit(f"Benchmark of {point} failed")
+        result = json.loads(process.stdout.splitlines()[-1])
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def compare(results: list, baseline: dict) -> None:
+    """Print change of MB/s and p99 latency of each point against same point of baseline."""
+    keys = ('file_size', 'chunk_size', 'concurrency', 'dedup_ratio')
+    previous = {tuple(result[key] for key in keys): result for result in baseline['results']}
+    for result in results:
+        before = previous.get(tuple(result[key] for key in keys))
+        if before is None:
+            continue
+        changes = []
+        for direction in ('upload', 'download'):
+            for metric in ('mb_s', 'p99_ms'):
+                change = (result[direction][metric] - before[direction][metric]) / (before[direction][metric] or 1)
+                flag = ' !' if abs(change) > CHANGE_THRESHOLD else ''
+                changes.append(f"{direction} {metric} {change:+.0%}{flag}")
+        print(' '.join(f"{key}={result[key]}" for key in keys), '|', ', '.join(changes), file=sys.stderr)
+
+
+def numbers(kind):
+    return lambda value: [kind(item) for item in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-sizes', type=numbers(int), default=[100 * 1000, 5 * 1000 * 1000],
+                        help="comma separated file sizes in bytes")
+    parser.add_argument('--chunk-sizes', type=numbers(int), default=[64 * 1000, 500 * 1000],
+                        help="comma separated values of CHUNK_SIZE_BYTES")
+    parser.add_argument('--concurrency', type=numbers(int), default=[1, 8], help="comma separated client threads")
+    parser.add_argument('--dedup-ratios', type=numbers(float), default=[0.0, 0.5],
+                        help="comma separated shares of uploads repeating data of another upload")
+    parser.add_argument('--files', type=int, default=32, help="uploads of each point")
+    parser.add_argument('--latency', type=float, default=0.0002, help="memcached latency per command in seconds")
+    parser.add_argument('--output', help="file to write results to, defaults to stdout")
+    parser.add_argument('--baseline', help="results of a previous run to compare with")
+    parser.add_argument('--point', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.point:
+        print(json.dumps(run_point(json.loads(args.point), args.files, args.latency)))
+        sys.exit()
+
+    report = {'environment': environment(), 'files': args.files, 'latency': args.latency, 'results': sweep(args)}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(report['results'], json.load(baseline))
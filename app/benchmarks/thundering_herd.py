@@ -0,0 +1,117 @@
+"""
+Load test of backend calls made by concurrent requests for the same file.
+
+The real app is run against a temporary SQLite database and an in-process stand-in for
+memcached with injected latency. A burst of concurrent GETs for one file and of concurrent
+uploads of the same data is sent with single flight on and off, and the number of database
+queries and memcached commands is reported.
+
+Usage:
+    $ cd app/
+    $ python benchmarks/thundering_herd.py --clients 200
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Barrier, Lock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import event
+
+import config
+import file_store
+from app import app
+from database import db
+
+
+class FakeMemcached(object):
+    """Thread-safe dict with memcached client methods used by file_store, counting each command."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.data = {}
+        self.commands = Counter()
+        self._lock = Lock()
+
+    def _command(self, name: str) -> None:
+        with self._lock:
+            self.commands[name] += 1
+        time.sleep(self.latency)
+
+    def set(self, key, value, expire=0, noreply=None, flags=None):
+        self._command('set')
+        self.data[key] = value
+        return True
+
+    def get(self, key, default=None):
+        self._command('get')
+        return self.data.get(key, default)
+
+    def get_many(self, keys):
+        self._command('get_many')
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def touch(self, key, expire=0, noreply=None):
+        self._command('touch')
+        return key in self.data
+
+    def touch_many(self, keys, expire=0):
+        self._command('touch_many')
+        return {key for key in keys if key in self.data}
+
+    def delete_many(self, keys, noreply=None):
+        self._command('delete_many')
+        for key in keys:
+            self.data.pop(key, None)
+        return True
+
+
+def burst(clients: int, request) -> None:
+    barrier = Barrier(clients)
+
+    def send(_):
+        barrier.wait()
+        response = request(app.test_client())
+        assert response.status_code == 200, response.status_code
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(send, range(clients)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=200, help="concurrent requests in burst")
+    parser.add_argument('--file-size', type=int, default=5 * 1000 * 1000, help="file size in bytes")
+    parser.add_argument('--latency', type=float, default=0.001, help="memcached latency per command in seconds")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    memcached = FakeMemcached(args.latency)
+    file_store._client = memcached
+    queries = Counter()
+    data = os.urandom(args.file_size)
+
+    with app.app_context():
+        db.create_all()
+        event.listen(db.engine, 'before_cursor_execute', lambda *_: queries.update(['query']))
+    file_id = app.test_client().post('/api/files', data={'file': (BytesIO(data), 'file')}).data.decode()
+
+    for single_flight in (False, True):
+        config.single_flight = single_flight
+        for name, request in (
+                ('download', lambda client: client.get(f'/api/files/{file_id}')),
+                ('upload', lambda client: client.post('/api/files', data={'file': (BytesIO(data), 'file')}))):
+            queries.clear()
+            memcached.commands.clear()
+            start = time.perf_counter()
+            burst(args.clients, request)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<8} single_flight={'on ' if single_flight else 'off'} clients={args.clients} "
+                  f"db_queries={queries['query']} memcached={dict(memcached.commands)} elapsed={elapsed:.2f}s")
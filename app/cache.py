@@ -0,0 +1,124 @@
+"""In-process cache of hot file contents."""
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import config
+
+logger = logging.getLogger(config.logger_name)
+
+
+class ByteLRUCache(object):
+    """Thread-safe least recently used cache bounded by total size of values in bytes.
+
+    Entries expire after ttl seconds, so that data removed by another process is not served for long.
+
+    Args:
+        max_bytes: max total size of cached values, 0 disables cache
+        max_entry_bytes: max size of a single value, bigger values are not cached
+        ttl: seconds after which an entry expires
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.ttl = ttl
+        # key -> (value, size, expiry time), in least to most recently used order
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """
+        Get cached value
+        Args:
+            key: key of entry
+
+        Returns: value, None if key is not cached or has expired
+
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._pop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size: int) -> None:
+        """
+        Cache value, evicting least recently used entries to make space for it
+        Args:
+            key: key of entry
+            value: value to cache
+            size: size of value in bytes
+
+        Returns: None
+
+        """
+        if not self.enabled or size > self.max_entry_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            while self._size + size > self.max_bytes:
+                evicted_key, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+                logger.debug(f"Evicted {evicted_key} from file cache")
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._size += size
+
+    def invalidate(self, key) -> None:
+        """
+        Remove entry from cache
+        Args:
+            key: key of entry
+
+        Returns: None
+
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pop(key)
+
+    def stats(self) -> dict:
+        """
+        Get counters of cache
+        Returns: dict of counters
+
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'entries': len(self._entries),
+                    'bytes': self._size, 'max_bytes': self.max_bytes}
+
+    def _pop(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+
+# Cache of verified chunks of hot files by file id, shared by request threads of this process.
+file_cache = ByteLRUCache(max_bytes=config.file_cache_max_bytes,
+                          max_entry_bytes=config.file_cache_max_entry_bytes,
+                          ttl=config.file_cache_ttl)
@@ -0,0 +1,79 @@
+"""Content defined chunking of streams."""
+
+from hashlib import sha256
+
+# Gear hash only depends on last 64 bytes read, as every byte is shifted out of 64 bit hash after 64 steps.
+_GEAR_WINDOW = 64
+_HASH_MASK = (1 << 64) - 1
+# Random 64 bit value for each byte, derived from sha256 so that boundaries are same across processes.
+_GEAR = [int.from_bytes(sha256(bytes([value])).digest()[:8], 'big') for value in range(256)]
+
+
+def content_defined_chunks(stream, max_size: int) -> bytes:
+    """Generator to read a file-like object in content defined parts.
+
+    Boundaries are placed where rolling gear hash of last 64 bytes matches a mask,
+    so inserting or deleting data only changes chunks around the edit, instead of
+    shifting every later chunk as fixed size chunks do.
+    Chunks are between max_size / 8 and max_size bytes, max_size / 2 on average.
+
+    Args:
+        stream: byte stream
+        max_size: max size of chunk in bytes
+    Returns:
+        chunk: stream data of content defined size
+    """
+    min_size = max(max_size // 8, 1)
+    mask = _boundary_mask(max(max_size // 2 - min_size, 1))
+    buffer = b''
+    end_of_stream = False
+    while True:
+        while not end_of_stream and len(buffer) < max_size:
+            data = stream.read(max_size - len(buffer))
+            if not data:
+                end_of_stream = True
+            buffer += data
+        if not buffer:
+            return
+        boundary = _find_boundary(buffer, min_size, max_size, mask)
+        yield buffer[:boundary]
+        buffer = buffer[boundary:]
+
+
+def _boundary_mask(average_size: int) -> int:
+    """
+    Mask over high bits of hash, matching once every average_size bytes on average.
+    High bits are used as they depend on all bytes in the window.
+    Args:
+        average_size: expected distance between boundaries
+
+    Returns: mask
+
+    """
+    bits = max(average_size.bit_length() - 1, 1)
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _find_boundary(data: bytes, min_size: int, max_size: int, mask: int) -> int:
+    """
+    Find end of first chunk in data.
+    Args:
+        data: buffered stream data
+        min_size: min size of chunk
+        max_size: max size of chunk
+        mask: boundary mask
+
+    Returns: length of first chunk
+
+    """
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    gear = _GEAR
+    hash_value = 0
+    # bytes before the window ending at min_size can't affect a boundary
+    for index in range(max(min_size - _GEAR_WINDOW, 0), end):
+        hash_value = ((hash_value << 1) + gear[data[index]]) & _HASH_MASK
+        if index >= min_size and not hash_value & mask:
+            return index + 1
+    return end
@@ -0,0 +1,241 @@
+"""Memcached cluster with consistent hashing and replication of keys."""
+
+import logging
+import time
+from bisect import bisect
+from hashlib import md5
+from threading import Lock
+
+from pymemcache.exceptions import MemcacheUnexpectedCloseError
+
+import config
+from exception.memcache import MemcacheConnectionError
+
+logger = logging.getLogger(config.logger_name)
+
+# Errors after which a node is considered down.
+NODE_ERRORS = (MemcacheUnexpectedCloseError, OSError)
+
+
+class _Node(object):
+    """Memcached node of cluster with its health."""
+
+    def __init__(self, server: tuple, client):
+        self.server = server
+        self.name = f"{server[0]}:{server[1]}"
+        self.client = client
+        self.failures = 0
+        self.down_until = 0.0
+
+
+class ClusterClient(object):
+    """Client of a cluster of memcached nodes, with the client api used by file_store.
+
+    Keys are placed on nodes by consistent hashing, so adding or removing a node moves only
+    a share of keys. Each key is written to `replicas` distinct nodes and read from the first
+    healthy one holding it. A node failing with a connection error is skipped for `retry_after`
+    seconds, keys are served by other replicas meanwhile. Reads of keys with no healthy replica
+    miss, they fail only while no node of the cluster is healthy.
+
+    Args:
+        servers: list of (host, port) of nodes
+        client_factory: callable creating client of a node from its (host, port)
+        replicas: number of nodes each key is written to
+        retry_after: seconds for which a failed node is skipped
+        virtual_nodes: points of each node on hash ring, more points spread keys more evenly
+    """
+
+    def __init__(self, servers: list, client_factory, replicas: int = 1, retry_after: float = 30,
+                 virtual_nodes: int = 160):
+        self.nodes = [_Node(server, client_factory(server)) for server in servers]
+        self.replicas = max(min(replicas, len(self.nodes)), 1)
+        self.retry_after = retry_after
+        self._lock = Lock()
+        ring = []
+        for node in self.nodes:
+            for point in range(virtual_nodes):
+                ring.append((self._hash(f"{node.name}-{point}"), node))
+        ring.sort(key=lambda item: item[0])
+        self._ring_points = [point for point, _ in ring]
+        self._ring_nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(md5(value.encode()).digest()[:8], 'big')
+
+    def replica_nodes(self, key: str) -> list:
+        """
+        Get nodes holding key, in order of preference
+        Args:
+            key: memcached key
+
+        Returns: list of distinct nodes
+
+        """
+        nodes = []
+        start = bisect(self._ring_points, self._hash(key))
+        for index in range(len(self._ring_nodes)):
+            node = self._ring_nodes[(start + index) % len(self._ring_nodes)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == self.replicas:
+                    break
+        return nodes
+
+    def _healthy(self, nodes: list) -> list:
+        now = time.monotonic()
+        return [node for node in nodes if node.down_until <= now]
+
+    def _mark_down(self, node: _Node, ex: Exception) -> None:
+        with self._lock:
+            node.failures += 1
+            node.down_until = time.monotonic() + self.retry_after
+        logger.error(f"Memcached node {node.name} is down for {self.retry_after}s: {ex}")
+
+    def _mark_up(self, node: _Node) -> None:
+        if node.failures:
+            with self._lock:
+                node.failures = 0
+
+    def _call(self, node: _Node, method: str, *args, **kwargs):
+        """
+        Call method of node client, tracking health of node
+        Returns: result of method, raises error if node is down
+
+        """
+        try:
+            result = getattr(node.client, method)(*args, **kwargs)
+        except NODE_ERRORS as ex:
+            self._mark_down(node, ex)
+            raise
+        self._mark_up(node)
+        return result
+
+    def _healthy_replicas(self, key: str) -> list:
+        nodes = self._healthy(self.replica_nodes(key))
+        if not nodes:
+            raise MemcacheConnectionError(description=f"No healthy memcached node for key {key}")
+        return nodes
+
+    def _read_replicas(self, key: str) -> list:
+        """
+        Get healthy nodes to read key from
+        Returns: list of nodes, empty if every replica of key is down, raises error if every node of cluster is down
+
+        """
+        nodes = self._healthy(self.replica_nodes(key))
+        if not nodes and not self._healthy(self.nodes):
+            raise MemcacheConnectionError(description="No healthy memcached node")
+        return nodes
+
+    def set(self, key, value, expire=0, noreply=None, flags=None):
+        stored = False
+        for node in self._healthy_replicas(key):
+            try:
+                stored = self._call(node, 'set', key, value, expire=expire, noreply=noreply, flags=flags) or stored
+            except NODE_ERRORS:
+                continue
+        if not stored:
+            raise MemcacheConnectionError(description=f"Could not store key {key} on any memcached node")
+        return stored
+
+    def get(self, key, default=None):
+        for node in self._read_replicas(key):
+            try:
+                value = self._call(node, 'get', key)
+            except NODE_ERRORS:
+                continue
+            if value is not None:
+                return value
+        return default
+
+    def get_many(self, keys):
+        """
+        Get many keys, with one multi-get per node for each replica level
+        Returns: dict of found keys and values, keys with no healthy replica are missing
+
+        """
+        found = {}
+        pending = {key: self._read_replicas(key) for key in keys}
+        while pending:
+            by_node = {}
+            for key, nodes in pending.items():
+                if nodes:
+                    by_node.setdefault(nodes.pop(0), []).append(key)
+            if not by_node:
+                break
+            for node, node_keys in by_node.items():
+                try:
+                    found.update(self._call(node, 'get_many', node_keys))
+                except NODE_ERRORS:
+                    continue
+            # keys missing on a replica are looked up on next one
+            pending = {key: nodes for key, nodes in pending.items() if key not in found and nodes}
+        return found
+
+    def touch(self, key, expire=0, noreply=None):
+        touched = False
+        for node in self._read_replicas(key):
+            try:
+                touched = self._call(node, 'touch', key, expire=expire, noreply=noreply) or touched
+            except NODE_ERRORS:
+                continue
+        return touched
+
+    def touch_many(self, keys, expire=0):
+        """
+        Touch many keys on every healthy replica, with one pipelined touch per node
+        Returns: set of keys touched on at least one replica, keys with no healthy replica are missing
+
+        """
+        by_node = {}
+        for key in keys:
+            for node in self._read_replicas(key):
+                by_node.setdefault(node, []).append(key)
+        touched = set()
+        for node, node_keys in by_node.items():
+            try:
+                touched.update(self._call(node, 'touch_many', node_keys, expire=expire))
+            except NODE_ERRORS:
+                continue
+        return touched
+
+    def delete_many(self, keys, noreply=None):
+        by_node = {}
+        for key in keys:
+            for node in self._healthy(self.replica_nodes(key)):
+                by_node.setdefault(node, []).append(key)
+        for node, node_keys in by_node.items():
+            try:
+                self._call(node, 'delete_many', node_keys, noreply=noreply)
+            except NODE_ERRORS:
+                continue
+        return True
+
+    def version(self):
+        """
+        Get version of healthy nodes
+        Returns: dict of version by node, raises error if no node is healthy
+
+        """
+        versions = {}
+        for node in self.nodes:
+            try:
+                versions[node.name] = self._call(node, 'version')
+            except NODE_ERRORS:
+                continue
+        if not versions:
+            raise MemcacheConnectionError(description="No healthy memcached node")
+        return versions
+
+    def stats(self, *args):
+        return {node.name: self._call(node, 'stats', *args) for node in self._healthy(self.nodes)}
+
+    def health(self) -> dict:
+        """
+        Get health of nodes
+        Returns: dict of node name to its failures and whether it is up
+
+        """
+        now = time.monotonic()
+        return {node.name: {'up': node.down_until <= now, 'failures': node.failures} for node in self.nodes}
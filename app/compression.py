@@ -0,0 +1,65 @@
+"""Compression of chunks stored in memcached."""
+
+import lzma
+import zlib
+
+import config
+
+# Size of sample compressed to decide if a chunk is worth compressing.
+SAMPLE_SIZE = 4096
+# Chunks whose sample doesn't compress below this ratio are stored raw.
+MAX_SAMPLE_RATIO = 0.9
+
+_COMPRESSORS = {
+    'zlib': lambda data, level: zlib.compress(data, level),
+    'lzma': lambda data, level: lzma.compress(data, preset=level),
+}
+_DECOMPRESSORS = {
+    'zlib': zlib.decompress,
+    'lzma': lzma.decompress,
+}
+
+
+def compress(chunk: bytes, codec: str = None, level: int = None) -> tuple:
+    """
+    Compress chunk with codec, unless chunk is incompressible.
+    A small sample of chunk is compressed first, so that incompressible data like
+    archives or media costs little CPU.
+    Args:
+        chunk: data of chunk
+        codec: name of codec, defaults to configured one. None or 'none' stores chunks raw
+        level: compression level of codec, defaults to configured one
+
+    Returns:
+        payload: data to store
+        codec: codec used for payload, None if payload is raw chunk
+
+    """
+    codec = codec if codec is not None else config.chunk_compression
+    level = level if level is not None else config.chunk_compression_level
+    if codec in (None, 'none') or not chunk:
+        return chunk, None
+    if codec not in _COMPRESSORS:
+        raise ValueError(f"Unsupported chunk compression codec {codec}")
+    sample = chunk[:SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * MAX_SAMPLE_RATIO:
+        return chunk, None
+    payload = _COMPRESSORS[codec](chunk, level)
+    if len(payload) >= len(chunk):
+        return chunk, None
+    return payload, codec
+
+
+def decompress(payload: bytes, codec: str = None) -> bytes:
+    """
+    Decompress stored payload of chunk.
+    Args:
+        payload: stored data
+        codec: codec used for payload, None if payload is raw chunk
+
+    Returns: data of chunk
+
+    """
+    if codec is None:
+        return payload
+    return _DECOMPRESSORS[codec](payload)
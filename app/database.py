@@ -1,7 +1,29 @@
 """Flask app database objects."""
 
+import os
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
 
 db = SQLAlchemy()
 migrate = Migrate()
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record) -> None:
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy) -> None:
+    """
+    Refuse pooled connections opened by parent of a forked process, such as a worker of a prefork server.
+    Such connection is dropped without being closed, as it is still used by parent, and pool opens a new one.
+    """
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(f"Connection record belongs to pid {connection_record.info['pid']}, "
+                                     f"attempting to check out in pid {pid}")
@@ -0,0 +1,358 @@
+"""Local disk tier of chunks behind memcached, made of append-only segment files read through mmap."""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from threading import Lock
+
+from pymemcache.exceptions import MemcacheError
+
+import config
+from exception.memcache import MemcacheConnectionError
+
+logger = logging.getLogger(config.logger_name)
+
+# Header of a record: crc32 of key and value, kind, key length, value length
+_HEADER = struct.Struct('>IBHI')
+_PUT = 0
+_DELETE = 1
+_SEGMENT_PREFIX = 'segment-'
+_SEGMENT_SUFFIX = '.dat'
+# Generation of segments kept at start of lock file, counting appends of every process sharing the directory
+_GENERATION = struct.Struct('>Q')
+# Errors of memcached clients, cluster client fails with connection error while none of its nodes is healthy
+MEMCACHED_ERRORS = (MemcacheError, MemcacheConnectionError, OSError)
+
+
+class SegmentStore(object):
+    """Store of chunks in append-only segment files of a local directory, with the client api used by file_store.
+
+    Each write appends a record to the active segment, a delete appends a tombstone. Location of the
+    live record of each key is kept in memory and rebuilt by scanning segments when store is opened,
+    so segments are the only state on disk besides a generation counter in the lock file, bumped by
+    each append. Records appended by other processes sharing the directory are picked up by scanning
+    new data of segments when the generation has changed since last scan. Segments are read through
+    mmap, so hot segments are served from page cache without copies into buffers of the process.
+    The oldest segments are dropped once segments take more than max_bytes, so the tier holds the
+    most recently written chunks.
+
+    Args:
+        directory: directory of segment files, created if missing
+        segment_size: size in bytes after which a new segment is started
+        max_bytes: max total size of segments in bytes
+    """
+
+    def __init__(self, directory: str, segment_size: int, max_bytes: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # key -> (segment id, offset of value, length of value)
+        self._index = {}
+        # segment id -> bytes of segment scanned into index
+        self._scanned = {}
+        # segment id -> mmap of segment
+        self._maps = {}
+        self._lock = Lock()
+        # lock file serializing appends of processes sharing the directory, holding generation of segments
+        self._lock_file = os.open(os.path.join(directory, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        # generation of segments whose records are all in index
+        self._generation = None
+        self.promotions = 0
+        self.dropped_segments = 0
+        with self._lock:
+            self._refresh()
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{_SEGMENT_PREFIX}{segment:06d}{_SEGMENT_SUFFIX}')
+
+    def _segments(self) -> list:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                segments.append(int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _read_generation(self) -> int:
+        data = os.pread(self._lock_file, _GENERATION.size, 0)
+        # lock file of older versions is empty
+        return _GENERATION.unpack(data)[0] if len(data) == _GENERATION.size else 0
+
+    def _refresh(self) -> None:
+        """Scan segments if another process has appended to them or dropped some since last scan."""
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._scan()
+            self._generation = generation
+
+    def _scan(self) -> None:
+        """Add records written since last scan to index, forget segments dropped by another process."""
+        segments = self._segments()
+        for segment in set(self._scanned) - set(segments):
+            self._forget(segment)
+        for segment in segments:
+            try:
+                with open(self._path(segment), 'rb') as segment_file:
+                    segment_file.seek(self._scanned.get(segment, 0))
+                    self._scan_records(segment, segment_file)
+            except FileNotFoundError:
+                self._forget(segment)
+
+    def _scan_records(self, segment: int, segment_file) -> None:
+        offset = segment_file.tell()
+        while True:
+            header = segment_file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            crc, kind, key_length, value_length = _HEADER.unpack(header)
+            key = segment_file.read(key_length)
+            value = segment_file.read(value_length)
+            if len(value) < value_length:
+                # record still being written, or torn by a crash
+                break
+            if zlib.crc32(value, zlib.crc32(key)) != crc:
+                logger.error(f"Corrupt record at offset {offset} of disk tier segment {segment}")
+            elif kind == _PUT:
+                self._index[key.decode()] = (segment, offset + _HEADER.size + key_length, value_length)
+            else:
+                self._index.pop(key.decode(), None)
+            offset += _HEADER.size + key_length + value_length
+        self._scanned[segment] = offset
+
+    def _forget(self, segment: int) -> None:
+        self._scanned.pop(segment, None)
+        segment_map = self._maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+        for key in [key for key, location in self._index.items() if location[0] == segment]:
+            del self._index[key]
+
+    def _append(self, records: list) -> None:
+        """
+        Append records to active segment
+        Args:
+            records: list of (kind, key, value)
+
+        Returns: None
+
+        """
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                # pick up records of other processes, so that offsets of index stay exact
+                self._refresh()
+                segment = max(self._scanned, default=1)
+                size = sum(_HEADER.size + len(key) + len(value) for _, key, value in records)
+                if self._scanned.get(segment, 0) and self._scanned[segment] + size > self.segment_size:
+                    self._drop_oldest(sorted(self._scanned), size)
+                    segment += 1
+                offset = self._scanned.get(segment, 0)
+                data = bytearray()
+                for kind, key, value in records:
+                    key_bytes = key.encode()
+                    data += _HEADER.pack(zlib.crc32(value, zlib.crc32(key_bytes)), kind, len(key_bytes), len(value))
+                    data += key_bytes
+                    value_offset = offset + len(data)
+                    data += value
+                    if kind == _PUT:
+                        self._index[key] = (segment, value_offset, len(value))
+                    else:
+                        self._index.pop(key, None)
+                segment_file = os.open(self._path(segment), os.O_WRONLY | os.O_CREAT, 0o644)
+                try:
+                    # records are written after last scanned one, over a record torn by a crash
+                    os.pwrite(segment_file, data, offset)
+                    os.ftruncate(segment_file, offset + len(data))
+                finally:
+                    os.close(segment_file)
+                self._scanned[segment] = offset + len(data)
+                self._generation += 1
+                os.pwrite(self._lock_file, _GENERATION.pack(self._generation), 0)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _drop_oldest(self, segments: list, incoming: int) -> None:
+        """Remove oldest segments until segments and incoming bytes fit in max bytes."""
+        total = sum(self._scanned[segment] for segment in segments) + incoming
+        for segment in segments:
+            if total <= self.max_bytes:
+                break
+            size = self._scanned[segment]
+            os.remove(self._path(segment))
+            self._forget(segment)
+            self.dropped_segments += 1
+            total -= size
+            logger.info(f"Dropped disk tier segment {segment} of {size} bytes")
+
+    def _read(self, location: tuple):
+        segment, offset, length = location
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < offset + length:
+            # active segment grows, so it is mapped again once a read goes past mapped size
+            if segment_map is not None:
+                segment_map.close()
+            try:
+                with open(self._path(segment), 'rb') as segment_file:
+                    segment_map = self._maps[segment] = mmap.mmap(segment_file.fileno(), 0,
+                                                                  access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                self._forget(segment)
+                return None
+        return segment_map[offset:offset + length]
+
+    def keys_older_than(self, seconds: float) -> list:
+        """
+        Get keys of segments not written for a while
+        Args:
+            seconds: seconds since last write of segment
+
+        Returns: list of keys
+
+        """
+        written_before = time.time() - seconds
+        with self._lock:
+            self._refresh()
+            old_segments = {segment for segment in self._scanned
+                            if os.path.getmtime(self._path(segment)) < written_before}
+            return [key for key, location in self._index.items() if location[0] in old_segments]
+
+    def set(self, key, value, expire=0, noreply=None, flags=None):
+        self._append([(_PUT, key, bytes(value))])
+        return True
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                self._refresh()
+            for key in keys:
+                location = self._index.get(key)
+                if location is not None:
+                    value = self._read(location)
+                    if value is not None:
+                        found[key] = value
+        return found
+
+    def touch(self, key, expire=0, noreply=None):
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            return key in self._index
+
+    def touch_many(self, keys, expire=0):
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                self._refresh()
+            return {key for key in keys if key in self._index}
+
+    def delete_many(self, keys, noreply=None):
+        keys = [key for key in keys if self.touch(key)]
+        if keys:
+            self._append([(_DELETE, key, b'') for key in keys])
+        return True
+
+    def stats(self, *args):
+        with self._lock:
+            segments = self._segments()
+            return {'segments': len(segments),
+                    'bytes': sum(os.path.getsize(self._path(segment)) for segment in segments),
+                    'live_bytes': sum(length for _, _, length in self._index.values()),
+                    'keys': len(self._index),
+                    'promotions': self.promotions,
+                    'dropped_segments': self.dropped_segments}
+
+
+class TieredClient(object):
+    """Client of memcached backed by a disk tier, with the client api used by file_store.
+
+    Memcached does not tell which keys it evicts, so every chunk is written through to the disk tier
+    and an eviction from memcached demotes the chunk to disk only. Reads are served by memcached and
+    fall back to disk, chunks found on disk are promoted back to memcached. Chunks are still served
+    from disk while memcached is failing.
+
+    Args:
+        memory: memcached client
+        disk: SegmentStore of disk tier
+    """
+
+    def __init__(self, memory, disk: SegmentStore):
+        self.memory = memory
+        self.disk = disk
+
+    def set(self, key, value, expire=0, noreply=None, flags=None):
+        self.disk.set(key, value)
+        try:
+            self.memory.set(key, value, expire=expire, noreply=noreply, flags=flags)
+        except MEMCACHED_ERRORS as ex:
+            logger.error(f"Could not store key {key} in memcached, it is served from disk tier: {ex}")
+        return True
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        try:
+            found = self.memory.get_many(keys)
+        except MEMCACHED_ERRORS as ex:
+            logger.error(f"Could not fetch keys from memcached, serving them from disk tier: {ex}")
+            found = {}
+        missing = [key for key in keys if not found.get(key)]
+        if missing:
+            promoted = self.disk.get_many(missing)
+            if promoted:
+                self._promote(promoted)
+                found.update(promoted)
+        return found
+
+    def _promote(self, values: dict) -> None:
+        for key, value in values.items():
+            try:
+                self.memory.set(key, value)
+                self.disk.promotions += 1
+                logger.debug(f"Promoted key {key} from disk tier to memcached")
+            except MEMCACHED_ERRORS as ex:
+                logger.error(f"Could not promote key {key} to memcached: {ex}")
+
+    def touch(self, key, expire=0, noreply=None):
+        # a chunk held by disk only is promoted, so that memcached records its access for the scrubber
+        try:
+            if self.memory.touch(key, expire=expire, noreply=noreply):
+                return True
+        except MEMCACHED_ERRORS as ex:
+            logger.error(f"Could not touch key {key} in memcached, looking it up in disk tier: {ex}")
+            return self.disk.touch(key)
+        promoted = self.disk.get_many([key])
+        if promoted:
+            self._promote(promoted)
+        return bool(promoted)
+
+    def touch_many(self, keys, expire=0):
+        try:
+            touched = self.memory.touch_many(keys, expire=expire)
+        except MEMCACHED_ERRORS as ex:
+            logger.error(f"Could not touch keys in memcached, looking them up in disk tier: {ex}")
+            return self.disk.touch_many(keys)
+        missing = [key for key in keys if key not in touched]
+        if missing:
+            promoted = self.disk.get_many(missing)
+            if promoted:
+                self._promote(promoted)
+                touched = set(touched) | set(promoted)
+        return touched
+
+    def delete_many(self, keys, noreply=None):
+        self.disk.delete_many(keys)
+        return self.memory.delete_many(keys, noreply=noreply)
+
+    def version(self):
+        return self.memory.version()
+
+    def stats(self, *args):
+        return self.memory.stats(*args)
@@ -0,0 +1,118 @@
+"""Reed-Solomon erasure coding of chunks over GF(256)."""
+
+# Data chunks of a group take points 0..k-1 and parity chunks points 128..128+m-1 of the Cauchy matrix,
+# so any k of the k + m chunks of a group recover its data chunks.
+MAX_DATA_CHUNKS = 128
+MAX_PARITY_CHUNKS = 128
+_PARITY_POINT = 128
+
+# exp and log tables of GF(256) with generator 2 and polynomial x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11d
+for _power in range(255, 512):
+    _EXP[_power] = _EXP[_power - 255]
+
+
+def _mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def _inv(a: int) -> int:
+    return _EXP[255 - _LOG[a]]
+
+
+# Table of products with each constant, multiplying bytes by a constant is a bytes.translate with it.
+_MUL_TABLES = [bytes(_mul(constant, value) for value in range(256)) for constant in range(256)]
+
+
+def _coefficient(parity_index: int, data_index: int) -> int:
+    """Coefficient of data chunk in parity chunk, element of a Cauchy matrix."""
+    return _inv((_PARITY_POINT + parity_index) ^ data_index)
+
+
+def _combine(chunks: list, coefficients: list, size: int) -> bytes:
+    """Sum of chunks multiplied by coefficients in GF(256), chunks are zero padded to size."""
+    total = 0
+    for chunk, coefficient in zip(chunks, coefficients):
+        if coefficient:
+            total ^= int.from_bytes(chunk.translate(_MUL_TABLES[coefficient]), 'little')
+    return total.to_bytes(size, 'little')
+
+
+def encode(data_chunks: list, parity_count: int) -> list:
+    """
+    Compute parity chunks of a group of data chunks.
+    Parity chunks are as long as the longest data chunk, shorter chunks are zero padded.
+    Args:
+        data_chunks: data chunks of group, at most 128
+        parity_count: number of parity chunks, at most 128
+
+    Returns: list of parity chunks
+
+    """
+    if not 0 < len(data_chunks) <= MAX_DATA_CHUNKS or not 0 < parity_count <= MAX_PARITY_CHUNKS:
+        raise ValueError(f"Unsupported erasure coding of {len(data_chunks)} data and {parity_count} parity chunks")
+    size = max(len(chunk) for chunk in data_chunks)
+    return [_combine(data_chunks, [_coefficient(parity_index, data_index) for data_index in range(len(data_chunks))],
+                     size)
+            for parity_index in range(parity_count)]
+
+
+def decode(data_chunks: list, parity_chunks: list, data_sizes: list) -> list:
+    """
+    Recover missing data chunks of a group.
+    Args:
+        data_chunks: data chunks of group, None for missing ones
+        parity_chunks: parity chunks of group, None for missing ones
+        data_sizes: size of each data chunk
+
+    Returns: list of all data chunks, raises ValueError if more chunks are missing than there are parity chunks
+
+    """
+    missing = [index for index, chunk in enumerate(data_chunks) if chunk is None]
+    if not missing:
+        return list(data_chunks)
+    available_parity = [index for index, chunk in enumerate(parity_chunks) if chunk is not None]
+    if len(available_parity) < len(missing):
+        raise ValueError(f"Can't recover {len(missing)} data chunks from {len(available_parity)} parity chunks")
+    size = max(len(chunk) for chunk in parity_chunks if chunk is not None)
+    known = [index for index in range(len(data_chunks)) if index not in missing]
+    rows = available_parity[:len(missing)]
+    # parity chunk minus contribution of known data chunks leaves a combination of missing chunks only
+    syndromes = []
+    for parity_index in rows:
+        coefficients = [1] + [_coefficient(parity_index, index) for index in known]
+        syndromes.append(_combine([parity_chunks[parity_index]] + [data_chunks[index] for index in known],
+                                  coefficients, size))
+    # solve the system of missing chunks with inverse of its Cauchy sub matrix
+    inverse = _invert([[_coefficient(parity_index, index) for index in missing] for parity_index in rows])
+    recovered = list(data_chunks)
+    for row, index in enumerate(missing):
+        recovered[index] = _combine(syndromes, inverse[row], size)[:data_sizes[index]]
+    return recovered
+
+
+def _invert(matrix: list) -> list:
+    """Inverse of square matrix over GF(256) by Gauss-Jordan elimination."""
+    size = len(matrix)
+    rows = [list(row) + [1 if column == index else 0 for column in range(size)] for index, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next(index for index in range(column, size) if rows[index][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        factor = _inv(rows[column][column])
+        rows[column] = [_mul(value, factor) for value in rows[column]]
+        for index in range(size):
+            if index != column and rows[index][column]:
+                factor = rows[index][column]
+                rows[index] = [value ^ _mul(factor, pivot_value)
+                               for value, pivot_value in zip(rows[index], rows[column])]
+    return [row[size:] for row in rows]
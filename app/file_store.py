@@ -1,16 +1,37 @@
 """File chunk storage."""
 
-from pymemcache.client.base import Client
-from pymemcache.exceptions import MemcacheError, MemcacheIllegalInputError
+from pymemcache.client.base import PooledClient
+from pymemcache.client.retrying import RetryingClient
+from pymemcache.exceptions import MemcacheError, MemcacheIllegalInputError, MemcacheUnexpectedCloseError
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import unquote
 from uuid import uuid4
+import os
+import socket
+import time
 import config
 import logging
 
+from cluster import ClusterClient
+from disk_tier import SegmentStore, TieredClient
+from metrics import InstrumentedClient
 from exception.memcache import MemcacheKeyNotFound, MemcacheConnectionError
-from config import memcached_host, memcached_port
 
 logger = logging.getLogger(config.logger_name)
 
+# Prefix of keys for chunks stored by their checksum, such chunks may be shared by many files.
+CONTENT_ADDRESSED_KEY_PREFIX = 'sha256:'
+# Prefix of keys for items holding data of many small files.
+PACKED_KEY_PREFIX = 'pack:'
+
+# Process wide memcached client, shared by every request thread. Built lazily by memcached_client().
+_client = None
+_client_lock = Lock()
+# Process wide pool of threads reading chunks ahead of streamed responses. Built lazily by _prefetcher().
+_prefetch_executor = None
+_prefetch_lock = Lock()
+
 
 def store(content: str) -> str:
     """Store a chunk in the backend datastore.
@@ -31,6 +52,88 @@ def store(content: str) -> str:
         raise me
 
 
+def store_content_addressed(content: bytes, checksum: str, codec: str = None) -> str:
+    """Store a chunk in the backend datastore under key derived from its checksum.
+    If a chunk with same checksum is already stored, its data is not sent again.
+    Args:
+        content: data to store in memcached
+        checksum: sha256 hex digest of chunk
+        codec: compression codec of content, None if content is the raw chunk.
+            Chunk compressed with different codecs is stored under different keys.
+    Returns: key of this chunk, needed to retrieve it again.
+    """
+    key = f"{CONTENT_ADDRESSED_KEY_PREFIX}{checksum}"
+    if codec is not None:
+        key = f"{key}.{codec}"
+    try:
+        client = memcached_client()
+        if client.touch(key, expire=0, noreply=False):
+            logger.debug(f"Chunk with key {key} is already present in memcached")
+        else:
+            logger.debug(f"Attempting to store data at key {key} in memcached")
+            client.set(key, content)
+        return key
+    except MemcacheError as me:
+        logger.error(f"Got error in storing chunk data on id {key} in memcached: {me}")
+        raise me
+
+
+def store_packed(content: bytes) -> str:
+    """Store an item holding data of many small files in the backend datastore.
+    Args:
+        content: data to store in memcached
+    Returns: key of this item, shared by parts of every file it holds.
+    """
+    try:
+        client = memcached_client()
+        key = f"{PACKED_KEY_PREFIX}{uuid4()}"
+        logger.debug(f"Attempting to store packed data at key {key} in memcached")
+        client.set(key, content)
+        return key
+    except MemcacheError as me:
+        logger.error(f"Got error in storing packed data on id {key} in memcached: {me}")
+        raise me
+
+
+def restore(key: str, content: bytes) -> None:
+    """Write back a chunk under its existing key, after it has been rebuilt.
+    Args:
+        key: id of key in memcached
+        content: data to store in memcached
+    Returns: None
+    """
+    try:
+        logger.debug(f"Attempting to restore data at key {key} in memcached")
+        memcached_client().set(key, content)
+    except MemcacheError as me:
+        logger.error(f"Got error in restoring chunk data on id {key} in memcached: {me}")
+        raise me
+
+
+def is_content_addressed(key: str) -> bool:
+    """
+    Check if key is of a chunk stored by its checksum.
+    Args:
+        key: id of key in memcached
+
+    Returns: True if chunk may be shared by many files
+
+    """
+    return key.startswith(CONTENT_ADDRESSED_KEY_PREFIX)
+
+
+def is_shared(key: str) -> bool:
+    """
+    Check if key is of a chunk which may be referenced by parts of many files.
+    Args:
+        key: id of key in memcached
+
+    Returns: True if chunk is stored by its checksum or holds data of packed files
+
+    """
+    return is_content_addressed(key) or key.startswith(PACKED_KEY_PREFIX)
+
+
 def remove(ids: list) -> None:
     """
     Remove keys from memcached.
@@ -67,36 +170,292 @@ def fetch(key: str) -> str:
         if not value:
             logger.error(f"Could not find key {key} in memcached")
             raise MemcacheKeyNotFound(description=f"Key with id {key} could not be found in memcached.")
-        return client.get(key)
+        return value
     except MemcacheError as ex:
         logger.error(f"Got error in fetching id {key} from memcached: {ex}")
         raise ex
 
 
-def check_all_keys(memcached_keys: list) -> bool:
+def fetch_many(keys: list, missing_ok: bool = False) -> list:
+    """
+    Retrieve stored data for many keys from the backend datastore.
+    Keys are fetched with multi-get in windows of configured size, so N keys cost about N/window round trips.
+    Args:
+        keys: ids of keys in memcached
+        missing_ok: if True None is returned for keys which are not present, instead of raising error
+    Returns:
+        list: data stored for the provided IDs, in the same order as keys.
+    """
+    values = []
+    for window in _windows(keys, config.memcached_fetch_window):
+        values.extend(_fetch_window(window, missing_ok))
+    return values
+
+
+def iter_fetch(keys: list, window: int = None, missing_ok: bool = False):
+    """
+    Generator to retrieve stored data for many keys, one at a time.
+    While values of a window are consumed, the next window is fetched in background,
+    so at most two windows of values are held in memory.
+    Args:
+        keys: ids of keys in memcached
+        window: number of keys to fetch per round trip, defaults to configured prefetch window
+        missing_ok: if True None is yielded for keys which are not present, instead of raising error
+    Returns:
+        value: data stored for each provided ID, in the same order as keys.
+    """
+    windows = _windows(keys, window or config.memcached_prefetch_window)
+    first_window = next(windows, None)
+    if first_window is None:
+        return
+    pending = _prefetcher().submit(_fetch_window, first_window, missing_ok)
+    for next_window in windows:
+        values = pending.result()
+        pending = _prefetcher().submit(_fetch_window, next_window, missing_ok)
+        yield from values
+    yield from pending.result()
+
+
+def _prefetcher() -> ThreadPoolExecutor:
+    """
+    Get executor for background chunk reads
+    Returns: executor
+
+    """
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        with _prefetch_lock:
+            if _prefetch_executor is None:
+                _prefetch_executor = ThreadPoolExecutor(max_workers=config.memcached_prefetch_workers,
+                                                        thread_name_prefix='memcached-prefetch')
+    return _prefetch_executor
+
+
+def _fetch_window(keys: list, missing_ok: bool = False) -> list:
+    """
+    Retrieve stored data for a window of keys in single round trip.
+    Args:
+        keys: ids of keys in memcached
+        missing_ok: if True None is returned for keys which are not present, instead of raising error
+    Returns:
+        list: data stored for the provided IDs, in the same order as keys.
+    """
+    try:
+        logger.debug(f"Fetching data from memcached for ids {keys}")
+        found = memcached_client().get_many(keys)
+    except MemcacheError as ex:
+        logger.error(f"Got error in fetching ids {keys} from memcached: {ex}")
+        raise ex
+    values = []
+    for key in keys:
+        value = found.get(key)
+        if not value:
+            logger.error(f"Could not find key {key} in memcached")
+            if missing_ok:
+                value = None
+            else:
+                raise MemcacheKeyNotFound(description=f"Key with id {key} could not be found in memcached.")
+        values.append(value)
+    return values
+
+
+def check_all_keys(memcached_keys: list, existence_only: bool = True, clean: bool = True) -> bool:
     """
     Check if all keys are present in memcached
     If any of key is not present, delete all keys as corrupted data is consuming memory.
     Args:
         memcached_keys: list of keys to check
+        existence_only: if True keys are probed with pipelined touches, so no chunk data is sent over the wire.
+            If False values are fetched with batched multi-gets.
+        clean: if False keys are not deleted when one of them is not present,
+            for keys which may be shared with other files.
 
     Returns:
         boolean: True if all keys are present, False if one or more keys are not present
 
     """
-    client = memcached_client()
-    found = True
     logger.debug(f"Checking if all supplied keys are present in memcached: {memcached_keys}")
-    for memcached_key in memcached_keys:
-        found = client.get(memcached_key)
-        if not found:
-            # if key is not found then delete corrupted record from memcached
-            logger.debug(f"Could not find {memcached_key} key in memcached")
+    if existence_only:
+        missing_key = _first_missing_key_by_touch(memcached_keys)
+    else:
+        missing_key = _first_missing_key_by_get(memcached_keys)
+    if missing_key is not None:
+        # if key is not found then delete corrupted record from memcached
+        logger.debug(f"Could not find {missing_key} key in memcached")
+        if clean:
             _clean_keys(memcached_keys)
-            found = False
-            # break the loop as all keys are now cleaned
-            break;
-    return found
+        return False
+    return True
+
+
+def _first_missing_key_by_touch(memcached_keys: list):
+    """
+    Probe keys for existence without transferring their values, with touches in windows of configured size.
+    Chunks are stored without expiry, so touching them with expire 0 does not change them.
+    Args:
+        memcached_keys: list of keys to check
+
+    Returns: first key which is not present, None if all keys are present
+
+    """
+    client = memcached_client()
+    # touches of a window are sent together, so a window takes a single round trip to each node
+    for window in _windows(memcached_keys, config.memcached_fetch_window):
+        touched = client.touch_many(window)
+        for memcached_key in window:
+            if memcached_key not in touched:
+                return memcached_key
+    return None
+
+
+def _first_missing_key_by_get(memcached_keys: list):
+    """
+    Check keys for existence by fetching them in windows with multi-get.
+    Args:
+        memcached_keys: list of keys to check
+
+    Returns: first key which is not present, None if all keys are present
+
+    """
+    client = memcached_client()
+    for window in _windows(memcached_keys, config.memcached_fetch_window):
+        found = client.get_many(window)
+        for memcached_key in window:
+            if not found.get(memcached_key):
+                return memcached_key
+    return None
+
+
+def live_keys(memcached_keys: list) -> set:
+    """
+    Find which keys are present, with pipelined touches in windows of configured size, so no chunk data
+    is sent over the wire. With disk tier, keys held on disk are live and are not promoted to memcached.
+    Args:
+        memcached_keys: list of keys to check
+
+    Returns: set of keys which are present
+
+    """
+    client = memcached_client()
+    live = set()
+    if isinstance(client, TieredClient):
+        live = client.disk.touch_many(memcached_keys)
+        client = client.memory
+    for window in _windows([key for key in memcached_keys if key not in live], config.memcached_fetch_window):
+        live.update(client.touch_many(window))
+    return live
+
+
+def idle_keys(idle_seconds: float):
+    """
+    Generator over stored keys which are not accessed for a while, to find keys no file refers to.
+    Keys of memcached nodes are listed with lru_crawler metadump, keys of disk tier from its index.
+    Args:
+        idle_seconds: seconds since last access of a key, or since it was written to disk tier
+
+    Returns:
+        key: each idle key, a key may be listed by more than one node or tier
+    """
+    client = memcached_client()
+    if isinstance(client, TieredClient):
+        yield from client.disk.keys_older_than(idle_seconds)
+    accessed_before = time.time() - idle_seconds
+    for node in config.memcached_nodes:
+        for key, last_access in _metadump(_server(node)):
+            if last_access < accessed_before:
+                yield key
+
+
+def _metadump(server: tuple):
+    """
+    Generator over keys of a memcached node with lru_crawler metadump, keys are streamed without their values.
+    Args:
+        server: (host, port) of node
+
+    Returns:
+        key: each key of node
+        last_access: unix time of last access of key
+    """
+    try:
+        with socket.create_connection(server, timeout=config.memcached_timeout) as connection:
+            connection.sendall(b'lru_crawler metadump all\r\n')
+            for line in connection.makefile('rb'):
+                line = line.rstrip(b'\r\n')
+                if line == b'END':
+                    return
+                if not line.startswith(b'key='):
+                    logger.error(f"Could not list keys of memcached node {server[0]}:{server[1]}: {line}")
+                    return
+                fields = dict(field.split(b'=', 1) for field in line.split(b' ') if b'=' in field)
+                yield unquote(fields[b'key'].decode()), int(fields.get(b'la', 0))
+    except OSError as ex:
+        logger.error(f"Could not list keys of memcached node {server[0]}:{server[1]}: {ex}")
+
+
+def recently_accessed(memcached_keys: list, seconds: float) -> set:
+    """
+    Get keys accessed on any memcached node within some seconds, so that keys about to be reclaimed
+    are checked again right before they are deleted.
+    Args:
+        memcached_keys: list of keys to check
+        seconds: seconds since last access of a key
+
+    Returns: keys accessed within seconds, along with keys whose last access could not be read
+
+    """
+    accessed = set()
+    for node in config.memcached_nodes:
+        accessed.update(_accessed_on(_server(node), memcached_keys, seconds))
+    return accessed
+
+
+def _accessed_on(server: tuple, memcached_keys: list, seconds: float) -> set:
+    """
+    Read last access of keys on a memcached node with meta get, gets of a window are sent in a single round trip.
+    Args:
+        server: (host, port) of node
+        memcached_keys: list of keys to check
+        seconds: seconds since last access of a key
+
+    Returns: keys accessed within seconds on node, every key if node can't tell
+
+    """
+    accessed = set()
+    try:
+        with socket.create_connection(server, timeout=config.memcached_timeout) as connection:
+            replies = connection.makefile('rb')
+            for window in _windows(memcached_keys, config.memcached_fetch_window):
+                connection.sendall(b''.join(b'mg %s l\r\n' % key.encode() for key in window))
+                for key in window:
+                    flags = replies.readline().rstrip(b'\r\n').split(b' ')
+                    if flags[0] == b'EN':
+                        # key is not on this node
+                        continue
+                    if flags[0] not in (b'HD', b'OK'):
+                        logger.error(f"Could not read last access of keys on memcached node {server[0]}:{server[1]}: "
+                                     f"{b' '.join(flags)}")
+                        return set(memcached_keys)
+                    last_access = next((int(flag[1:]) for flag in flags[1:] if flag.startswith(b'l')), None)
+                    if last_access is None or last_access < seconds:
+                        accessed.add(key)
+    except OSError as ex:
+        logger.error(f"Could not read last access of keys on memcached node {server[0]}:{server[1]}: {ex}")
+        return set(memcached_keys)
+    return accessed
+
+
+def _windows(items: list, size: int):
+    """
+    Generator to split items in consecutive windows.
+    Args:
+        items: list to split
+        size: max number of items in a window
+    Returns:
+        window: list of at most size items
+    """
+    size = max(size, 1)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
 
 
 def _clean_keys(keys_to_clean: list) -> None:
@@ -118,12 +477,119 @@ def _clean_keys(keys_to_clean: list) -> None:
 
 def memcached_client():
     """
-    Get memcached client
+    Get memcached client.
+    The client is created once per process and keeps a thread-safe pool of persistent connections,
+    so concurrent requests reuse sockets instead of opening a new connection for every call.
+    Operations failing on a broken or closed socket are retried on a fresh connection.
+    With many nodes or replicas configured, client of the cluster is returned.
+    With disk tier configured, memcached is backed by segments on local disk.
     Returns: memcached client
 
     """
-    try:
-        return Client((memcached_host, memcached_port))
-    except Exception as ex:
-        logger.error(f"Got error while connecting to memcached: {ex}")
-        raise MemcacheConnectionError(description=ex)
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                try:
+                    _client = _create_client()
+                except Exception as ex:
+                    logger.error(f"Got error while connecting to memcached: {ex}")
+                    raise MemcacheConnectionError(description=ex)
+    return _client
+
+
+def _create_client():
+    """
+    Create memcached client as per configuration
+    Returns: memcached client
+
+    """
+    servers = [_server(node) for node in config.memcached_nodes]
+    if len(servers) == 1 and config.memcached_replicas == 1:
+        client = _create_node_client(servers[0])
+    else:
+        logger.debug(f"Creating memcached cluster client for nodes {config.memcached_nodes} "
+                     f"with {config.memcached_replicas} replicas")
+        client = ClusterClient(servers, _create_node_client,
+                               replicas=config.memcached_replicas,
+                               retry_after=config.memcached_node_retry_seconds)
+    if not config.disk_tier_dir:
+        return client
+    logger.debug(f"Creating disk tier in {config.disk_tier_dir}")
+    return TieredClient(client, SegmentStore(config.disk_tier_dir,
+                                             segment_size=config.disk_tier_segment_size,
+                                             max_bytes=config.disk_tier_max_bytes))
+
+
+def _create_node_client(server: tuple) -> InstrumentedClient:
+    """
+    Create pooled memcached client of a node, latency of its operations is observed in metrics
+    Args:
+        server: (host, port) of node
+
+    Returns: memcached client
+
+    """
+    logger.debug(f"Creating memcached connection pool for {server[0]}:{server[1]} "
+                 f"with max size {config.memcached_pool_size}")
+    pooled_client = PipelinedClient(server,
+                                    max_pool_size=config.memcached_pool_size,
+                                    pool_idle_timeout=config.memcached_pool_idle_timeout,
+                                    connect_timeout=config.memcached_connect_timeout,
+                                    timeout=config.memcached_timeout,
+                                    no_delay=True)
+    # pooled client destroys a connection which failed, so a retry is done on a new socket
+    return InstrumentedClient(RetryingClient(pooled_client,
+                                             attempts=config.memcached_retry_attempts,
+                                             retry_for=[MemcacheUnexpectedCloseError, ConnectionError]))
+
+
+class PipelinedClient(PooledClient):
+    """Pooled memcached client which also touches many keys in a single round trip."""
+
+    def touch_many(self, keys, expire=0):
+        """
+        Touch keys with commands sent together on one connection, replies are read after all of them are sent
+        Args:
+            keys: list of keys
+            expire: seconds until keys expire, 0 for no expiry
+
+        Returns: set of touched keys, other keys are not present
+
+        """
+        if not keys:
+            return set()
+        with self.client_pool.get_and_release(destroy_on_fail=True) as client:
+            expire = client._check_integer(expire, 'expire')
+            commands = [b'touch ' + client.check_key(key) + b' ' + expire + b'\r\n' for key in keys]
+            replies = client._misc_cmd(commands, b'touch', False)
+        return {key for key, reply in zip(keys, replies) if reply == b'TOUCHED'}
+
+
+def _reset_after_fork() -> None:
+    """
+    Forget client and prefetch threads of parent process in a forked child, such as a worker of a prefork server.
+    Child creates its own on first use, so processes never share memcached sockets nor disk tier lock file.
+    Sockets of parent are not closed, as they are still used by parent.
+    """
+    global _client, _client_lock, _prefetch_executor, _prefetch_lock
+    _client = None
+    _client_lock = Lock()
+    _prefetch_executor = None
+    _prefetch_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _server(node: str) -> tuple:
+    """
+    Parse address of node
+    Args:
+        node: host:port of node
+
+    Returns: (host, port)
+
+    """
+    host, _, port = node.rpartition(':')
+    return host, int(port)
@@ -0,0 +1,25 @@
+"""
+Gunicorn settings of prefork serving.
+
+Usage:
+    $ cd app/
+    $ FLASK_APP=app.py flask db upgrade
+    $ gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# imported under another name, as module level names of this file are read as gunicorn settings
+import config as app_config
+
+bind = f'0.0.0.0:{app_config.port}'
+workers = app_config.workers
+# threads share a worker for requests waiting on memcached or database, processes hash uploads in parallel
+threads = app_config.worker_threads
+worker_class = 'gthread' if app_config.worker_threads > 1 else 'sync'
+timeout = app_config.worker_timeout
+# app is imported by each worker after fork, so that database engines and memcached pools are never shared
+preload_app = False
@@ -0,0 +1,233 @@
+"""Lightweight metrics of hot paths, exposed in Prometheus text format."""
+
+import sys
+import time
+from collections import Counter as _Tally, OrderedDict
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, get_ident
+from uuid import uuid4
+
+# Upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram(object):
+    """Thread-safe histogram of observed values by value of a label.
+
+    Args:
+        name: name of metric
+        help_text: description of metric
+        label: name of label
+        buckets: upper bounds of buckets, in increasing order
+    """
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        # label value -> [count of each bucket, sum, count]
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(self._series.items()):
+                label = f'{self.label}="{_escape(label_value)}"'
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total}')
+                lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+class Counter(object):
+    """Thread-safe counter, optionally by value of a label.
+
+    Args:
+        name: name of metric
+        help_text: description of metric
+        label: name of label, None for a single counter
+    """
+
+    def __init__(self, name: str, help_text: str, label: str = None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {} if label else {None: 0}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, label_value: str = None) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value: str = None) -> float:
+        with self._lock:
+            return self._values.get(label_value, 0)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_value, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+                label = f'{{{self.label}="{_escape(label_value)}"}}' if self.label else ''
+                lines.append(f'{self.name}{label} {value}')
+        return lines
+
+
+stage_seconds = Histogram('file_store_stage_seconds', 'Latency of stages of storing and reading files.', 'stage')
+memcached_seconds = Histogram('file_store_memcached_operation_seconds', 'Latency of memcached operations.',
+                              'operation')
+request_seconds = Histogram('file_store_http_request_seconds', 'Latency of HTTP requests.', 'endpoint')
+evicted_chunks = Counter('file_store_evicted_chunks_total', 'Chunks found evicted when they were read.')
+corrupt_chunks = Counter('file_store_corrupt_chunks_total', 'Chunks found corrupted when they were read.')
+rebuilt_chunks = Counter('file_store_rebuilt_chunks_total', 'Chunks rebuilt from parity chunks.')
+dedup_hits = Counter('file_store_dedup_hits_total', 'Uploads and checksum checks answered by a stored file.',
+                     'source')
+bytes_received = Counter('file_store_bytes_received_total', 'Bytes of request bodies.')
+bytes_sent = Counter('file_store_bytes_sent_total', 'Bytes of response bodies.')
+
+REGISTRY = (stage_seconds, memcached_seconds, request_seconds, evicted_chunks, corrupt_chunks, rebuilt_chunks,
+            dedup_hits, bytes_received, bytes_sent)
+
+
+@contextmanager
+def timed(stage: str, histogram: Histogram = stage_seconds):
+    """
+    Context manager observing time taken by its block
+    Args:
+        stage: label value of observation
+        histogram: histogram to observe time in, defaults to stage latency
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(stage, time.perf_counter() - start)
+
+
+def render(extra_lines: list = ()) -> str:
+    """
+    Get metrics in Prometheus text format
+    Args:
+        extra_lines: lines of other metrics to append
+
+    Returns: text of metrics
+
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedClient(object):
+    """Memcached client observing latency of each operation, with the client api of wrapped client.
+
+    Args:
+        client: memcached client
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                memcached_seconds.observe(name, time.perf_counter() - start)
+        return timed_call
+
+
+class SamplingProfiler(object):
+    """Profile of a single thread by sampling its stack at an interval, in collapsed stack format.
+
+    Args:
+        interval: seconds between samples
+        thread_id: id of thread to profile, defaults to current thread
+    """
+
+    def __init__(self, interval: float, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = thread_id or get_ident()
+        self.id = str(uuid4())
+        self.stacks = _Tally()
+        self._stopped = Event()
+        self._thread = Thread(target=self._sample, name='profiler', daemon=True)
+
+    def start(self) -> 'SamplingProfiler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> str:
+        """
+        Stop sampling
+        Returns: stacks with their number of samples, one per line, outermost frame first
+
+        """
+        self._stopped.set()
+        self._thread.join()
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+class ProfileStore(object):
+    """Most recent profiles by id.
+
+    Args:
+        max_profiles: number of profiles kept
+    """
+
+    def __init__(self, max_profiles: int):
+        self.max_profiles = max_profiles
+        self._profiles = OrderedDict()
+        self._lock = Lock()
+
+    def put(self, profile_id: str, profile: str) -> None:
+        with self._lock:
+            self._profiles[profile_id] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+profiles = ProfileStore(max_profiles=20)
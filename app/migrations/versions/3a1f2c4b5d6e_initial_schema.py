@@ -0,0 +1,39 @@
+"""initial schema
+
+Revision ID: 3a1f2c4b5d6e
+Revises: 
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a1f2c4b5d6e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('file',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('file_name', sa.String(length=496), nullable=False),
+    sa.Column('checksum', sa.String(length=496), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('file_part',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('checksum', sa.String(length=496), nullable=False),
+    sa.Column('memcached_key', sa.String(length=496), nullable=False),
+    sa.Column('sequence', sa.String(length=496), nullable=False),
+    sa.Column('file_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['file_id'], ['file.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('file_part')
+    op.drop_table('file')
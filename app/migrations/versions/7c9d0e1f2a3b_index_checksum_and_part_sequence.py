@@ -0,0 +1,48 @@
+"""index checksum and part sequence
+
+Revision ID: 7c9d0e1f2a3b
+Revises: 3a1f2c4b5d6e
+Create Date: 2026-10-17 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c9d0e1f2a3b'
+down_revision = '3a1f2c4b5d6e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # concurrent uploads could store same data twice, keep oldest record of such files
+    op.execute('DELETE FROM file_part WHERE file_id IN '
+               '(SELECT id FROM (SELECT f.id FROM file f JOIN file o '
+               'ON f.checksum = o.checksum AND f.id > o.id) AS duplicate)')
+    op.execute('DELETE FROM file WHERE id IN '
+               '(SELECT id FROM (SELECT f.id FROM file f JOIN file o '
+               'ON f.checksum = o.checksum AND f.id > o.id) AS duplicate)')
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.create_index('ix_file_checksum', ['checksum'], unique=True)
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.alter_column('sequence',
+                              existing_type=sa.String(length=496),
+                              type_=sa.Integer(),
+                              existing_nullable=False,
+                              postgresql_using='sequence::integer')
+        batch_op.create_index('ix_file_part_file_id_sequence', ['file_id', 'sequence'], unique=True)
+        batch_op.create_index('ix_file_part_memcached_key', ['memcached_key'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_index('ix_file_part_memcached_key')
+        batch_op.drop_index('ix_file_part_file_id_sequence')
+        batch_op.alter_column('sequence',
+                              existing_type=sa.Integer(),
+                              type_=sa.String(length=496),
+                              existing_nullable=False)
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.drop_index('ix_file_checksum')
@@ -0,0 +1,46 @@
+"""add upload sessions
+
+Revision ID: a5b6c7d8e9f0
+Revises: f4a5b6c7d8e9
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5b6c7d8e9f0'
+down_revision = 'f4a5b6c7d8e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_session',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('file_name', sa.String(length=496), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_upload_session_expires_at', 'upload_session', ['expires_at'], unique=False)
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.alter_column('file_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.add_column(sa.Column('upload_session_id', sa.String(length=36), nullable=True))
+        batch_op.add_column(sa.Column('upload_part', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_file_part_upload_session_id', 'upload_session',
+                                    ['upload_session_id'], ['id'], ondelete='CASCADE')
+        batch_op.create_index('ix_file_part_upload_session_id_upload_part_sequence',
+                              ['upload_session_id', 'upload_part', 'sequence'], unique=True)
+
+
+def downgrade():
+    op.execute('DELETE FROM file_part WHERE file_id IS NULL')
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_index('ix_file_part_upload_session_id_upload_part_sequence')
+        batch_op.drop_constraint('fk_file_part_upload_session_id', type_='foreignkey')
+        batch_op.drop_column('upload_part')
+        batch_op.drop_column('upload_session_id')
+        batch_op.alter_column('file_id', existing_type=sa.Integer(), nullable=False)
+    op.drop_index('ix_upload_session_expires_at', table_name='upload_session')
+    op.drop_table('upload_session')
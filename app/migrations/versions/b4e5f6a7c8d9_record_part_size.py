@@ -0,0 +1,26 @@
+"""record part size
+
+Revision ID: b4e5f6a7c8d9
+Revises: 7c9d0e1f2a3b
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e5f6a7c8d9'
+down_revision = '7c9d0e1f2a3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.add_column(sa.Column('size', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_column('size')
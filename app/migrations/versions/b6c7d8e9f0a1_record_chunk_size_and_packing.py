@@ -0,0 +1,30 @@
+"""record chunk size and packing
+
+Revision ID: b6c7d8e9f0a1
+Revises: a5b6c7d8e9f0
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6c7d8e9f0a1'
+down_revision = 'a5b6c7d8e9f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.add_column(sa.Column('chunk_size', sa.Integer(), nullable=True))
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.add_column(sa.Column('item_offset', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_column('item_offset')
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.drop_column('chunk_size')
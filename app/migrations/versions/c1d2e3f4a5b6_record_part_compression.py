@@ -0,0 +1,28 @@
+"""record part compression
+
+Revision ID: c1d2e3f4a5b6
+Revises: b4e5f6a7c8d9
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1d2e3f4a5b6'
+down_revision = 'b4e5f6a7c8d9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.add_column(sa.Column('codec', sa.String(length=16), nullable=True))
+        batch_op.add_column(sa.Column('stored_size', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_column('stored_size')
+        batch_op.drop_column('codec')
@@ -0,0 +1,27 @@
+"""drop part location
+
+Revision ID: c8d9e0f1a2b3
+Revises: b6c7d8e9f0a1
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8d9e0f1a2b3'
+down_revision = 'b6c7d8e9f0a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # location of chunk in disk tier changes as segments are written and dropped, disk tier keeps its own index
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_column('location')
+
+
+def downgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.add_column(sa.Column('location', sa.String(length=64), nullable=True))
@@ -0,0 +1,28 @@
+"""record parity parts
+
+Revision ID: d2e3f4a5b6c7
+Revises: c1d2e3f4a5b6
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2e3f4a5b6c7'
+down_revision = 'c1d2e3f4a5b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.add_column(sa.Column('parity', sa.Boolean(), nullable=False, server_default=sa.false()))
+        batch_op.add_column(sa.Column('parity_group', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file_part') as batch_op:
+        batch_op.drop_column('parity_group')
+        batch_op.drop_column('parity')
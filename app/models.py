@@ -1,33 +1,56 @@
 """Application models."""
 
 import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
+from threading import BoundedSemaphore, Lock
 
 from exception.memcache import MemcacheKeyNotFound, MemcacheKeyDataCorrupt
+from cache import file_cache
 from database import db
-from file_store import store, fetch, remove
+from chunking import content_defined_chunks
+from compression import compress, decompress
+from erasure import encode, decode
+from metrics import timed, evicted_chunks, corrupt_chunks, rebuilt_chunks
+from file_store import store, store_content_addressed, store_packed, is_content_addressed, is_shared, restore, fetch_many, iter_fetch, \
+    remove
+from slab_sizing import fitted_chunk_size
 from config import chunk_size, logger_name
+import config
 
 logger = logging.getLogger(logger_name)
 
+# Process wide pool of threads writing chunks of uploads. Built lazily by _writer().
+_write_executor = None
+_write_lock = Lock()
+
 
 class File(db.Model):
     """User-submitted file."""
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     file_name = db.Column(db.String(496), nullable=False)
-    checksum = db.Column(db.String(496))
-    parts = db.relationship('FilePart', backref='file', lazy=True)
+    checksum = db.Column(db.String(496), index=True, unique=True)
+    parts = db.relationship('FilePart', backref='file', lazy=True, order_by='FilePart.sequence')
+    # time in UTC at which scrubber last found every chunk of this file, None if it is not scrubbed yet
+    scrubbed_at = db.Column(db.DateTime)
+    # size in bytes data was split in when it was stored, None for files stored before it was recorded
+    chunk_size = db.Column(db.Integer)
 
-    def save(self, stream, checksum: str) -> list:
+    def save(self, stream) -> list:
         """Write contents for this file.
         stream is expected to be a file-like object.
         This method reads a file in parts and stores the contents and
-        metadata.
+        metadata. Stream is read only once, checksum of whole data is
+        calculated incrementally while chunks are stored.
+        Parts are not attached to this file, so that caller can insert them in bulk.
+        Chunk size is fitted to slab classes of memcached if adaptive chunk sizing is enabled,
+        size in use is recorded for this file.
 
         Args:
             stream: byte stream
-            checksum: checksum of data in stream
 
         Returns:
              parts: list of FilePart objects for each portion of the file written.
@@ -38,31 +61,94 @@ class File(db.Model):
 
         parts = []
         mem_cache_ids = []
+        # parts whose chunk is being written concurrently, in sequence order
+        in_flight = deque()
+        concurrent = config.store_concurrency > 1
+        # writes of this upload running at once in the pool shared by uploads of all threads
+        writers = BoundedSemaphore(config.store_concurrency)
+        # with erasure coding, parity chunks are written for every group of data chunks
+        group_size = config.erasure_data_chunks
+        group_chunks = []
+        parity_parts = []
+
+        def write(file_part, chunk: bytes) -> None:
+            if concurrent:
+                writers.acquire()
+                try:
+                    future = _writer().submit(_store_chunk, chunk, file_part.checksum)
+                except BaseException:
+                    writers.release()
+                    raise
+                future.add_done_callback(lambda _: writers.release())
+                in_flight.append((file_part, future))
+                if len(in_flight) >= config.store_max_in_flight:
+                    self.__class__._complete_write(*in_flight.popleft(), mem_cache_ids)
+            else:
+                self.__class__._complete_write(file_part, None, mem_cache_ids, chunk)
+
+        def write_parity() -> None:
+            with timed('erasure_encode'):
+                parity_chunks = encode(group_chunks, config.erasure_parity_chunks)
+            for parity_chunk in parity_chunks:
+                parity_part = FilePart(checksum=sha256(parity_chunk).hexdigest(),
+                                       size=len(parity_chunk),
+                                       parity=True,
+                                       parity_group=(len(parts) - 1) // group_size)
+                parity_parts.append(parity_part)
+                write(parity_part, parity_chunk)
+            group_chunks.clear()
+
         try:
-            logger.debug(f"Chunking data for file id {self.id}")
-            for chunk in self.__class__._read_stream(stream, chunk_size):
-                # we have already calculated file checksum earlier so we are
-                # going to use it instead of calculating a new one.
-                chunk_hash = sha256(chunk).hexdigest()
-                mem_id = store(chunk)
-                # store mem_cache_ids , this will be used to free memcached in case of exception
-                mem_cache_ids.append(mem_id)
+            logger.debug(f"Chunking data for file {self.file_name}")
+            self.chunk_size = fitted_chunk_size(chunk_size)
+            read_stream = content_defined_chunks if config.content_defined_chunking else self.__class__._read_stream
+            for chunk in read_stream(stream, self.chunk_size):
+                with timed('hash'):
+                    chunk_hash = sha256(chunk).hexdigest()
+                    stream_checksum.update(chunk)
+                # sequence is assigned in read order, so it does not depend on order in which writes complete
                 file_part = FilePart(checksum=chunk_hash,
-                                     memcached_key=mem_id,
                                      sequence=len(parts) + 1,
-                                     file_id=self.id)
+                                     size=len(chunk),
+                                     parity=False,
+                                     parity_group=len(parts) // group_size if group_size else None)
+                parts.append(file_part)
+                write(file_part, chunk)
+                if group_size:
+                    group_chunks.append(chunk)
+                    if len(group_chunks) == group_size:
+                        write_parity()
+            if group_chunks:
+                write_parity()
+            while in_flight:
+                self.__class__._complete_write(*in_flight.popleft(), mem_cache_ids)
+            # parity parts follow data parts
+            for file_part in parity_parts:
+                file_part.sequence = len(parts) + 1
                 parts.append(file_part)
-                stream_checksum.update(chunk)
             # After reading the entire stream, store the checksum of the data
-            self.checksum = checksum
+            self.checksum = stream_checksum.hexdigest()
         except Exception as ex:
             logger.error(ex)
+            # wait for writes still in flight, so that their keys are freed as well
+            for _, future in in_flight:
+                if future.exception() is None:
+                    mem_cache_ids.append(future.result()[0])
             # if any exception occurs free up memcached
             if len(mem_cache_ids) > 0:
-                remove(mem_cache_ids)
+                release_keys(mem_cache_ids)
             raise ex
         return parts
 
+    @property
+    def data_parts(self) -> list:
+        """Parts holding data of this file in sequence, without parity parts of erasure coding.
+
+        Returns:
+            list: FilePart objects
+        """
+        return [part for part in self.parts if not part.parity]
+
     @property
     def contents(self) -> bytes:
         """Retrieves the stored contents of this file.
@@ -72,21 +158,123 @@ class File(db.Model):
         Returns:
             bytes: content in byte
         """
-        parts = []
         logger.debug(f"Attempting to fetch content for id {self.id}")
-        for part in self.parts:
-            try:
-                memchached_part = fetch(part.memcached_key)
-                parts.append(memchached_part)
-                # match checksum of chunk with checksum in db
-                if not part.checksum == sha256(memchached_part).hexdigest():
+        return b''.join(self._iter_verified(self.data_parts, config.memcached_fetch_window))
+
+    def iter_contents(self):
+        """Generator over the stored contents of this file.
+        Chunks are verified against their checksum and yielded one at a time in sequence,
+        while following chunks are fetched in background.
+
+        Returns:
+            bytes: content of each chunk
+        """
+        logger.debug(f"Attempting to stream content for id {self.id}")
+        return self._iter_verified(self.data_parts)
+
+    @property
+    def size(self):
+        """Size of this file in bytes, None if size of a part is not recorded.
+
+        Returns:
+            int: size in bytes
+        """
+        sizes = [part.size for part in self.data_parts]
+        return None if None in sizes else sum(sizes)
+
+    def iter_range(self, start: int, stop: int):
+        """Generator over the stored contents of this file between two byte offsets.
+        Only chunks overlapping the range are fetched and verified.
+
+        Args:
+            start: offset of first byte
+            stop: offset after last byte
+
+        Returns:
+            bytes: content of range in each overlapping chunk
+        """
+        logger.debug(f"Attempting to stream bytes {start}-{stop} of content for id {self.id}")
+        offsets = []
+        parts = []
+        offset = 0
+        for part in self.data_parts:
+            if offset < stop and offset + part.size > start:
+                offsets.append(offset)
+                parts.append(part)
+            offset += part.size
+        for part_offset, chunk in zip(offsets, self._iter_verified(parts)):
+            yield chunk[max(start - part_offset, 0):stop - part_offset]
+
+    def _iter_verified(self, parts: list, window: int = None):
+        """Generator over verified chunks of supplied parts of this file.
+        With erasure coding, evicted or corrupted chunks are rebuilt from their group and written back.
+        Otherwise, or if a group has lost more chunks than it has parity chunks, whole file is removed
+        from memcached and database.
+
+        Args:
+            parts: list of FilePart objects of this file
+            window: number of chunks to fetch per round trip, defaults to configured prefetch window
+
+        Returns:
+            bytes: content of each chunk
+        """
+        # data chunks rebuilt by sequence
+        recovered = {}
+        try:
+            payloads = iter_fetch([part.memcached_key for part in parts], window, missing_ok=True)
+            for part, memchached_part in zip(parts, payloads):
+                chunk = self.__class__._verified(part, memchached_part)
+                if chunk is None:
+                    with timed('rebuild'):
+                        chunk = recovered.get(part.sequence) or self._recover(part, recovered)
+                yield chunk
+        except (MemcacheKeyNotFound, MemcacheKeyDataCorrupt) as ex:
+            # if any key is not found in memcached then remove whole file from memcached and from database
+            self._clean_keys()
+            self._delete_from_database()
+            raise ex
+
+    def _recover(self, file_part, recovered: dict) -> bytes:
+        """
+        Rebuild lost data chunks of group of part from remaining data and parity chunks.
+        Rebuilt data and parity chunks are written back to memcached.
+        Args:
+            file_part: FilePart whose chunk is evicted or corrupted
+            recovered: data chunks rebuilt by sequence, chunks of group are added to it
+
+        Returns: data of chunk of part
+
+        """
+        group = [part for part in self.parts if part.parity_group is not None
+                 and part.parity_group == file_part.parity_group]
+        data_parts = [part for part in group if not part.parity]
+        parity_parts = [part for part in group if part.parity]
+        if not parity_parts:
+            logger.error(f"Chunk {file_part.memcached_key} of file id {file_part.file_id} is evicted or corrupted")
+            raise MemcacheKeyNotFound(description=f"Key with id {file_part.memcached_key} could not be found "
+                                                  f"in memcached.")
+        logger.info(f"Rebuilding chunks of group {file_part.parity_group} of file id {file_part.file_id}")
+        chunks = [self.__class__._verified(part, payload, record=False)
+                  for part, payload in zip(group, fetch_many([part.memcached_key for part in group], missing_ok=True))]
+        data_chunks = chunks[:len(data_parts)]
+        parity_chunks = chunks[len(data_parts):]
+        try:
+            restored = decode(data_chunks, parity_chunks, [part.size for part in data_parts])
+        except ValueError as ex:
+            raise MemcacheKeyNotFound(description=f"File Part lost beyond recovery for file id "
+                                                  f"{file_part.file_id}: {ex}")
+        for part, chunk, stored_chunk in zip(data_parts, restored, data_chunks):
+            if stored_chunk is None:
+                if part.checksum != sha256(chunk).hexdigest():
                     raise MemcacheKeyDataCorrupt(description=f"File Part corrupt for file id {part.file_id}")
-            except (MemcacheKeyNotFound, MemcacheKeyDataCorrupt) as ex:
-                # if any key is not found in memcached then remove whole file from memcached and from database
-                self._clean_keys()
-                self._delete_from_database()
-                raise ex
-        return b''.join(parts)
+                self.__class__._write_back(part, chunk)
+                rebuilt_chunks.inc()
+                recovered[part.sequence] = chunk
+        if None in parity_chunks:
+            for part, chunk, stored_chunk in zip(parity_parts, encode(restored, len(parity_parts)), parity_chunks):
+                if stored_chunk is None and part.checksum == sha256(chunk).hexdigest():
+                    self.__class__._write_back(part, chunk)
+        return recovered[file_part.sequence]
 
     def _delete_from_database(self) -> None:
         """
@@ -96,26 +284,98 @@ class File(db.Model):
         """
         file_id = self.parts[0].file_id
         logger.debug(f"Attempting to delete file record from database for id {file_id}")
+        file_cache.invalidate(str(file_id))
         File.query.filter_by(id=file_id).delete()
         db.session.commit()
 
 
     def _clean_keys(self) -> None:
         """
-        Delete all keys from memcached for file
+        Delete all keys from memcached for file, except chunks shared with other files
         Returns: None
 
         """
         keys_to_clean = []
         logger.debug(f"Fetching all memcached keys to clean for id {self.id}")
+        file_cache.invalidate(str(self.id))
         for local_part in self.parts:
             keys_to_clean.append(local_part.memcached_key)
         try:
-            remove(keys_to_clean)
+            release_keys(keys_to_clean, self.id)
         except MemcacheKeyNotFound as ex:
             logger.error(f"Got Key error while deleting ids {keys_to_clean} in memcached: {ex}")
             pass
 
+    @staticmethod
+    def _complete_write(file_part, future, mem_cache_ids: list, chunk: bytes = None) -> None:
+        """
+        Set memcached key of part once its chunk is written.
+        Args:
+            file_part: FilePart for chunk
+            future: future of concurrent write, None to write chunk now
+            mem_cache_ids: list of written keys, this will be used to free memcached in case of exception
+            chunk: data of part, needed only if future is None
+
+        Returns: None
+
+        """
+        mem_id, codec, stored_size = future.result() if future is not None \
+            else _store_chunk(chunk, file_part.checksum)
+        mem_cache_ids.append(mem_id)
+        file_part.memcached_key = mem_id
+        file_part.codec = codec
+        file_part.stored_size = stored_size
+
+    @staticmethod
+    def _verified(file_part, payload: bytes, record: bool = True):
+        """
+        Decompress data of part stored in memcached and match it with checksum of part.
+        Data of a packed file is taken from its offset in item.
+        Args:
+            file_part: FilePart for chunk
+            payload: data stored in memcached, None if it is not present
+            record: if False evicted and corrupted chunks are not counted in metrics, for chunks checked again
+
+        Returns: data of chunk, None if it is not present or is corrupted
+
+        """
+        if payload is None:
+            if record:
+                evicted_chunks.inc()
+            return None
+        with timed('verify'):
+            try:
+                chunk = decompress(payload, file_part.codec)
+            except Exception as ex:
+                logger.error(f"Could not decompress chunk {file_part.memcached_key}: {ex}")
+                chunk = None
+            if chunk is not None and file_part.item_offset is not None:
+                chunk = chunk[file_part.item_offset:file_part.item_offset + file_part.size]
+            # match checksum of chunk with checksum in db
+            if chunk is not None and not file_part.checksum == sha256(chunk).hexdigest():
+                logger.error(f"Chunk {file_part.memcached_key} does not match its checksum")
+                chunk = None
+        if chunk is None and record:
+            corrupt_chunks.inc()
+        return chunk
+
+    @staticmethod
+    def _write_back(file_part, chunk: bytes) -> None:
+        """
+        Store rebuilt chunk of part under its key, encoded as recorded for part.
+        Args:
+            file_part: FilePart for chunk
+            chunk: data of chunk
+
+        Returns: None
+
+        """
+        payload, codec = compress(chunk, file_part.codec or 'none')
+        if codec != file_part.codec:
+            logger.error(f"Could not encode chunk {file_part.memcached_key} as {file_part.codec}, not restoring it")
+            return
+        restore(file_part.memcached_key, payload)
+
     @staticmethod
     def _read_stream(stream: bytes, segment_size: int) -> bytes:
         """Generator to read a file-like object in parts.
@@ -139,11 +399,182 @@ class File(db.Model):
             streamed_data = stream.read(segment_size)
 
 
+def release_keys(keys: list, file_id: int = None) -> None:
+    """
+    Delete keys from memcached, except packed items which are still referenced by parts of another file.
+    Chunks stored by checksum are never deleted here: an upload in flight may have found such a chunk
+    already stored and skipped writing it, and commit its parts only after this release. They are
+    reclaimed by the orphan pass of scrubber, once no part refers to them and they are idle.
+    Args:
+        keys: list of memcached keys
+        file_id: id of file keys belong to, None if file is not stored in database
+
+    Returns: None
+
+    """
+    keys = [key for key in dict.fromkeys(keys) if not is_content_addressed(key)]
+    shared_keys = [key for key in keys if is_shared(key)]
+    if shared_keys:
+        query = db.session.query(FilePart.memcached_key).filter(FilePart.memcached_key.in_(shared_keys))
+        if file_id is not None:
+            # parts of upload sessions have no file yet
+            query = query.filter(db.or_(FilePart.file_id != file_id, FilePart.file_id.is_(None)))
+        referenced = {key for key, in query.distinct()}
+        logger.debug(f"Keeping {len(referenced)} packed items referenced by other files")
+        keys = [key for key in keys if key not in referenced]
+    if keys:
+        remove(keys)
+
+
+def pack_files(files: list) -> list:
+    """
+    Store data of small files together, an item holds data of as many files as fit in a chunk.
+    So files don't cost a round trip each, nor a slab chunk each which is mostly empty.
+    Each file gets a single part, which records offset of its data in item.
+    Args:
+        files: list of (File, data) of files to store, checksum of each file is set
+
+    Returns:
+        parts: list of FilePart objects of each file, in order of files
+
+    """
+    item_size = fitted_chunk_size(chunk_size)
+    parts = []
+    mem_cache_ids = []
+    # parts and data of item being filled
+    item = []
+    try:
+        for user_file, data in files:
+            user_file.chunk_size = item_size
+            file_part = FilePart(checksum=user_file.checksum, sequence=1, size=len(data), parity=False)
+            if item and sum(len(item_data) for _, item_data in item) + len(data) > item_size:
+                _store_item(item, mem_cache_ids)
+                item = []
+            item.append((file_part, data))
+            parts.append([file_part])
+        if item:
+            _store_item(item, mem_cache_ids)
+    except Exception as ex:
+        logger.error(ex)
+        if len(mem_cache_ids) > 0:
+            release_keys(mem_cache_ids)
+        raise ex
+    return parts
+
+
+def _store_item(item: list, mem_cache_ids: list) -> None:
+    """
+    Store item holding data of packed files, and set its key and offset on part of each file.
+    Args:
+        item: list of (FilePart, data) of files in item
+        mem_cache_ids: list of written keys, this will be used to free memcached in case of exception
+
+    Returns: None
+
+    """
+    data = b''.join(file_data for _, file_data in item)
+    with timed('hash'):
+        item_hash = sha256(data).hexdigest()
+    mem_id, codec, stored_size = _store_chunk(data, item_hash, packed=True)
+    mem_cache_ids.append(mem_id)
+    logger.debug(f"Packed {len(item)} files in item {mem_id}")
+    offset = 0
+    for file_part, file_data in item:
+        file_part.memcached_key = mem_id
+        file_part.codec = codec
+        file_part.stored_size = stored_size
+        file_part.item_offset = offset
+        offset += len(file_data)
+
+
+def _store_chunk(chunk: bytes, chunk_hash: str, packed: bool = False) -> tuple:
+    """
+    Compress and store chunk in memcached as per configured mode
+    Args:
+        chunk: data of chunk
+        chunk_hash: checksum of chunk
+        packed: True if chunk is an item holding data of many files
+
+    Returns:
+        key: memcached key of chunk
+        codec: compression codec of stored data, None if chunk is stored raw
+        stored_size: size of stored data in bytes
+
+    """
+    with timed('compress'):
+        payload, codec = compress(chunk)
+    with timed('store'):
+        if config.content_addressed_chunks:
+            key = store_content_addressed(payload, chunk_hash, codec)
+        elif packed:
+            key = store_packed(payload)
+        else:
+            key = store(payload)
+    return key, codec, len(payload)
+
+
+def _writer() -> ThreadPoolExecutor:
+    """
+    Get executor for concurrent chunk writes.
+    Pool is shared by uploads of every thread serving requests, each of them running up to store
+    concurrency writes in it, so that an upload does not wait for writers taken by other uploads.
+    Returns: executor
+
+    """
+    global _write_executor
+    if _write_executor is None:
+        with _write_lock:
+            if _write_executor is None:
+                _write_executor = ThreadPoolExecutor(max_workers=config.store_writer_threads,
+                                                     thread_name_prefix='memcached-store')
+    return _write_executor
+
+
+def _reset_after_fork() -> None:
+    """Forget write threads of parent process in a forked child, threads don't survive a fork."""
+    global _write_executor, _write_lock
+    _write_executor = None
+    _write_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 class FilePart(db.Model):
     """Portion or chunk of a file."""
 
+    # parts of a file are listed in sequence order, this index also serves lookups by file id
+    __table_args__ = (db.Index('ix_file_part_file_id_sequence', 'file_id', 'sequence', unique=True),
+                      db.Index('ix_file_part_upload_session_id_upload_part_sequence',
+                               'upload_session_id', 'upload_part', 'sequence', unique=True))
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     checksum = db.Column(db.String(496), nullable=False)
-    memcached_key = db.Column(db.String(496), nullable=False)
-    sequence = db.Column(db.String(496), nullable=False)
-    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), nullable=False)
+    memcached_key = db.Column(db.String(496), nullable=False, index=True)
+    sequence = db.Column(db.Integer, nullable=False)
+    # size of chunk in bytes, not recorded for parts stored before it was added
+    size = db.Column(db.Integer)
+    # compression codec of data stored in memcached, None if it is stored raw
+    codec = db.Column(db.String(16))
+    # size of data stored in memcached in bytes
+    stored_size = db.Column(db.Integer)
+    # True for parity chunks of erasure coding, which follow data chunks in sequence
+    parity = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    # group of data and parity chunks which can rebuild each other, None without erasure coding
+    parity_group = db.Column(db.Integer)
+    # offset of data of a packed file in item shared with other files, None if chunk holds data of this file only
+    item_offset = db.Column(db.Integer)
+    # None while part belongs to an upload session which is not committed
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'))
+    upload_session_id = db.Column(db.String(36), db.ForeignKey('upload_session.id', ondelete='CASCADE'))
+    # number of part of upload session in which chunk was sent, sequence is counted within it
+    upload_part = db.Column(db.Integer)
+
+
+class UploadSession(db.Model):
+    """Upload of a file in numbered parts, which are stored as they arrive and form a file once committed."""
+
+    id = db.Column(db.String(36), primary_key=True)
+    file_name = db.Column(db.String(496), nullable=False)
+    # time in UTC after which an abandoned session and its chunks are reclaimed, extended by each part
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
@@ -0,0 +1,223 @@
+"""Background scrubbing of stored files, reclaiming files whose chunks are evicted and chunks no file refers to."""
+
+import logging
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from threading import Event, Thread
+
+import config
+from cache import file_cache
+from database import db
+from file_store import live_keys, idle_keys, recently_accessed, remove
+from models import File, FilePart, UploadSession, release_keys
+
+logger = logging.getLogger(config.logger_name)
+
+
+class Scrubber(object):
+    """Walk stored files in batches, off the request path.
+
+    Chunks of each batch of files are checked with pipelined touches. Files which lost more chunks than
+    their parity chunks can rebuild are removed along with their remaining chunks, live files are
+    marked as scrubbed, so that uploads of same data can trust them without checking their chunks.
+    Part rows of removed files, upload sessions which expired and stored keys no part refers to
+    are reclaimed as well.
+
+    Args:
+        app: flask app, scrubbing runs in its app context
+        batch_size: number of files or keys handled per batch
+        orphan_idle_seconds: stored keys not referred by any part are removed once idle for these seconds
+    """
+
+    def __init__(self, app, batch_size: int = None, orphan_idle_seconds: float = None):
+        self.app = app
+        self.batch_size = max(batch_size or config.scrub_batch_size, 1)
+        self.orphan_idle_seconds = orphan_idle_seconds if orphan_idle_seconds is not None \
+            else config.scrub_orphan_idle_seconds
+        self.last_pass = {}
+        self._stopped = Event()
+
+    def run(self) -> dict:
+        """
+        Do a single pass over files, parts and stored keys
+        Returns: dict of counters and rates of pass
+
+        """
+        with self.app.app_context():
+            try:
+                stats = self.scrub_files()
+                stats.update(self.reclaim_dead_parts())
+                stats.update(self.reclaim_expired_sessions())
+                stats.update(self.reclaim_orphan_keys())
+            finally:
+                db.session.remove()
+        self.last_pass = stats
+        logger.info(f"Scrubbed {stats['files']} files in {stats['files_seconds']}s "
+                     f"({stats['files_per_second']} files/s, {stats['parts_per_second']} parts/s), "
+                     f"removed {stats['dead_files']} dead files, {stats['dead_parts']} dead parts, "
+                     f"{stats['expired_sessions']} expired upload sessions "
+                     f"and {stats['orphan_keys']} of {stats['idle_keys']} idle keys "
+                     f"({stats['keys_per_second']} keys/s)")
+        return stats
+
+    def scrub_files(self) -> dict:
+        """
+        Check chunks of every file, remove files which can't be read anymore
+        Returns: dict of counters and rates
+
+        """
+        counters = Counter()
+        started = time.perf_counter()
+        last_id = 0
+        while True:
+            files = File.query.filter(File.id > last_id).order_by(File.id).limit(self.batch_size).all()
+            if not files:
+                break
+            last_id = files[-1].id
+            file_ids = [file.id for file in files]
+            parts_by_file = defaultdict(list)
+            for part in FilePart.query.filter(FilePart.file_id.in_(file_ids)):
+                parts_by_file[part.file_id].append(part)
+            live = live_keys([part.memcached_key for parts in parts_by_file.values() for part in parts])
+            dead_ids = [file_id for file_id in file_ids if not readable(parts_by_file[file_id], live)]
+            dead_keys = [part.memcached_key for file_id in dead_ids for part in parts_by_file[file_id]]
+            if dead_ids:
+                logger.debug(f"Removing file ids {dead_ids} whose chunks are evicted")
+                FilePart.query.filter(FilePart.file_id.in_(dead_ids)).delete(synchronize_session=False)
+                File.query.filter(File.id.in_(dead_ids)).delete(synchronize_session=False)
+            live_ids = [file_id for file_id in file_ids if file_id not in dead_ids]
+            if live_ids:
+                File.query.filter(File.id.in_(live_ids)).update({File.scrubbed_at: datetime.utcnow()},
+                                                                synchronize_session=False)
+            db.session.commit()
+            # keys are released once rows are gone, so dead files of batch don't keep each other's shared keys
+            for file_id in dead_ids:
+                file_cache.invalidate(str(file_id))
+            if dead_keys:
+                release_keys(dead_keys)
+            counters['files'] += len(file_ids)
+            counters['parts'] += sum(len(parts) for parts in parts_by_file.values())
+            counters['dead_files'] += len(dead_ids)
+        elapsed = time.perf_counter() - started
+        return {'files': counters['files'], 'parts': counters['parts'], 'dead_files': counters['dead_files'],
+                'files_seconds': round(elapsed, 3),
+                'files_per_second': round(counters['files'] / elapsed, 1) if elapsed else 0,
+                'parts_per_second': round(counters['parts'] / elapsed, 1) if elapsed else 0}
+
+    def reclaim_dead_parts(self) -> dict:
+        """
+        Remove parts whose file or upload session no longer exists, with their chunks
+        Returns: dict of counters
+
+        """
+        dead_parts = 0
+        orphaned = db.and_(~db.exists().where(File.id == FilePart.file_id),
+                           ~db.exists().where(UploadSession.id == FilePart.upload_session_id))
+        while True:
+            parts = FilePart.query.filter(orphaned).order_by(FilePart.id).limit(self.batch_size).all()
+            if not parts:
+                break
+            release_keys([part.memcached_key for part in parts])
+            FilePart.query.filter(FilePart.id.in_([part.id for part in parts])).delete(synchronize_session=False)
+            db.session.commit()
+            dead_parts += len(parts)
+        return {'dead_parts': dead_parts}
+
+    def reclaim_expired_sessions(self) -> dict:
+        """
+        Remove upload sessions which are not committed in time, with their parts and chunks
+        Returns: dict of counters
+
+        """
+        expired = 0
+        while True:
+            session_ids = [session_id for session_id, in db.session.query(UploadSession.id)
+                           .filter(UploadSession.expires_at < datetime.utcnow()).limit(self.batch_size)]
+            if not session_ids:
+                break
+            parts = FilePart.query.filter(FilePart.upload_session_id.in_(session_ids))
+            keys = [key for key, in parts.with_entities(FilePart.memcached_key)]
+            parts.delete(synchronize_session=False)
+            UploadSession.query.filter(UploadSession.id.in_(session_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            if keys:
+                release_keys(keys)
+            logger.debug(f"Removed expired upload sessions {session_ids}")
+            expired += len(session_ids)
+        return {'expired_sessions': expired}
+
+    def reclaim_orphan_keys(self) -> dict:
+        """
+        Remove idle stored keys which no part refers to, left behind by uploads which were interrupted.
+        Last access of keys is read again right before they are deleted, so a key which an upload in flight
+        has just found stored, and will refer to once it commits, is kept.
+        Returns: dict of counters and rates
+
+        """
+        idle = orphans = 0
+        started = time.perf_counter()
+        keys = list(dict.fromkeys(idle_keys(self.orphan_idle_seconds)))
+        for index in range(0, len(keys), self.batch_size):
+            window = keys[index:index + self.batch_size]
+            referenced = {key for key, in db.session.query(FilePart.memcached_key)
+                          .filter(FilePart.memcached_key.in_(window))}
+            orphan_keys = [key for key in window if key not in referenced]
+            if orphan_keys:
+                accessed = recently_accessed(orphan_keys, self.orphan_idle_seconds)
+                orphan_keys = [key for key in orphan_keys if key not in accessed]
+            if orphan_keys:
+                logger.debug(f"Removing {len(orphan_keys)} keys which no file refers to")
+                remove(orphan_keys)
+            idle += len(window)
+            orphans += len(orphan_keys)
+        elapsed = time.perf_counter() - started
+        return {'idle_keys': idle, 'orphan_keys': orphans,
+                'keys_per_second': round(idle / elapsed, 1) if elapsed else 0}
+
+    def start(self, interval: float) -> Thread:
+        """
+        Run passes in a daemon thread
+        Args:
+            interval: seconds between end of a pass and start of next one
+
+        Returns: thread of scrubber
+
+        """
+        thread = Thread(target=self._loop, args=(interval,), name='scrubber', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _loop(self, interval: float) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run()
+            except Exception as ex:
+                logger.error(f"Scrubber pass failed: {ex}")
+            self._stopped.wait(interval)
+
+
+def readable(parts: list, live: set) -> bool:
+    """
+    Check if data of file can be read with live chunks, evicted chunks of a parity group
+    can be rebuilt as long as no more of them are lost than the group has parity chunks.
+    Args:
+        parts: FilePart objects of file
+        live: keys which are present
+
+    Returns: True if file can be read
+
+    """
+    missing = Counter()
+    parity = Counter()
+    for part in parts:
+        if part.parity:
+            parity[part.parity_group] += 1
+        if part.memcached_key not in live:
+            if part.parity_group is None:
+                return False
+            missing[part.parity_group] += 1
+    return all(count <= parity[group] for group, count in missing.items())
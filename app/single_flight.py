@@ -0,0 +1,61 @@
+"""Coalescing of concurrent calls doing the same work."""
+
+from threading import Event, Lock
+
+
+class _Call(object):
+    """Call in flight, result or error of which is shared with waiting callers."""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run a function once for concurrent callers using the same key.
+
+    First caller for a key runs the function, callers arriving while it runs wait for it
+    and get its result, or have its exception raised. Once the call completes, next caller
+    for the key runs the function again, so results are never served stale.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function):
+        """
+        Run function for key, or wait for concurrent call for same key
+        Args:
+            key: key identifying the work done by function
+            function: callable taking no arguments
+
+        Returns: result of function
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
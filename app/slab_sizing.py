@@ -0,0 +1,137 @@
+"""Sizing of chunks to fit slab classes of memcached."""
+
+import logging
+import os
+import time
+from threading import Lock
+
+import config
+from file_store import memcached_client
+
+logger = logging.getLogger(config.logger_name)
+
+# Bytes an item takes in its slab chunk besides its value: item header with CAS, longest key written by
+# file_store, client flags and line ending. Kept a little generous, so items never spill into next class.
+ITEM_OVERHEAD_BYTES = 144
+# Size of item header of memcached, smallest slab class holds it and minimum item space.
+ITEM_HEADER_BYTES = 48
+# Slab class sizes of memcached are aligned to these many bytes.
+CHUNK_ALIGN_BYTES = 8
+
+# Slab class sizes of each memcached node and monotonic time they were read at, read by fitted_chunk_size().
+_node_classes = None
+_read_at = None
+_read_lock = Lock()
+
+
+def fitted_chunk_size(target: int) -> int:
+    """
+    Get size of chunks to split data in.
+    With adaptive chunk sizing, chunks are sized so that an item of a full chunk fills a slab class of
+    memcached, at the class closest to target. Slab classes are read from stats of memcached nodes at
+    first use and again once refresh interval has passed.
+    Args:
+        target: configured chunk size in bytes
+
+    Returns: chunk size in bytes, target if adaptive chunk sizing is disabled or stats can't be read
+
+    """
+    global _node_classes, _read_at
+    if not config.adaptive_chunk_size:
+        return target
+    if _read_at is None or time.monotonic() - _read_at >= config.chunk_size_refresh_seconds:
+        # a single thread reads stats, others keep using classes read before unless there are none yet
+        if _read_lock.acquire(blocking=_read_at is None):
+            try:
+                if _read_at is None or time.monotonic() - _read_at >= config.chunk_size_refresh_seconds:
+                    _node_classes = _read_classes() or _node_classes
+                    _read_at = time.monotonic()
+            finally:
+                _read_lock.release()
+    if not _node_classes:
+        return target
+    # nodes are usually configured alike, otherwise smallest size fits a class closely on most of them
+    return min(fit_chunk_size(target, classes) for classes in _node_classes)
+
+
+def fit_chunk_size(target: int, classes: list) -> int:
+    """
+    Get chunk size closest to target whose items fill a slab class exactly, so stored chunks don't waste slab memory.
+    Args:
+        target: wanted chunk size in bytes
+        classes: chunk sizes of slab classes of a memcached node
+
+    Returns: chunk size in bytes, target if no class holds more than item overhead
+
+    """
+    sizes = sorted(size - ITEM_OVERHEAD_BYTES for size in classes if size > ITEM_OVERHEAD_BYTES)
+    if not sizes:
+        return target
+    return min(sizes, key=lambda size: abs(size - target))
+
+
+def slab_classes(settings: dict, slabs: dict = None) -> list:
+    """
+    Get chunk sizes of slab classes of a memcached node.
+    Classes are derived from settings the way memcached builds them, classes listed by stats slabs are
+    added, as only classes holding items are listed there.
+    Args:
+        settings: result of stats settings
+        slabs: result of stats slabs
+
+    Returns: ascending chunk sizes in bytes, empty if settings don't have item size max
+
+    """
+    settings = _parse(settings)
+    classes = {int(value) for name, value in _parse(slabs or {}).items() if name.endswith(':chunk_size')}
+    if 'item_size_max' not in settings:
+        return sorted(classes)
+    # items larger than slab chunk max are chained from chunks of largest class
+    largest = int(settings.get('slab_chunk_max', settings['item_size_max']))
+    factor = float(settings.get('growth_factor', 1.25))
+    size = ITEM_HEADER_BYTES + int(settings.get('chunk_size', 48))
+    while size < largest / factor:
+        size = -(-size // CHUNK_ALIGN_BYTES) * CHUNK_ALIGN_BYTES
+        classes.add(size)
+        size = int(size * factor)
+    classes.add(largest)
+    return sorted(classes)
+
+
+def _read_classes():
+    """
+    Read slab classes of every memcached node
+    Returns: list of chunk sizes of slab classes of each node, None if stats can't be read
+
+    """
+    try:
+        client = memcached_client()
+        settings = client.stats('settings')
+        slabs = client.stats('slabs')
+    except Exception as ex:
+        logger.error(f"Could not read slab classes of memcached, keeping chunk size: {ex}")
+        return None
+    if settings and all(isinstance(value, dict) for value in settings.values()):
+        # cluster client lists stats by node
+        node_classes = [slab_classes(node_settings, slabs.get(node)) for node, node_settings in settings.items()]
+    else:
+        node_classes = [slab_classes(settings, slabs)]
+    node_classes = [classes for classes in node_classes if classes]
+    logger.info(f"Read slab classes of {len(node_classes)} memcached nodes, largest chunk sizes are "
+                f"{[classes[-1] for classes in node_classes]}")
+    return node_classes or None
+
+
+def _parse(stats: dict) -> dict:
+    # pymemcache returns names as bytes, and values as bytes unless it knows their type
+    return {(name.decode() if isinstance(name, bytes) else name): (value.decode() if isinstance(value, bytes) else value)
+            for name, value in stats.items()}
+
+
+def _reset_after_fork() -> None:
+    """Forget lock of parent process in a forked child, it may have been held by a thread which does not survive fork."""
+    global _read_lock
+    _read_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,11 +1,20 @@
 #!flask/bin/python
 from unittest import TestCase
 import sys, os
+import tarfile
 from unittest.mock import patch, MagicMock
 
 sys.path.append(os.path.abspath(os.path.join('..')))
 
-from app import liveness_check, health_check, get_files
+from datetime import datetime, timedelta
+from hashlib import sha256
+from io import BytesIO
+
+from app import app, create_app, liveness_check, health_check, get_files, post_files, _store_files
+from cache import ByteLRUCache
+from database import db
+from exception.memcache import MemcacheKeyNotFound
+from models import File, FilePart, UploadSession
 from werkzeug.exceptions import HTTPException
 
 
@@ -14,6 +23,13 @@ class AppTests(TestCase):
     def test_startup(self):
         self.assertEqual(liveness_check(), "OK")
 
+    def test_create_app(self):
+        other_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        self.assertIsNot(other_app, app)
+        self.assertEqual(other_app.config['SQLALCHEMY_DATABASE_URI'], 'sqlite://')
+        self.assertIn('scrub', other_app.cli.commands)
+        self.assertEqual(other_app.test_client().get('/api/liveness').data, b'OK')
+
     def test_health_check(self):
         with patch('app.db.session.execute', return_value=None):
             mock = MagicMock()
@@ -39,3 +55,504 @@ class AppTests(TestCase):
             query_mock.get_or_404.return_value = data_mock
             self.assertEqual(get_files('2'), "test data")
 
+
+    def test_get_files_streamed(self):
+        query_mock = MagicMock()
+        data_mock = MagicMock(id=2, size=9)
+        data_mock.iter_contents.return_value = iter([b"test ", b"data"])
+        cache = ByteLRUCache(max_bytes=100, max_entry_bytes=100, ttl=60)
+        with patch('app.File') as mock_obj, patch('app.config.stream_downloads', True), patch('app.file_cache', cache):
+            mock_obj.query = query_mock
+            query_mock.get_or_404.return_value = data_mock
+            with app.test_request_context():
+                response = get_files('2')
+                self.assertEqual(response.headers['Content-Length'], '9')
+                self.assertEqual(b''.join(response.response), b"test data")
+                # file cached by streaming is served with its length too
+                response = get_files('2')
+                self.assertEqual(response.headers['Content-Length'], '9')
+                self.assertEqual(b''.join(response.response), b"test data")
+        query_mock.get_or_404.assert_called_once()
+
+    def test_get_files_streamed_without_size(self):
+        query_mock = MagicMock()
+        data_mock = MagicMock(id=2, size=None)
+        data_mock.iter_contents.return_value = iter([b"test ", b"data"])
+        with patch('app.File') as mock_obj, patch('app.config.stream_downloads', True):
+            mock_obj.query = query_mock
+            query_mock.get_or_404.return_value = data_mock
+            with app.test_request_context():
+                response = get_files('2')
+                self.assertNotIn('Content-Length', response.headers)
+                self.assertEqual(b''.join(response.response), b"test data")
+
+    def test_post_files_duplicate_discards_chunks(self):
+        part = MagicMock(memcached_key='key-1')
+        existing = MagicMock(id=7)
+        with patch('app.File') as mock_obj, patch('app._file_record', return_value=existing), \
+                patch('app.release_keys') as release_mock, patch('app.db') as db_mock:
+            mock_obj.return_value.save.return_value = [part]
+            with app.test_request_context(method='POST', data={'file-1': (BytesIO(b"test data"), 'test.txt')}):
+                self.assertEqual(post_files(), '7')
+        release_mock.assert_called_once_with(['key-1'])
+        db_mock.session.commit.assert_not_called()
+
+    def test_get_files_served_from_cache(self):
+        query_mock = MagicMock()
+        data_mock = MagicMock(id=2)
+        data_mock.contents = b"test data"
+        cache = ByteLRUCache(max_bytes=100, max_entry_bytes=100, ttl=60)
+        with patch('app.File') as mock_obj, patch('app.file_cache', cache):
+            mock_obj.query = query_mock
+            query_mock.get_or_404.return_value = data_mock
+            self.assertEqual(get_files('2'), b"test data")
+            self.assertEqual(get_files('2'), b"test data")
+        query_mock.get_or_404.assert_called_once()
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+class StoredFilesTestCase(TestCase):
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.chunks = {}
+        self.fetched = []
+        self.patches = [patch('models.store', side_effect=self._store),
+                        patch('models.remove', side_effect=self._remove),
+                        patch('app.live_keys', side_effect=lambda keys: set(keys) & set(self.chunks)),
+                        patch('models.iter_fetch', side_effect=self._iter_fetch),
+                        patch('app.iter_fetch', side_effect=self._iter_fetch),
+                        patch('models.fetch_many',
+                              side_effect=lambda keys, missing_ok=False: list(self._iter_fetch(keys, None, missing_ok))),
+                        patch('models.restore', side_effect=self.chunks.__setitem__),
+                        patch('models.chunk_size', 4),
+                        patch('models.config.store_concurrency', 1)]
+        for mock_patch in self.patches:
+            mock_patch.start()
+
+    def tearDown(self):
+        for mock_patch in self.patches:
+            mock_patch.stop()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def _store(self, chunk):
+        key = f'key-{len(self.chunks)}'
+        self.chunks[key] = chunk
+        return key
+
+    def _remove(self, keys):
+        for key in keys:
+            self.chunks.pop(key, None)
+
+    def _iter_fetch(self, keys, window=None, missing_ok=False):
+        self.fetched.extend(keys)
+        if not missing_ok and not set(keys) <= set(self.chunks):
+            raise MemcacheKeyNotFound(description="Key not found")
+        return iter([self.chunks.get(key) for key in keys])
+
+    def _post(self, data: dict) -> str:
+        with app.test_request_context(method='POST', data={
+                file_id: (BytesIO(content), f'{file_id}.txt') for file_id, content in data.items()}):
+            return post_files()
+
+
+class PostFilesTests(StoredFilesTestCase):
+
+    def test_files_are_stored_in_single_commit(self):
+        with patch.object(db.session, 'commit', wraps=db.session.commit) as commit_mock:
+            ids = self._post({'a': b'first file', 'b': b'second file', 'c': b'first file'}).split(',')
+        commit_mock.assert_called_once()
+        self.assertEqual(ids[0], ids[2])
+        self.assertEqual(File.query.count(), 2)
+        self.assertEqual(len(File.query.get(int(ids[1])).parts), 3)
+        # chunks of data supplied twice are discarded
+        self.assertEqual(len(self.chunks), 6)
+
+    def test_failure_stores_nothing(self):
+        with patch('app._insert_files', side_effect=Exception("Mock exception")):
+            with self.assertRaises(HTTPException):
+                self._post({'a': b'first file', 'b': b'second file'})
+        self.assertEqual(File.query.count(), 0)
+        self.assertEqual(self.chunks, {})
+
+    def test_failed_upload_keeps_content_addressed_chunks(self):
+        def store_content_addressed(chunk, checksum, codec):
+            self.chunks.setdefault(f'sha256:{checksum}', chunk)
+            return f'sha256:{checksum}'
+
+        with patch('models.config.content_addressed_chunks', True), \
+                patch('models.store_content_addressed', side_effect=store_content_addressed):
+            # upload in flight finds chunks stored, and commits after a failed upload of same data
+            in_flight = File(file_name='z')
+            parts = in_flight.save(BytesIO(b'first file'))
+            with patch('app._insert_files', side_effect=Exception("Mock exception")):
+                with self.assertRaises(HTTPException):
+                    self._post({'y': b'first file'})
+            file_ids = _store_files({in_flight.checksum: (in_flight, parts)})
+        self.assertEqual(app.test_client().get(f'/api/files/{file_ids[in_flight.checksum]}').data, b'first file')
+
+    def test_stored_file_is_reused(self):
+        first_id = self._post({'a': b'first file'})
+        self.assertEqual(self._post({'b': b'first file'}), first_id)
+        self.assertEqual(len(self.chunks), 3)
+
+    def test_concurrently_stored_file_is_reused(self):
+        first_id = self._post({'a': b'first file'})
+        # other request stores same data after the check of this request
+        with patch('app._file_record', return_value=None):
+            ids = self._post({'b': b'first file', 'c': b'second file'}).split(',')
+        self.assertEqual(ids[0], first_id)
+        self.assertEqual(File.query.count(), 2)
+        self.assertEqual(len(self.chunks), 6)
+
+
+class GetFileRangeTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.file_id = self._post({'a': b'0123456789abcdef'})
+
+    def _get(self, headers: dict):
+        return app.test_client().get(f'/api/files/{self.file_id}', headers=headers)
+
+    def test_range_fetches_overlapping_chunks(self):
+        response = self._get({'Range': 'bytes=5-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b'56789')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 5-9/16')
+        self.assertEqual(response.headers['Content-Length'], '5')
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_suffix_range(self):
+        response = self._get({'Range': 'bytes=-3'})
+        self.assertEqual(response.data, b'def')
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_unsatisfiable_range(self):
+        response = self._get({'Range': 'bytes=20-30'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */16')
+
+    def test_if_range(self):
+        checksum = File.query.get(int(self.file_id)).checksum
+        self.assertEqual(self._get({'Range': 'bytes=0-1', 'If-Range': f'"{checksum}"'}).status_code, 206)
+        response = self._get({'Range': 'bytes=0-1', 'If-Range': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'0123456789abcdef')
+
+
+class CompressedFilesTests(StoredFilesTestCase):
+
+    def test_compressed_file_round_trip(self):
+        data = b'compressible ' * 1000
+        with patch('models.chunk_size', 4000), patch('models.config.chunk_compression', 'zlib'):
+            file_id = self._post({'a': data})
+        parts = File.query.get(int(file_id)).parts
+        self.assertEqual({part.codec for part in parts}, {'zlib'})
+        self.assertLess(sum(part.stored_size for part in parts), len(data) / 10)
+        self.assertEqual(app.test_client().get(f'/api/files/{file_id}').data, data)
+        self.assertEqual(app.test_client().get(f'/api/files/{file_id}', headers={'Range': 'bytes=3999-4011'}).data,
+                         data[3999:4012])
+
+
+class ErasureCodedFilesTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = b'0123456789abcdefghij'
+        with patch('models.config.erasure_data_chunks', 2), patch('models.config.erasure_parity_chunks', 1):
+            self.file_id = self._post({'a': self.data})
+        self.parts = File.query.get(int(self.file_id)).parts
+
+    def test_parity_parts_follow_data_parts(self):
+        self.assertEqual([part.parity for part in self.parts], [False] * 5 + [True] * 3)
+        self.assertEqual([part.parity_group for part in self.parts], [0, 0, 1, 1, 2, 0, 1, 2])
+        self.assertEqual(len(self.chunks), 8)
+
+    def test_evicted_chunks_are_rebuilt(self):
+        del self.chunks[self.parts[1].memcached_key]
+        self.chunks[self.parts[2].memcached_key] = b'xxxx'
+        self.assertEqual(app.test_client().get(f'/api/files/{self.file_id}').data, self.data)
+        # rebuilt chunks are written back
+        self.assertEqual(self.chunks[self.parts[1].memcached_key], b'4567')
+        self.assertEqual(self.chunks[self.parts[2].memcached_key], b'89ab')
+
+    def test_upload_reuses_file_with_rebuildable_chunks(self):
+        del self.chunks[self.parts[1].memcached_key]
+        client = app.test_client()
+        self.assertEqual(client.get(f'/api/checksums/{sha256(self.data).hexdigest()}').data.decode(), self.file_id)
+        with patch('models.config.erasure_data_chunks', 2), patch('models.config.erasure_parity_chunks', 1):
+            self.assertEqual(self._post({'b': self.data}), self.file_id)
+        self.assertEqual(client.get(f'/api/files/{self.file_id}').data, self.data)
+
+    def test_chunks_lost_beyond_recovery(self):
+        del self.chunks[self.parts[0].memcached_key]
+        del self.chunks[self.parts[5].memcached_key]
+        self.assertEqual(app.test_client().get(f'/api/files/{self.file_id}').status_code, 404)
+        self.assertIsNone(File.query.get(int(self.file_id)))
+
+
+class PackedFilesTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patches += [patch('models.store_packed', side_effect=self._store_packed),
+                         patch('models.chunk_size', 16),
+                         patch('app.config.pack_max_file_size', 8)]
+        for mock_patch in self.patches[-3:]:
+            mock_patch.start()
+
+    def _store_packed(self, item):
+        key = f'pack:{len(self.chunks)}'
+        self.chunks[key] = item
+        return key
+
+    def test_small_files_share_an_item(self):
+        ids = self._post({'a': b'first', 'b': b'second', 'c': b'0123456789abcdefg', 'd': b'first'}).split(',')
+        self.assertEqual(ids[0], ids[3])
+        first, second, large = (File.query.get(int(file_id)) for file_id in ids[:3])
+        self.assertEqual(first.parts[0].memcached_key, second.parts[0].memcached_key)
+        self.assertTrue(first.parts[0].memcached_key.startswith('pack:'))
+        self.assertEqual([first.parts[0].item_offset, second.parts[0].item_offset], [0, 5])
+        self.assertEqual([part.item_offset for part in large.parts], [None, None])
+        self.assertEqual({first.chunk_size, second.chunk_size, large.chunk_size}, {16})
+        client = app.test_client()
+        self.assertEqual(client.get(f'/api/files/{ids[1]}').data, b'second')
+        self.assertEqual(client.get(f'/api/files/{ids[1]}', headers={'Range': 'bytes=1-3'}).data, b'eco')
+        self.assertEqual(client.get(f'/api/files/{ids[2]}').data, b'0123456789abcdefg')
+
+    def test_items_hold_files_up_to_chunk_size(self):
+        self._post({'a': b'aaaaaaaa', 'b': b'bbbbbbbb', 'c': b'cccc'})
+        self.assertEqual(sorted(self.chunks.values()), [b'aaaaaaaabbbbbbbb', b'cccc'])
+
+    def test_item_is_kept_while_a_file_uses_it(self):
+        ids = self._post({'a': b'first', 'b': b'second'}).split(',')
+        key = File.query.get(int(ids[0])).parts[0].memcached_key
+        self.chunks[key] = b'lost'
+        self.assertEqual(app.test_client().get(f'/api/files/{ids[0]}').status_code, 404)
+        # item is still referenced by other file
+        self.assertIn(key, self.chunks)
+
+
+class ScrubbedFilesTests(StoredFilesTestCase):
+
+    def test_recently_scrubbed_file_is_trusted(self):
+        first_id = self._post({'a': b'first file'})
+        File.query.get(int(first_id)).scrubbed_at = datetime.utcnow()
+        db.session.commit()
+        with patch('app.live_keys') as live_mock:
+            self.assertEqual(self._post({'b': b'first file'}), first_id)
+        live_mock.assert_not_called()
+
+    def test_file_scrubbed_long_ago_is_checked(self):
+        first_id = self._post({'a': b'first file'})
+        File.query.get(int(first_id)).scrubbed_at = datetime.utcnow() - timedelta(days=1)
+        db.session.commit()
+        with patch('app.live_keys', side_effect=set) as live_mock:
+            self.assertEqual(self._post({'b': b'first file'}), first_id)
+        live_mock.assert_called_once()
+
+
+class UploadSessionTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = app.test_client()
+        self.session_id = self.client.post('/api/uploads?file_name=big.bin').get_json()['id']
+
+    def _put(self, number: int, data: bytes):
+        return self.client.put(f'/api/uploads/{self.session_id}/parts/{number}', data=data)
+
+    def _commit(self, query: str = ''):
+        return self.client.post(f'/api/uploads/{self.session_id}/commit{query}')
+
+    def test_part_past_max_file_size_is_not_stored(self):
+        megabyte = 1024 * 1024
+        with patch('app.config.max_file_size', 1), patch('models.chunk_size', megabyte // 4):
+            self.assertEqual(self._put(1, bytes(megabyte + 1)).status_code, 413)
+            self.assertEqual(self.chunks, {})
+            self.assertEqual(self._put(1, bytes(megabyte // 2)).status_code, 200)
+            self.assertEqual(self._put(2, bytes(megabyte // 2 + 1)).status_code, 413)
+            # body sent without length is rejected once it is read past max size
+            response = self.client.put(f'/api/uploads/{self.session_id}/parts/2',
+                                       input_stream=BytesIO(bytes(megabyte // 2 + 1)),
+                                       environ_overrides={'wsgi.input_terminated': True, 'CONTENT_LENGTH': ''})
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(len(self.chunks), 2)
+            # part sent again replaces its earlier size
+            self.assertEqual(self._put(1, bytes(megabyte // 2 + 1)).status_code, 200)
+            self.assertEqual(self._put(2, bytes(megabyte // 2 - 1)).status_code, 200)
+
+    def test_parts_sent_out_of_order(self):
+        self.assertEqual(self._put(2, b'second part').get_json()['size'], 11)
+        self._put(1, b'first part, ')
+        self.assertEqual([part['number'] for part in self.client.get(f'/api/uploads/{self.session_id}')
+                         .get_json()['parts']], [1, 2])
+        file_id = self._commit('?parts=2').data.decode()
+        self.assertEqual(self.client.get(f'/api/files/{file_id}').data, b'first part, second part')
+        self.assertEqual(File.query.get(int(file_id)).checksum, sha256(b'first part, second part').hexdigest())
+        self.assertEqual(self.client.get(f'/api/uploads/{self.session_id}').status_code, 404)
+
+    def test_part_sent_again_replaces_earlier_one(self):
+        self._put(1, b'broken')
+        self._put(1, b'fixed')
+        self.assertEqual(len(self.chunks), 2)
+        file_id = self._commit().data.decode()
+        self.assertEqual(self.client.get(f'/api/files/{file_id}').data, b'fixed')
+
+    def test_missing_part(self):
+        self._put(1, b'first')
+        self._put(3, b'third')
+        response = self._commit()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'[2]', response.data)
+        self.assertEqual(self._commit('?parts=4').status_code, 400)
+
+    def test_stored_data_is_reused(self):
+        first_id = self._post({'a': b'same data'})
+        self._put(1, b'same data')
+        self.assertEqual(self._commit().data.decode(), first_id)
+        self.assertEqual(len(self.chunks), 3)
+        self.assertEqual(UploadSession.query.count(), 0)
+
+    def test_evicted_part_is_sent_again(self):
+        self._put(1, b'first')
+        self._put(2, b'second')
+        self.chunks[sorted(self.chunks)[-1]] = b'lost'
+        response = self._commit()
+        self.assertEqual(response.status_code, 409)
+        self.assertIn(b'Part 2', response.data)
+        self._put(2, b'second')
+        self.assertEqual(self._commit().status_code, 200)
+
+    def test_parity_groups_are_numbered_across_parts(self):
+        with patch('models.config.erasure_data_chunks', 2):
+            self._put(1, b'0123456789')
+            self._put(2, b'abcdefgh')
+        parts = File.query.get(int(self._commit().data.decode())).parts
+        # part 1 has groups of chunks 0123, 4567 and 89, part 2 a group of chunks abcd and efgh
+        self.assertEqual([part.sequence for part in parts], list(range(1, 9)))
+        self.assertEqual([part.parity_group for part in parts], [0, 0, 1, 2, 2, 0, 1, 2])
+
+    def test_expired_session(self):
+        UploadSession.query.get(self.session_id).expires_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(self._put(1, b'late').status_code, 404)
+
+    def test_delete_session(self):
+        self._put(1, b'first')
+        self.assertEqual(self.client.delete(f'/api/uploads/{self.session_id}').status_code, 200)
+        self.assertEqual(self.chunks, {})
+        self.assertEqual(FilePart.query.count(), 0)
+
+
+class ChecksumTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = app.test_client()
+        self.file_id = self._post({'a': b'first file'})
+        self.checksum = sha256(b'first file').hexdigest()
+
+    def test_stored_checksum(self):
+        response = self.client.get(f'/api/checksums/{self.checksum.upper()}?size=10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode(), self.file_id)
+        self.assertEqual(self.client.get(f'/api/checksums/{self.checksum}?size=11').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/checksums/{sha256(b"other").hexdigest()}').status_code, 404)
+        self.assertEqual(self.client.get('/api/checksums/abc').status_code, 400)
+
+    def test_evicted_file_is_not_reused(self):
+        self.chunks.clear()
+        self.assertEqual(self.client.get(f'/api/checksums/{self.checksum}').status_code, 404)
+        self.assertEqual(File.query.count(), 0)
+
+    def test_batch(self):
+        response = self.client.post('/api/checksums', json={'files': [
+            {'sha256': sha256(b'other').hexdigest()},
+            {'sha256': self.checksum, 'size': 10},
+            {'sha256': self.checksum, 'size': 11}]})
+        self.assertEqual(response.get_json(), {'ids': [None, int(self.file_id), None]})
+        self.assertEqual(self.client.post('/api/checksums', json={'files': [{'sha256': 'abc'}]}).status_code, 400)
+        self.assertEqual(self.client.post('/api/checksums', json={}).status_code, 400)
+
+
+class BatchDownloadTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = app.test_client()
+        self.ids = [int(file_id) for file_id in self._post({'a': b'first file', 'b': b'second file'}).split(',')]
+
+    def _entries(self, file_ids: list) -> dict:
+        response = self.client.post('/api/files/batch', json={'ids': file_ids})
+        self.assertEqual(response.status_code, 200)
+        with tarfile.open(fileobj=BytesIO(response.data), mode='r:') as archive:
+            return {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+
+    def test_files_are_streamed_in_tar(self):
+        with patch('app.iter_fetch', side_effect=self._iter_fetch) as fetch_mock:
+            entries = self._entries([self.ids[1], 1000, self.ids[0]])
+        self.assertEqual(list(entries), [f'{self.ids[1]}/b', '1000.error', f'{self.ids[0]}/a'])
+        self.assertEqual(entries[f'{self.ids[1]}/b'], b'second file')
+        self.assertEqual(entries[f'{self.ids[0]}/a'], b'first file')
+        # chunks of all files are fetched together
+        fetch_mock.assert_called_once()
+
+    def test_evicted_file_is_reported_inline(self):
+        self.chunks[File.query.get(self.ids[0]).parts[0].memcached_key] = b'lost'
+        entries = self._entries(self.ids)
+        self.assertEqual(entries[f'{self.ids[0]}.error'], b'Data has been evicted or is corrupted.')
+        self.assertEqual(entries[f'{self.ids[1]}/b'], b'second file')
+        self.assertIsNone(File.query.get(self.ids[0]))
+
+    def test_invalid_ids(self):
+        self.assertEqual(self.client.post('/api/files/batch', json={'ids': ['a']}).status_code, 400)
+
+    def test_file_names_cant_escape_entry_directory(self):
+        posted = self._post({'../../etc/passwd': b'third file', '..': b'fourth file'})
+        file_ids = [int(file_id) for file_id in posted.split(',')]
+        entries = self._entries(file_ids)
+        self.assertEqual(list(entries), [f'{file_ids[0]}/etc_passwd', f'{file_ids[1]}/{file_ids[1]}'])
+
+class MetricsTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = app.test_client()
+
+    def test_metrics(self):
+        file_id = self._post({'a': b'first file'})
+        self._post({'b': b'first file'})
+        response = self.client.get(f'/api/files/{file_id}')
+        self.assertEqual(response.data, b'first file')
+        # latency of streamed responses is observed once server closes them
+        response.close()
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        text = response.data.decode()
+        self.assertIn('file_store_stage_seconds_count{stage="hash"}', text)
+        self.assertIn('file_store_stage_seconds_count{stage="commit"}', text)
+        self.assertIn('file_store_http_request_seconds_count{endpoint="api.get_files"}', text)
+        self.assertIn('file_store_dedup_hits_total{source="upload"}', text)
+        self.assertIn('file_store_file_cache_hits', text)
+        self.assertIn('file_store_single_flight_calls{flight="downloads"}', text)
+
+    def test_profile(self):
+        file_id = self._post({'a': b'first file'})
+        with patch('app.config.profiling_enabled', False):
+            self.assertNotIn('X-Profile-Id', self.client.get(f'/api/files/{file_id}',
+                                                               headers={'X-Profile': '1'}).headers)
+        with patch('app.config.profiling_enabled', True):
+            self.assertNotIn('X-Profile-Id', self.client.get(f'/api/files/{file_id}').headers)
+            response = self.client.get(f'/api/files/{file_id}', headers={'X-Profile': '1'})
+            response.close()
+        profile_id = response.headers['X-Profile-Id']
+        self.assertEqual(self.client.get(f'/api/profiles/{profile_id}').status_code, 200)
+        self.assertEqual(self.client.get('/api/profiles/unknown').status_code, 404)
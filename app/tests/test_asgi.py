@@ -0,0 +1,140 @@
+from unittest import TestCase
+import sys, os
+import asyncio
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from async_file_store import AsyncMemcachedClient, iter_fetch_windows
+from asgi import app as asgi_app
+from exception.memcache import MemcacheKeyNotFound
+from models import File
+from test_app import StoredFilesTestCase
+
+
+async def _serve_memcached(data: dict, commands: list):
+    """Start memcached stand-in answering get commands from data."""
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            commands.append(line)
+            for key in line.split()[1:]:
+                if key.decode() in data:
+                    value = data[key.decode()]
+                    writer.write(b'VALUE %s 0 %d\r\n%s\r\n' % (key, len(value), value))
+            writer.write(b'END\r\n')
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+class AsyncMemcachedClientTests(TestCase):
+
+    def setUp(self):
+        self.data = {'a': b'first', 'b': b'second', 'c': b'third'}
+        self.commands = []
+
+    def _run(self, test):
+        async def run():
+            server = await _serve_memcached(self.data, self.commands)
+            try:
+                return await test(server.sockets[0].getsockname())
+            finally:
+                server.close()
+        return asyncio.run(run())
+
+    def test_get_many(self):
+        async def test(address):
+            client = AsyncMemcachedClient([address])
+            found = await client.get_many(['a', 'x', 'b'])
+            # connection is reused for next request
+            found.update(await client.get_many(['c']))
+            client.close()
+            return found
+
+        self.assertEqual(self._run(test), self.data)
+        self.assertEqual(self.commands, [b'get a x b\r\n', b'get c\r\n'])
+
+    def test_failing_node_is_a_miss(self):
+        async def test(address):
+            return await AsyncMemcachedClient([('127.0.0.1', 1)]).get_many(['a'])
+
+        self.assertEqual(self._run(test), {})
+
+    def test_iter_fetch_windows(self):
+        async def test(address):
+            with patch('async_file_store.config.memcached_nodes', [f'{address[0]}:{address[1]}']):
+                return [window async for window in iter_fetch_windows(['a', 'x', 'b', 'c'], window=2, ahead=1)]
+
+        self.assertEqual(self._run(test), [[b'first', None], [b'second', b'third']])
+
+
+class AsgiAppTests(StoredFilesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patches.append(patch('asgi.iter_fetch_windows', side_effect=self._iter_fetch_windows))
+        self.patches[-1].start()
+
+    async def _iter_fetch_windows(self, keys, window=None, ahead=None):
+        self.fetched.extend(keys)
+        yield [self.chunks.get(key) for key in keys]
+
+    def _request(self, method: str, path: str, body: bytes = b'', headers: list = ()) -> tuple:
+        messages = []
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(body)
+                return {'type': 'http.request', 'body': body}
+            # client stays connected until response is sent
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'root_path': '',
+                 'headers': list(headers), 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+        asyncio.run(asgi_app(scope, receive, send))
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def test_download(self):
+        file_id = self._post({'a': b'first file'})
+        self.assertEqual(self._request('GET', f'/api/files/{file_id}'), (200, b'first file'))
+        self.assertEqual(self._request('GET', '/api/files/999')[0], 404)
+
+    def test_evicted_chunk_is_read_by_model(self):
+        file_id = self._post({'a': b'first file'})
+        parts = File.query.get(int(file_id)).parts
+        self.chunks[parts[0].memcached_key] = b'lost'
+        self.assertEqual(self._request('GET', f'/api/files/{file_id}')[0], 404)
+        self.assertIsNone(File.query.get(int(file_id)))
+
+    def test_response_is_aborted_once_started(self):
+        file_id = self._post({'a': b'first file'})
+        parts = File.query.get(int(file_id)).parts
+        self.chunks[parts[1].memcached_key] = b'lost'
+        with self.assertRaises(MemcacheKeyNotFound):
+            self._request('GET', f'/api/files/{file_id}')
+
+    def test_evicted_chunk_is_rebuilt(self):
+        with patch('models.config.erasure_data_chunks', 2), patch('models.config.erasure_parity_chunks', 1):
+            file_id = self._post({'a': b'0123456789abcdefghij'})
+        parts = File.query.get(int(file_id)).parts
+        del self.chunks[parts[1].memcached_key]
+        self.assertEqual(self._request('GET', f'/api/files/{file_id}'), (200, b'0123456789abcdefghij'))
+        self.assertEqual(self.chunks[parts[1].memcached_key], b'4567')
+
+    def test_other_requests_are_served_by_flask_app(self):
+        body = (b'--b\r\nContent-Disposition: form-data; name="a"; filename="a.txt"\r\n\r\n'
+                b'first file\r\n--b--\r\n')
+        status, file_id = self._request('POST', '/api/files', body, [(b'content-type', b'multipart/form-data; boundary=b'),
+                                                                     (b'content-length', str(len(body)).encode())])
+        self.assertEqual(status, 200)
+        self.assertEqual(File.query.get(int(file_id)).file_name, 'a')
+        self.assertEqual(self._request('GET', f'/api/files/{file_id.decode()}', headers=[(b'range', b'bytes=0-4')]),
+                         (206, b'first'))
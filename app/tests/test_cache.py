@@ -0,0 +1,49 @@
+from unittest import TestCase
+import sys, os
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from cache import ByteLRUCache
+
+
+class ByteLRUCacheTests(TestCase):
+
+    def test_evicts_least_recently_used_by_size(self):
+        cache = ByteLRUCache(max_bytes=10, max_entry_bytes=10, ttl=60)
+        cache.put('a', b'aaaa', 4)
+        cache.put('b', b'bbbb', 4)
+        self.assertEqual(cache.get('a'), b'aaaa')
+        cache.put('c', b'cccc', 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'aaaa')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+    def test_large_values_are_not_cached(self):
+        cache = ByteLRUCache(max_bytes=10, max_entry_bytes=5, ttl=60)
+        cache.put('a', b'aaaaaa', 6)
+        self.assertIsNone(cache.get('a'))
+
+    def test_entries_expire(self):
+        cache = ByteLRUCache(max_bytes=10, max_entry_bytes=10, ttl=60)
+        with patch('cache.time.monotonic', return_value=0):
+            cache.put('a', b'aaaa', 4)
+        with patch('cache.time.monotonic', return_value=61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_invalidate(self):
+        cache = ByteLRUCache(max_bytes=10, max_entry_bytes=10, ttl=60)
+        cache.put('a', b'aaaa', 4)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_disabled_cache(self):
+        cache = ByteLRUCache(max_bytes=0, max_entry_bytes=0, ttl=60)
+        cache.put('a', b'', 0)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 0)
@@ -0,0 +1,29 @@
+from unittest import TestCase
+import sys, os
+from io import BytesIO
+from random import Random
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from chunking import content_defined_chunks
+
+
+class ContentDefinedChunksTests(TestCase):
+
+    def setUp(self):
+        self.data = Random(7).getrandbits(8 * 200000).to_bytes(200000, 'big')
+
+    def test_chunks_join_to_data(self):
+        chunks = list(content_defined_chunks(BytesIO(self.data), 8000))
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertTrue(all(len(chunk) <= 8000 for chunk in chunks))
+        self.assertTrue(all(len(chunk) >= 1000 for chunk in chunks[:-1]))
+
+    def test_boundaries_resync_after_insertion(self):
+        chunks = list(content_defined_chunks(BytesIO(self.data), 8000))
+        edited = self.data[:5000] + b'inserted' + self.data[5000:]
+        edited_chunks = list(content_defined_chunks(BytesIO(edited), 8000))
+        self.assertGreaterEqual(len(set(chunks) & set(edited_chunks)), len(chunks) - 2)
+
+    def test_empty_stream(self):
+        self.assertEqual(list(content_defined_chunks(BytesIO(b''), 8000)), [])
@@ -0,0 +1,138 @@
+from unittest import TestCase
+import sys, os
+from collections import Counter
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from cluster import ClusterClient
+from exception.memcache import MemcacheConnectionError
+
+
+class FakeNode(object):
+    """In-process memcached node, failing with connection error while down."""
+
+    def __init__(self, server):
+        self.server = server
+        self.data = {}
+        self.down = False
+        self.commands = Counter()
+
+    def _command(self, name):
+        if self.down:
+            raise ConnectionRefusedError(f"{self.server} is down")
+        self.commands[name] += 1
+
+    def set(self, key, value, expire=0, noreply=None, flags=None):
+        self._command('set')
+        self.data[key] = value
+        return True
+
+    def get(self, key):
+        self._command('get')
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        self._command('get_many')
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def touch(self, key, expire=0, noreply=None):
+        self._command('touch')
+        return key in self.data
+
+    def touch_many(self, keys, expire=0):
+        self._command('touch_many')
+        return {key for key in keys if key in self.data}
+
+    def delete_many(self, keys, noreply=None):
+        self._command('delete_many')
+        for key in keys:
+            self.data.pop(key, None)
+        return True
+
+    def version(self):
+        self._command('version')
+        return b'1.6.0'
+
+
+class ClusterClientTests(TestCase):
+
+    def setUp(self):
+        self.nodes = {}
+        servers = [('localhost', 11211 + index) for index in range(4)]
+        self.client = ClusterClient(servers, self._node, replicas=2, retry_after=60)
+
+    def _node(self, server):
+        self.nodes[server] = FakeNode(server)
+        return self.nodes[server]
+
+    def _holders(self, key):
+        return [node for node in self.nodes.values() if key in node.data]
+
+    def test_keys_are_replicated_and_spread(self):
+        for index in range(400):
+            self.client.set(f'key-{index}', b'data')
+        self.assertTrue(all(len(self._holders(f'key-{index}')) == 2 for index in range(400)))
+        # every node holds a fair share of keys
+        self.assertTrue(all(100 < len(node.data) < 300 for node in self.nodes.values()))
+
+    def test_placement_is_consistent(self):
+        other = ClusterClient(list(self.nodes), FakeNode, replicas=2)
+        self.assertEqual([node.name for node in self.client.replica_nodes('key')],
+                         [node.name for node in other.replica_nodes('key')])
+
+    def test_reads_survive_node_failure(self):
+        keys = [f'key-{index}' for index in range(50)]
+        for key in keys:
+            self.client.set(key, key.encode())
+        down = self.client.replica_nodes(keys[0])[0]
+        self.nodes[down.server].down = True
+        self.assertEqual(self.client.get(keys[0]), keys[0].encode())
+        self.assertEqual(self.client.get_many(keys), {key: key.encode() for key in keys})
+        self.assertFalse(self.client.health()[down.name]['up'])
+
+    def test_read_falls_back_to_replica_on_miss(self):
+        self.client.set('key', b'data')
+        first = self.client.replica_nodes('key')[0]
+        del self.nodes[first.server].data['key']
+        self.assertEqual(self.client.get_many(['key']), {'key': b'data'})
+        self.assertTrue(self.client.touch('key'))
+
+    def test_touch_many_sends_one_touch_per_node(self):
+        keys = [f'key-{index}' for index in range(50)]
+        for key in keys[:40]:
+            self.client.set(key, key.encode())
+        first = self.client.replica_nodes(keys[0])[0]
+        del self.nodes[first.server].data[keys[0]]
+        self.assertEqual(self.client.touch_many(keys), set(keys[:40]))
+        self.assertEqual([node.commands['touch_many'] for node in self.nodes.values()], [1] * 4)
+
+    def test_keys_of_down_node_miss_without_replicas(self):
+        servers = [('localhost', 11211 + index) for index in range(3)]
+        client = ClusterClient(servers, self._node, replicas=1, retry_after=60)
+        keys = [f'key-{index}' for index in range(50)]
+        for key in keys:
+            client.set(key, key.encode())
+        down = client.replica_nodes(keys[0])[0]
+        self.nodes[down.server].down = True
+        served = [key for key in keys if client.replica_nodes(key)[0] is not down]
+        # node is marked down by first read, later reads skip it
+        for _ in range(2):
+            self.assertEqual(client.get_many(keys), {key: key.encode() for key in served})
+            self.assertEqual(client.touch_many(keys), set(served))
+            self.assertIsNone(client.get(keys[0]))
+            self.assertFalse(client.touch(keys[0]))
+
+    def test_delete_removes_all_replicas(self):
+        self.client.set('key', b'data')
+        self.client.delete_many(['key'])
+        self.assertEqual(self._holders('key'), [])
+
+    def test_no_healthy_node(self):
+        for node in self.nodes.values():
+            node.down = True
+        with self.assertRaises(MemcacheConnectionError):
+            self.client.set('key', b'data')
+        with self.assertRaises(MemcacheConnectionError):
+            self.client.version()
+        with self.assertRaises(MemcacheConnectionError):
+            self.client.get_many(['key'])
@@ -0,0 +1,31 @@
+from unittest import TestCase
+import sys, os
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from compression import compress, decompress
+
+
+class CompressionTests(TestCase):
+
+    def setUp(self):
+        self.text = b''.join(f'2026-10-17 INFO request {i} served in {i % 97} ms\n'.encode() for i in range(5000))
+
+    def test_round_trip(self):
+        for codec in ('zlib', 'lzma'):
+            payload, used_codec = compress(self.text, codec, 6)
+            self.assertEqual(used_codec, codec)
+            self.assertLess(len(payload), len(self.text) / 4)
+            self.assertEqual(decompress(payload, used_codec), self.text)
+
+    def test_incompressible_chunk_is_stored_raw(self):
+        chunk = os.urandom(100000)
+        self.assertEqual(compress(chunk, 'zlib', 6), (chunk, None))
+
+    def test_no_compression(self):
+        self.assertEqual(compress(self.text, 'none', 6), (self.text, None))
+        self.assertEqual(decompress(self.text, None), self.text)
+
+    def test_unsupported_codec(self):
+        with self.assertRaises(ValueError):
+            compress(self.text, 'snappy', 6)
@@ -0,0 +1,150 @@
+from unittest import TestCase
+import sys, os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from cluster import ClusterClient
+from disk_tier import SegmentStore, TieredClient
+
+
+class SegmentStoreTests(TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.store = self._open()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _open(self, segment_size=1000, max_bytes=10000):
+        return SegmentStore(self.directory.name, segment_size=segment_size, max_bytes=max_bytes)
+
+    def test_round_trip(self):
+        self.store.set('a', b'first')
+        self.store.set('b', b'second')
+        self.assertEqual(self.store.get_many(['a', 'b', 'c']), {'a': b'first', 'b': b'second'})
+        self.assertTrue(self.store.touch('a'))
+        self.assertFalse(self.store.touch('c'))
+
+    def test_delete(self):
+        self.store.set('a', b'first')
+        self.store.delete_many(['a'])
+        self.assertIsNone(self.store.get('a'))
+        self.assertIsNone(self._open().get('a'))
+
+    def test_index_is_rebuilt_from_segments(self):
+        self.store.set('a', b'first')
+        self.store.set('a', b'updated')
+        self.assertEqual(self._open().get('a'), b'updated')
+
+    def test_records_of_other_store_are_found(self):
+        other = self._open()
+        other.set('a', b'first')
+        self.assertEqual(self.store.get('a'), b'first')
+
+    def test_segments_are_scanned_only_after_other_writers(self):
+        other = self._open()
+        with patch.object(self.store, '_scan', wraps=self.store._scan) as scan_mock:
+            self.store.set('a', b'first')
+            self.store.get_many(['a', 'missing'])
+            scan_mock.assert_not_called()
+            other.set('b', b'second')
+            self.store.set('c', b'third')
+            self.assertEqual(scan_mock.call_count, 1)
+        self.assertEqual(self.store.get_many(['a', 'b', 'c']), {'a': b'first', 'b': b'second', 'c': b'third'})
+        self.assertEqual(other.get_many(['a', 'c']), {'a': b'first', 'c': b'third'})
+
+    def test_segments_dropped_by_other_store_are_forgotten(self):
+        store = self._open(segment_size=1000, max_bytes=2500)
+        other = self._open(segment_size=1000, max_bytes=2500)
+        store.set('key-0', bytes(500))
+        for index in range(1, 10):
+            other.set(f'key-{index}', bytes(500))
+        self.assertIsNone(store.get('key-0'))
+        self.assertEqual(store.get('key-9'), bytes(500))
+
+    def test_torn_record_is_ignored(self):
+        self.store.set('a', b'first')
+        path = os.path.join(self.directory.name, 'segment-000001.dat')
+        with open(path, 'ab') as segment_file:
+            segment_file.write(b'\x00' * 5)
+        store = self._open()
+        store.set('b', b'second')
+        self.assertEqual(self._open().get_many(['a', 'b']), {'a': b'first', 'b': b'second'})
+
+    def test_oldest_segments_are_dropped(self):
+        store = self._open(segment_size=1000, max_bytes=2500)
+        for index in range(10):
+            store.set(f'key-{index}', bytes(500))
+        self.assertLessEqual(store.stats()['bytes'], 2500)
+        self.assertIsNone(store.get('key-0'))
+        self.assertEqual(store.get('key-9'), bytes(500))
+
+
+class TieredClientTests(TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.memory = MagicMock()
+        self.memory.get_many.return_value = {}
+        self.disk = SegmentStore(self.directory.name, segment_size=1000, max_bytes=10000)
+        self.client = TieredClient(self.memory, self.disk)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_set_writes_both_tiers(self):
+        self.client.set('a', b'first')
+        self.memory.set.assert_called_once()
+        self.assertEqual(self.disk.get('a'), b'first')
+
+    def test_evicted_chunk_is_promoted(self):
+        self.client.set('a', b'first')
+        self.memory.get_many.return_value = {'b': b'second'}
+        self.assertEqual(self.client.get_many(['a', 'b']), {'a': b'first', 'b': b'second'})
+        self.memory.set.assert_called_with('a', b'first')
+        self.assertEqual(self.disk.stats()['promotions'], 1)
+
+    def test_touch_promotes_evicted_chunk(self):
+        self.client.set('a', b'first')
+        self.memory.set.reset_mock()
+        self.memory.touch.return_value = False
+        self.assertTrue(self.client.touch('a'))
+        self.memory.set.assert_called_once_with('a', b'first')
+        self.assertFalse(self.client.touch('b'))
+
+    def test_touch_many_promotes_evicted_chunks(self):
+        self.client.set('a', b'first')
+        self.client.set('b', b'second')
+        self.memory.set.reset_mock()
+        self.memory.touch_many.return_value = {'a'}
+        self.assertEqual(self.client.touch_many(['a', 'b', 'c']), {'a', 'b'})
+        self.memory.set.assert_called_once_with('b', b'second')
+        self.memory.touch_many.side_effect = ConnectionRefusedError()
+        self.assertEqual(self.client.touch_many(['a', 'c']), {'a'})
+
+    def test_chunks_are_served_while_every_cluster_node_is_down(self):
+        def down_node(server):
+            node = MagicMock()
+            for method in ('set', 'get', 'get_many', 'touch', 'touch_many', 'delete_many'):
+                getattr(node, method).side_effect = ConnectionRefusedError(f"{server} is down")
+            return node
+
+        cluster = ClusterClient([('localhost', 11211), ('localhost', 11212)], down_node, replicas=2, retry_after=60)
+        client = TieredClient(cluster, self.disk)
+        self.assertTrue(client.set('a', b'first'))
+        # nodes are marked down by now, cluster fails without calling them
+        self.assertTrue(client.set('b', b'second'))
+        self.assertEqual(client.get_many(['a', 'b', 'c']), {'a': b'first', 'b': b'second'})
+        self.assertEqual(client.get('a'), b'first')
+        self.assertTrue(client.touch('a'))
+        self.assertEqual(client.touch_many(['a', 'c']), {'a'})
+
+    def test_chunks_are_served_while_memcached_fails(self):
+        self.memory.set.side_effect = ConnectionRefusedError()
+        self.memory.get_many.side_effect = ConnectionRefusedError()
+        self.assertTrue(self.client.set('a', b'first'))
+        self.assertEqual(self.client.get('a'), b'first')
+        self.assertTrue(self.client.touch('a'))
@@ -0,0 +1,34 @@
+from unittest import TestCase
+import sys, os
+from itertools import combinations
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from erasure import encode, decode
+
+
+class ErasureTests(TestCase):
+
+    def setUp(self):
+        self.chunks = [os.urandom(1000), os.urandom(1000), os.urandom(1000), os.urandom(321)]
+        self.sizes = [len(chunk) for chunk in self.chunks]
+        self.parity = encode(self.chunks, 2)
+
+    def test_parity_is_as_long_as_longest_chunk(self):
+        self.assertEqual([len(chunk) for chunk in self.parity], [1000, 1000])
+
+    def test_any_two_lost_chunks_are_recovered(self):
+        group = self.chunks + self.parity
+        for lost in list(combinations(range(len(group)), 2)) + [(index,) for index in range(len(group))]:
+            available = [None if index in lost else chunk for index, chunk in enumerate(group)]
+            self.assertEqual(decode(available[:4], available[4:], self.sizes), self.chunks)
+
+    def test_too_many_lost_chunks(self):
+        with self.assertRaises(ValueError):
+            decode([None, None, self.chunks[2], self.chunks[3]], [self.parity[0], None], self.sizes)
+
+    def test_unsupported_group(self):
+        with self.assertRaises(ValueError):
+            encode(self.chunks, 0)
+        with self.assertRaises(ValueError):
+            encode([], 1)
@@ -0,0 +1,247 @@
+from unittest import TestCase
+import sys, os
+import time
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+import file_store
+from benchmarks.fake_memcached import FakeMemcachedServer
+
+
+class MemcachedClientTests(TestCase):
+
+    def setUp(self):
+        file_store._client = None
+
+    def tearDown(self):
+        file_store._client = None
+
+    def test_client_is_shared(self):
+        self.assertIs(file_store.memcached_client(), file_store.memcached_client())
+
+    def test_forked_child_creates_own_client(self):
+        client = file_store.memcached_client()
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child reports if it got a client of its own
+            os.write(write_end, b'1' if file_store._client is None and file_store.memcached_client() is not client
+                     else b'0')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_end, 1), b'1')
+        self.assertIs(file_store.memcached_client(), client)
+
+    def test_cluster_client_for_many_nodes(self):
+        with patch('file_store.config.memcached_nodes', ['node-1:11211', 'node-2:11212']):
+            client = file_store.memcached_client()
+        self.assertIsInstance(client, file_store.ClusterClient)
+        self.assertEqual([node.server for node in client.nodes], [('node-1', 11211), ('node-2', 11212)])
+
+    def test_client_created_once_across_threads(self):
+        with patch('file_store._create_client', side_effect=lambda: MagicMock()) as mock_obj:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                clients = list(executor.map(lambda _: file_store.memcached_client(), range(64)))
+            self.assertEqual(mock_obj.call_count, 1)
+            self.assertEqual(len(set(map(id, clients))), 1)
+
+
+class FetchTests(TestCase):
+
+    def test_fetch_many_uses_windows(self):
+        client = MagicMock()
+        client.get_many.side_effect = lambda keys: {key: key.encode() for key in keys}
+        with patch('file_store.memcached_client', return_value=client), \
+                patch('file_store.config.memcached_fetch_window', 4):
+            values = file_store.fetch_many([str(i) for i in range(10)])
+        self.assertEqual(values, [str(i).encode() for i in range(10)])
+        self.assertEqual(client.get_many.call_count, 3)
+
+    def test_fetch_many_missing_key(self):
+        client = MagicMock()
+        client.get_many.return_value = {'a': b'data'}
+        with patch('file_store.memcached_client', return_value=client):
+            with self.assertRaises(file_store.MemcacheKeyNotFound):
+                file_store.fetch_many(['a', 'b'])
+
+    def test_fetch_gets_key_once(self):
+        client = MagicMock()
+        client.get.return_value = b'data'
+        with patch('file_store.memcached_client', return_value=client):
+            self.assertEqual(file_store.fetch('a'), b'data')
+        client.get.assert_called_once_with('a')
+
+
+class CheckAllKeysTests(TestCase):
+
+    def test_existence_only_does_not_fetch_values(self):
+        client = MagicMock()
+        client.touch_many.side_effect = set
+        with patch('file_store.memcached_client', return_value=client):
+            self.assertTrue(file_store.check_all_keys(['a', 'b']))
+        client.touch_many.assert_called_once_with(['a', 'b'])
+        client.get.assert_not_called()
+        client.get_many.assert_not_called()
+
+    def test_existence_only_touches_keys_in_windows(self):
+        client = MagicMock()
+        client.touch_many.side_effect = set
+        keys = [f'key-{index}' for index in range(10)]
+        with patch('file_store.memcached_client', return_value=client), \
+                patch('file_store.config.memcached_fetch_window', 4):
+            self.assertTrue(file_store.check_all_keys(keys))
+        # one round trip for each window instead of one for each key
+        self.assertEqual(client.touch_many.call_count, 3)
+        client.touch.assert_not_called()
+
+    def test_missing_key_cleans_all_keys(self):
+        client = MagicMock()
+        client.touch_many.side_effect = lambda keys: set(keys) - {'b'}
+        with patch('file_store.memcached_client', return_value=client), \
+                patch('file_store.remove') as remove_mock:
+            self.assertFalse(file_store.check_all_keys(['a', 'b', 'c']))
+        remove_mock.assert_called_once_with(['a', 'b', 'c'])
+
+    def test_fetch_values_mode_uses_multi_get(self):
+        client = MagicMock()
+        client.get_many.side_effect = lambda keys: {key: b'data' for key in keys}
+        with patch('file_store.memcached_client', return_value=client):
+            self.assertTrue(file_store.check_all_keys(['a', 'b'], existence_only=False))
+        client.get_many.assert_called_once_with(['a', 'b'])
+        client.touch_many.assert_not_called()
+
+
+class PipelinedClientTests(TestCase):
+
+    def setUp(self):
+        self.server = FakeMemcachedServer().start()
+        self.client = file_store.PipelinedClient(self.server.server_address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_touch_many(self):
+        self.client.set('a', b'first')
+        self.client.set('c', b'third')
+        self.assertEqual(self.client.touch_many(['a', 'b', 'c']), {'a', 'c'})
+        self.assertEqual(self.client.touch_many([]), set())
+        self.assertEqual(self.server.commands['touch'], 3)
+
+
+class IterFetchTests(TestCase):
+
+    def test_iter_fetch_keeps_order(self):
+        client = MagicMock()
+        client.get_many.side_effect = lambda keys: {key: key.encode() for key in keys}
+        with patch('file_store.memcached_client', return_value=client):
+            values = list(file_store.iter_fetch([str(i) for i in range(7)], window=2))
+        self.assertEqual(values, [str(i).encode() for i in range(7)])
+        self.assertEqual(client.get_many.call_count, 4)
+
+    def test_iter_fetch_reads_ahead_one_window(self):
+        client = MagicMock()
+        client.get_many.side_effect = lambda keys: {key: key.encode() for key in keys}
+        with patch('file_store.memcached_client', return_value=client):
+            values = file_store.iter_fetch([str(i) for i in range(6)], window=2)
+            self.assertEqual(next(values), b'0')
+            # first window is consumed while second one is being fetched
+            deadline = time.monotonic() + 5
+            while client.get_many.call_count < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(client.get_many.call_count, 2)
+            values.close()
+
+    def test_iter_fetch_no_keys(self):
+        self.assertEqual(list(file_store.iter_fetch([])), [])
+
+
+class ContentAddressedStoreTests(TestCase):
+
+    def test_existing_chunk_is_not_sent_again(self):
+        client = MagicMock()
+        client.touch.return_value = True
+        with patch('file_store.memcached_client', return_value=client):
+            key = file_store.store_content_addressed(b'data', 'abc')
+        self.assertEqual(key, 'sha256:abc')
+        self.assertTrue(file_store.is_content_addressed(key))
+        client.set.assert_not_called()
+
+    def test_new_chunk_is_stored(self):
+        client = MagicMock()
+        client.touch.return_value = False
+        with patch('file_store.memcached_client', return_value=client):
+            file_store.store_content_addressed(b'data', 'abc')
+        client.set.assert_called_once_with('sha256:abc', b'data')
+
+    def test_packed_item_is_shared(self):
+        client = MagicMock()
+        with patch('file_store.memcached_client', return_value=client):
+            key = file_store.store_packed(b'data')
+        self.assertTrue(key.startswith('pack:'))
+        self.assertTrue(file_store.is_shared(key))
+        self.assertTrue(file_store.is_shared('sha256:abc'))
+        self.assertFalse(file_store.is_shared('0d6e4079-e2a6-4b3b-8ed4-0bf4b3d2cf3a'))
+        client.set.assert_called_once_with(key, b'data')
+
+
+class ScrubKeysTests(TestCase):
+
+    def test_recently_accessed(self):
+        connection = MagicMock()
+        connection.__enter__.return_value = connection
+        connection.makefile.return_value = BytesIO(b'HD l5\r\nEN\r\nHD l7200\r\n')
+        with patch('file_store.socket.create_connection', return_value=connection), \
+                patch('file_store.config.memcached_nodes', ['localhost:11211']):
+            self.assertEqual(file_store.recently_accessed(['new', 'missing', 'old'], 3600), {'new'})
+        # gets of window are sent together
+        connection.sendall.assert_called_once_with(b'mg new l\r\nmg missing l\r\nmg old l\r\n')
+
+    def test_keys_are_accessed_if_node_cant_tell(self):
+        connection = MagicMock()
+        connection.__enter__.return_value = connection
+        connection.makefile.return_value = BytesIO(b'ERROR\r\n')
+        with patch('file_store.socket.create_connection', return_value=connection), \
+                patch('file_store.config.memcached_nodes', ['localhost:11211']):
+            self.assertEqual(file_store.recently_accessed(['a', 'b'], 3600), {'a', 'b'})
+        with patch('file_store.socket.create_connection', side_effect=ConnectionRefusedError()), \
+                patch('file_store.config.memcached_nodes', ['localhost:11211']):
+            self.assertEqual(file_store.recently_accessed(['a'], 3600), {'a'})
+
+
+    def test_live_keys_uses_windows(self):
+        client = MagicMock()
+        client.touch_many.side_effect = lambda keys: set(keys) - {'key-3'}
+        with patch('file_store.memcached_client', return_value=client), \
+                patch('file_store.config.memcached_fetch_window', 2):
+            live = file_store.live_keys([f'key-{index}' for index in range(5)])
+        self.assertEqual(live, {'key-0', 'key-1', 'key-2', 'key-4'})
+        self.assertEqual(client.touch_many.call_count, 3)
+        # values of chunks are not fetched
+        client.get_many.assert_not_called()
+
+    def test_live_keys_of_disk_tier_are_not_probed_in_memcached(self):
+        client = MagicMock(spec=file_store.TieredClient)
+        client.disk = MagicMock()
+        client.disk.touch_many.return_value = {'key-0'}
+        client.memory = MagicMock()
+        client.memory.touch_many.side_effect = lambda keys: set(keys) - {'key-2'}
+        with patch('file_store.memcached_client', return_value=client):
+            live = file_store.live_keys(['key-0', 'key-1', 'key-2'])
+        self.assertEqual(live, {'key-0', 'key-1'})
+        client.memory.touch_many.assert_called_once_with(['key-1', 'key-2'])
+        client.memory.get_many.assert_not_called()
+
+    def test_idle_keys_are_listed_with_metadump(self):
+        now = int(time.time())
+        connection = MagicMock()
+        connection.__enter__.return_value.makefile.return_value = iter([
+            f'key=sha256%3Aabc exp=-1 la={now - 7200} cas=1 fetch=no cls=1 size=100\r\n'.encode(),
+            f'key=recent exp=-1 la={now} cas=2 fetch=no cls=1 size=100\r\n'.encode(),
+            b'END\r\n'])
+        with patch('file_store.memcached_client', return_value=MagicMock()), \
+                patch('file_store.socket.create_connection', return_value=connection):
+            self.assertEqual(list(file_store.idle_keys(3600)), ['sha256:abc'])
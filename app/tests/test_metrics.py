@@ -0,0 +1,70 @@
+from unittest import TestCase
+import sys, os
+import time
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from metrics import Counter, Histogram, InstrumentedClient, ProfileStore, SamplingProfiler, memcached_seconds
+
+
+class HistogramTests(TestCase):
+
+    def test_render(self):
+        histogram = Histogram('latency_seconds', 'Latency.', 'stage', buckets=(0.1, 1))
+        histogram.observe('store', 0.05)
+        histogram.observe('store', 0.5)
+        histogram.observe('store', 5)
+        self.assertEqual(histogram.render(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{stage="store",le="0.1"} 1',
+            'latency_seconds_bucket{stage="store",le="1"} 2',
+            'latency_seconds_bucket{stage="store",le="+Inf"} 3',
+            'latency_seconds_sum{stage="store"} 5.55',
+            'latency_seconds_count{stage="store"} 3'])
+
+
+class CounterTests(TestCase):
+
+    def test_render(self):
+        counter = Counter('hits_total', 'Hits.', 'source')
+        counter.inc(label_value='upload')
+        counter.inc(2, label_value='checksum')
+        self.assertEqual(counter.value('checksum'), 2)
+        self.assertEqual(counter.render()[2:], ['hits_total{source="checksum"} 2', 'hits_total{source="upload"} 1'])
+        self.assertEqual(Counter('bytes_total', 'Bytes.').render()[2:], ['bytes_total 0'])
+
+
+class InstrumentedClientTests(TestCase):
+
+    def test_observes_calls(self):
+        memory = MagicMock()
+        memory.get_many.return_value = {'a': b'1'}
+        client = InstrumentedClient(memory)
+        self.assertEqual(client.get_many(['a']), {'a': b'1'})
+        self.assertIn('memcached_operation_seconds_count{operation="get_many"}', '\n'.join(memcached_seconds.render()))
+        memory.set.side_effect = OSError("down")
+        with self.assertRaises(OSError):
+            client.set('a', b'1')
+        self.assertIn('memcached_operation_seconds_count{operation="set"}', '\n'.join(memcached_seconds.render()))
+
+
+class SamplingProfilerTests(TestCase):
+
+    def test_samples_current_thread(self):
+        profiler = SamplingProfiler(0.001).start()
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        profile = profiler.stop()
+        self.assertIn('test_samples_current_thread', profile)
+        stack, count = profile.splitlines()[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+
+    def test_store_keeps_recent_profiles(self):
+        store = ProfileStore(max_profiles=2)
+        for profile_id in ('a', 'b', 'c'):
+            store.put(profile_id, profile_id)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.get('c'), 'c')
@@ -0,0 +1,190 @@
+from unittest import TestCase
+import sys, os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from hashlib import sha256
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from flask import Flask
+
+from database import db
+import models
+from models import File, FilePart, release_keys
+
+
+class FileSaveTests(TestCase):
+
+    def test_save_reads_stream_once(self):
+        data = os.urandom(2500)
+        stream = MagicMock(wraps=BytesIO(data))
+        with patch('models.store', side_effect=lambda chunk: sha256(chunk).hexdigest()), \
+                patch('models.chunk_size', 1000):
+            parts = File(file_name='test').save(stream)
+        self.assertEqual([part.sequence for part in parts], [1, 2, 3])
+        stream.seek.assert_not_called()
+        self.assertEqual(stream.read.call_count, 4)
+
+    def test_save_sets_checksum_of_whole_data(self):
+        data = os.urandom(2500)
+        user_file = File(file_name='test')
+        with patch('models.store', side_effect=lambda chunk: sha256(chunk).hexdigest()), \
+                patch('models.chunk_size', 1000):
+            parts = user_file.save(BytesIO(data))
+        self.assertEqual(user_file.checksum, sha256(data).hexdigest())
+        self.assertEqual(b''.join(sha256(data[i:i + 1000]).digest() for i in range(0, 2500, 1000)),
+                         b''.join(bytes.fromhex(part.checksum) for part in parts))
+
+    def test_save_failure_removes_stored_chunks(self):
+        with patch('models.store', side_effect=['key-1', Exception("Mock exception")]), \
+                patch('models.remove') as remove_mock, patch('models.chunk_size', 1000):
+            with self.assertRaises(Exception):
+                File(file_name='test').save(BytesIO(os.urandom(2500)))
+        remove_mock.assert_called_once_with(['key-1'])
+
+
+class FileConcurrentSaveTests(TestCase):
+
+    @staticmethod
+    def _slow_store(chunk):
+        time.sleep(random.random() / 100)
+        return sha256(chunk).hexdigest()
+
+    def test_concurrent_save_keeps_sequence_order(self):
+        data = os.urandom(20000)
+        with patch('models.store', side_effect=self._slow_store), patch('models.chunk_size', 1000), \
+                patch('models.config.store_concurrency', 4), patch('models.config.store_max_in_flight', 3):
+            parts = File(file_name='test').save(BytesIO(data))
+        self.assertEqual([part.sequence for part in parts], list(range(1, 21)))
+        self.assertEqual([part.memcached_key for part in parts],
+                         [sha256(data[i:i + 1000]).hexdigest() for i in range(0, 20000, 1000)])
+
+    def test_concurrent_save_failure_removes_all_written_chunks(self):
+        def store(chunk):
+            if chunk == b'c' * 1000:
+                raise Exception("Mock exception")
+            return self._slow_store(chunk)
+
+        data = b''.join(bytes([letter]) * 1000 for letter in b'abcdef')
+        with patch('models.store', side_effect=store), patch('models.remove') as remove_mock, \
+                patch('models.chunk_size', 1000), patch('models.config.store_concurrency', 4), \
+                patch('models.config.store_max_in_flight', 8):
+            with self.assertRaises(Exception):
+                File(file_name='test').save(BytesIO(data))
+        removed = remove_mock.call_args[0][0]
+        self.assertEqual(sorted(removed),
+                         sorted(sha256(bytes([letter]) * 1000).hexdigest() for letter in b'abdef'))
+
+    def test_concurrent_uploads_both_progress(self):
+        # writes of first upload wait for second upload to write a chunk
+        second_stored = Event()
+        waits = []
+
+        def store(chunk):
+            if chunk[:1] == b'a':
+                waits.append(second_stored.wait(timeout=2))
+            else:
+                second_stored.set()
+            return sha256(chunk).hexdigest()
+
+        with patch('models.store', side_effect=store), patch('models.chunk_size', 1000), \
+                patch('models.config.store_concurrency', 2), patch('models.config.store_writer_threads', 4), \
+                patch('models.config.store_max_in_flight', 8), patch('models._write_executor', None):
+            try:
+                with ThreadPoolExecutor(max_workers=2) as uploads:
+                    first = uploads.submit(File(file_name='a').save, BytesIO(b'a' * 6000))
+                    # second upload starts once writes of first one hold their writers
+                    time.sleep(0.1)
+                    second = uploads.submit(File(file_name='b').save, BytesIO(b'b' * 2000))
+                    self.assertEqual(len(first.result()), 6)
+                    self.assertEqual(len(second.result()), 2)
+            finally:
+                models._write_executor.shutdown()
+        self.assertEqual(waits, [True] * 6)
+
+    def test_sequential_save(self):
+        with patch('models.store', side_effect=['key-1', 'key-2']), patch('models.chunk_size', 1000), \
+                patch('models.config.store_concurrency', 1), patch('models._writer') as writer_mock:
+            parts = File(file_name='test').save(BytesIO(os.urandom(1500)))
+        self.assertEqual([part.memcached_key for part in parts], ['key-1', 'key-2'])
+        writer_mock.assert_not_called()
+
+
+class DatabaseTestCase(TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def _stored_file(self, keys: list) -> File:
+        user_file = File(file_name='test')
+        for sequence, key in enumerate(keys, 1):
+            FilePart(checksum=key, memcached_key=key, sequence=sequence, file=user_file)
+        db.session.add(user_file)
+        db.session.commit()
+        return user_file
+
+
+class FilePartOrderTests(DatabaseTestCase):
+
+    def test_parts_are_listed_in_sequence(self):
+        user_file = File(file_name='test')
+        for sequence in (3, 1, 10, 2):
+            db.session.add(FilePart(checksum='c', memcached_key=f'key-{sequence}', sequence=sequence, file=user_file))
+        db.session.commit()
+        file_id = user_file.id
+        db.session.expire_all()
+        self.assertEqual([part.sequence for part in File.query.get(file_id).parts], [1, 2, 3, 10])
+
+
+class ReleaseKeysTests(DatabaseTestCase):
+
+    def test_shared_items_are_kept(self):
+        first = self._stored_file(['pack:a', 'pack:b'])
+        self._stored_file(['pack:b', 'pack:c'])
+        with patch('models.remove') as remove_mock:
+            release_keys(['pack:a', 'pack:b'], first.id)
+        remove_mock.assert_called_once_with(['pack:a'])
+
+    def test_content_addressed_chunks_are_left_to_scrubber(self):
+        # an upload in flight may have touched the chunk instead of writing it, and commit its parts later
+        first = self._stored_file(['sha256:a', 'key-1'])
+        with patch('models.remove') as remove_mock:
+            release_keys(['sha256:a', 'key-1'], first.id)
+            release_keys(['sha256:b'])
+        remove_mock.assert_called_once_with(['key-1'])
+
+    def test_discarded_upload_keeps_stored_chunks(self):
+        self._stored_file(['sha256:a', 'sha256:b'])
+        with patch('models.remove') as remove_mock:
+            release_keys(['sha256:a', 'sha256:b', 'sha256:a'])
+        remove_mock.assert_not_called()
+
+    def test_random_keys_are_removed(self):
+        first = self._stored_file(['key-1'])
+        with patch('models.remove') as remove_mock:
+            release_keys(['key-1', 'key-2'], first.id)
+        remove_mock.assert_called_once_with(['key-1', 'key-2'])
+
+    def test_content_addressed_save_stores_identical_chunks_once(self):
+        data = b'a' * 1000 + b'b' * 1000 + b'a' * 1000
+        with patch('models.store_content_addressed', side_effect=lambda chunk, checksum, codec: f"sha256:{checksum}"), \
+                patch('models.config.content_addressed_chunks', True), patch('models.chunk_size', 1000):
+            parts = File(file_name='test').save(BytesIO(data))
+        keys = [part.memcached_key for part in parts]
+        self.assertEqual(keys[0], keys[2])
+        self.assertEqual(len(set(keys)), 2)
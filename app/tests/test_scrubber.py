@@ -0,0 +1,106 @@
+from unittest import TestCase
+import sys, os
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from flask import Flask
+
+from database import db
+from models import File, FilePart, UploadSession
+from scrubber import Scrubber
+
+
+class ScrubberTests(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.stored = {'a-1', 'sha256:a-2', 'c-2', 'c-parity', 'orphan', 'dead-part', 'open-1', 'expired-1'}
+        self.idle = ['a-1', 'orphan']
+        self.accessed = set()
+        self.patches = [patch('scrubber.live_keys', side_effect=lambda keys: set(keys) & self.stored),
+                        patch('scrubber.idle_keys', side_effect=lambda seconds: iter(self.idle)),
+                        patch('scrubber.recently_accessed', side_effect=lambda keys, seconds: set(keys) & self.accessed),
+                        patch('scrubber.remove', side_effect=self._remove),
+                        patch('models.remove', side_effect=self._remove)]
+        for mock_patch in self.patches:
+            mock_patch.start()
+
+    def tearDown(self):
+        for mock_patch in self.patches:
+            mock_patch.stop()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def _remove(self, keys):
+        self.stored -= set(keys)
+
+    def _stored_file(self, name: str, keys: list, parity_keys: list = ()) -> int:
+        user_file = File(file_name=name, checksum=name)
+        group = 0 if parity_keys else None
+        for sequence, key in enumerate(list(keys) + list(parity_keys), 1):
+            FilePart(checksum=key, memcached_key=key, sequence=sequence, file=user_file,
+                     parity=key in parity_keys, parity_group=group)
+        db.session.add(user_file)
+        db.session.commit()
+        return user_file.id
+
+    def test_pass(self):
+        live_id = self._stored_file('a', ['a-1', 'sha256:a-2'])
+        dead_id = self._stored_file('b', ['b-1', 'sha256:a-2'])
+        recoverable_id = self._stored_file('c', ['c-1', 'c-2'], ['c-parity'])
+        db.session.add(FilePart(checksum='d', memcached_key='dead-part', sequence=1, file_id=1000))
+        db.session.commit()
+
+        stats = Scrubber(self.app, batch_size=2).run()
+
+        self.assertEqual((stats['files'], stats['dead_files'], stats['dead_parts'], stats['orphan_keys']),
+                         (3, 1, 1, 1))
+        self.assertEqual({file.id for file in File.query}, {live_id, recoverable_id})
+        self.assertIsNone(FilePart.query.filter(FilePart.file_id.in_([dead_id, 1000])).first())
+        self.assertIsNotNone(File.query.get(live_id).scrubbed_at)
+        # chunk shared with live file is kept, chunks of dead part and orphan chunk are removed
+        self.assertEqual(self.stored, {'a-1', 'sha256:a-2', 'c-2', 'c-parity', 'open-1', 'expired-1'})
+
+    def test_expired_upload_sessions(self):
+        now = datetime.utcnow()
+        for session_id, expires_at in (('open', now + timedelta(hours=1)), ('expired', now - timedelta(hours=1))):
+            db.session.add(UploadSession(id=session_id, file_name=session_id, expires_at=expires_at))
+            db.session.add(FilePart(checksum='c', memcached_key=f'{session_id}-1', sequence=1,
+                                    upload_session_id=session_id, upload_part=1))
+        db.session.commit()
+
+        stats = Scrubber(self.app).run()
+
+        self.assertEqual((stats['expired_sessions'], stats['dead_parts']), (1, 0))
+        self.assertEqual([upload.id for upload in UploadSession.query], ['open'])
+        self.assertEqual([part.memcached_key for part in FilePart.query], ['open-1'])
+        self.assertIn('open-1', self.stored)
+        self.assertNotIn('expired-1', self.stored)
+
+    def test_dead_files_sharing_a_key_release_it(self):
+        self.stored |= {'pack:shared'}
+        self._stored_file('a', ['pack:shared', 'a-missing'])
+        self._stored_file('b', ['pack:shared', 'b-missing'])
+
+        stats = Scrubber(self.app).run()
+
+        self.assertEqual(stats['dead_files'], 2)
+        self.assertNotIn('pack:shared', self.stored)
+
+    def test_recently_accessed_orphan_is_kept(self):
+        # upload in flight has just found key stored, and refers to it once it commits
+        self.accessed = {'orphan'}
+
+        stats = Scrubber(self.app).run()
+
+        self.assertEqual(stats['orphan_keys'], 1)
+        self.assertEqual(self.stored & {'a-1', 'orphan'}, {'orphan'})
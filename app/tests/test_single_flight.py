@@ -0,0 +1,54 @@
+from unittest import TestCase
+import sys, os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+from single_flight import SingleFlight
+
+
+class SingleFlightTests(TestCase):
+
+    def test_concurrent_callers_share_call(self):
+        flight = SingleFlight()
+        calls = []
+        release = Event()
+
+        def function():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(flight.do, 'key', function) for _ in range(8)]
+            while flight.calls + flight.shared < 8:
+                time.sleep(0.001)
+            release.set()
+            self.assertEqual([future.result() for future in futures], ['result'] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.shared, 7)
+
+    def test_error_is_raised_to_all_callers(self):
+        flight = SingleFlight()
+        release = Event()
+
+        def function():
+            release.wait(5)
+            raise ValueError("Mock exception")
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(flight.do, 'key', function) for _ in range(4)]
+            while flight.calls + flight.shared < 4:
+                time.sleep(0.001)
+            release.set()
+            for future in futures:
+                with self.assertRaises(ValueError):
+                    future.result()
+
+    def test_sequential_calls_are_not_shared(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+        self.assertEqual(flight.shared, 0)
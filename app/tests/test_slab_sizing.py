@@ -0,0 +1,80 @@
+from unittest import TestCase
+import sys, os
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+import slab_sizing
+from slab_sizing import fit_chunk_size, fitted_chunk_size, slab_classes
+
+# stats settings of memcached 1.6 with default slab settings, as returned by pymemcache
+SETTINGS = {b'item_size_max': 1048576, b'slab_chunk_max': 524288, b'chunk_size': 48, b'growth_factor': 1.25}
+
+
+class SlabClassesTests(TestCase):
+
+    def test_classes_follow_settings(self):
+        classes = slab_classes(SETTINGS)
+        self.assertEqual(len(classes), 39)
+        self.assertEqual(classes[:3], [96, 120, 152])
+        self.assertEqual(classes[-2:], [394840, 524288])
+
+    def test_listed_classes_are_added(self):
+        classes = slab_classes(SETTINGS, {b'1:chunk_size': b'100', b'1:used_chunks': b'3', b'active_slabs': 1})
+        self.assertIn(100, classes)
+        self.assertEqual(slab_classes({}, {b'1:chunk_size': b'100'}), [100])
+
+    def test_fit_chunk_size(self):
+        classes = slab_classes(SETTINGS)
+        # items of full chunks fill largest class instead of leaving 24 KB of it unused
+        self.assertEqual(fit_chunk_size(500000, classes), 524288 - slab_sizing.ITEM_OVERHEAD_BYTES)
+        self.assertEqual(fit_chunk_size(64000, classes) + slab_sizing.ITEM_OVERHEAD_BYTES, 66232)
+        self.assertEqual(fit_chunk_size(4, [96, 120]), 4)
+
+
+class FittedChunkSizeTests(TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.stats.side_effect = lambda name: SETTINGS if name == 'settings' else {}
+        self.now = 0
+        self.patches = [patch('slab_sizing.memcached_client', return_value=self.client),
+                        patch('slab_sizing.time.monotonic', side_effect=lambda: self.now),
+                        patch('slab_sizing.config.adaptive_chunk_size', True),
+                        patch('slab_sizing.config.chunk_size_refresh_seconds', 300),
+                        patch('slab_sizing._node_classes', None),
+                        patch('slab_sizing._read_at', None)]
+        for mock_patch in self.patches:
+            mock_patch.start()
+
+    def tearDown(self):
+        for mock_patch in self.patches:
+            mock_patch.stop()
+
+    def test_disabled(self):
+        with patch('slab_sizing.config.adaptive_chunk_size', False):
+            self.assertEqual(fitted_chunk_size(500000), 500000)
+        self.client.stats.assert_not_called()
+
+    def test_stats_are_read_again_after_refresh_interval(self):
+        self.assertEqual(fitted_chunk_size(500000), 524144)
+        self.assertEqual(fitted_chunk_size(64000), 66088)
+        self.assertEqual(self.client.stats.call_count, 2)
+        self.now = 301
+        self.client.stats.side_effect = lambda name: {**SETTINGS, b'slab_chunk_max': 262144} \
+            if name == 'settings' else {}
+        self.assertEqual(fitted_chunk_size(500000), 262144 - slab_sizing.ITEM_OVERHEAD_BYTES)
+        self.assertEqual(self.client.stats.call_count, 4)
+
+    def test_smallest_size_of_cluster_nodes(self):
+        self.client.stats.side_effect = lambda name: {
+            'a:11211': SETTINGS, 'b:11211': {**SETTINGS, b'slab_chunk_max': 262144}} \
+            if name == 'settings' else {'a:11211': {}, 'b:11211': {}}
+        self.assertEqual(fitted_chunk_size(500000), 262144 - slab_sizing.ITEM_OVERHEAD_BYTES)
+
+    def test_unreadable_stats_keep_configured_size(self):
+        self.client.stats.side_effect = ConnectionRefusedError()
+        self.assertEqual(fitted_chunk_size(500000), 500000)
+        # stats are not read again until refresh interval has passed
+        fitted_chunk_size(500000)
+        self.assertEqual(self.client.stats.call_count, 1)